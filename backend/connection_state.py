@@ -0,0 +1,229 @@
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Iterable, List, Set, Tuple
+from fanout import FanoutBus, RedisBus
+import os
+import time
+
+# Store-and-forward for offline users: frames kept per user, for how long (seconds), and for how many users
+OFFLINE_QUEUE_SIZE = int(os.getenv("OFFLINE_QUEUE_SIZE", "100"))
+OFFLINE_QUEUE_TTL = float(os.getenv("OFFLINE_QUEUE_TTL", str(24 * 3600)))
+OFFLINE_QUEUE_MAX_USERS = int(os.getenv("OFFLINE_QUEUE_MAX_USERS", "50000"))
+# How long a worker's claim that a user is connected to it lasts without being refreshed (seconds).
+# Workers refresh their claims every heartbeat, so the claims of a worker that died run out on their own.
+CONNECTION_LEASE = float(os.getenv("CONNECTION_LEASE", "90"))
+
+
+class ConnectionRegistry:
+    """Knows which users have an open socket on any worker.
+
+    WebSocketManager calls connect() when a user's first socket opens on this
+    worker and disconnect() when the last one closes there.
+    """
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def connect(self, uid: str) -> bool:
+        """Records the user as connected here; True if they had no socket on any worker before."""
+        raise NotImplementedError
+
+    async def disconnect(self, uid: str) -> bool:
+        """Records that the user left this worker; True if they have no socket on any worker now."""
+        raise NotImplementedError
+
+    async def connected(self, uids: Iterable[str]) -> Set[str]:
+        """Of uids, the users with an open socket on some worker."""
+        raise NotImplementedError
+
+    async def refresh(self, uids: Iterable[str]):
+        """Renews this worker's claims on its connected users (called every heartbeat)."""
+        pass
+
+
+class LocalConnectionRegistry(ConnectionRegistry):
+    """Single process: this worker's own connection table is the whole picture."""
+
+    def __init__(self, active_connections: Dict[str, Set]):
+        self.active_connections = active_connections
+
+    async def connect(self, uid: str) -> bool:
+        return True
+
+    async def disconnect(self, uid: str) -> bool:
+        return True
+
+    async def connected(self, uids: Iterable[str]) -> Set[str]:
+        return {uid for uid in uids if uid in self.active_connections}
+
+
+class RedisConnectionRegistry(ConnectionRegistry):
+    """Connections shared through Redis: online:<uid> is a sorted set of worker IDs scored by lease expiry."""
+
+    def __init__(self, url: str, worker_id: str, lease: float = CONNECTION_LEASE):
+        self.url = url
+        self.worker_id = worker_id
+        self.lease = lease
+        self._redis = None
+
+    async def start(self):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("❌ FANOUT_BACKEND=redis requires the 'redis' package (pip install redis)")
+        self._redis = redis.from_url(self.url)
+
+    async def stop(self):
+        if self._redis:
+            await self._redis.aclose()
+
+    @staticmethod
+    def _key(uid: str) -> str:
+        return f"online:{uid}"
+
+    async def connect(self, uid: str) -> bool:
+        now = time.time()
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(self._key(uid), "-inf", now)
+            pipe.zadd(self._key(uid), {self.worker_id: now + self.lease})
+            pipe.expire(self._key(uid), int(self.lease) + 1)
+            pipe.zcard(self._key(uid))
+            *_, count = await pipe.execute()
+        return count == 1
+
+    async def disconnect(self, uid: str) -> bool:
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self._key(uid), self.worker_id)
+            pipe.zremrangebyscore(self._key(uid), "-inf", time.time())
+            pipe.zcard(self._key(uid))
+            *_, count = await pipe.execute()
+        return count == 0
+
+    async def connected(self, uids: Iterable[str]) -> Set[str]:
+        uids = list(uids)
+        if not uids:
+            return set()
+        now = time.time()
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for uid in uids:
+                pipe.zcount(self._key(uid), now, "+inf")
+            counts = await pipe.execute()
+        return {uid for uid, count in zip(uids, counts) if count}
+
+    async def refresh(self, uids: Iterable[str]):
+        uids = list(uids)
+        if not uids:
+            return
+        expires_at = time.time() + self.lease
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for uid in uids:
+                pipe.zadd(self._key(uid), {self.worker_id: expires_at})
+                pipe.expire(self._key(uid), int(self.lease) + 1)
+            await pipe.execute()
+
+
+class OfflineQueue:
+    """Encoded frames waiting for users with no open socket, flushed when they connect.
+
+    Each user keeps at most OFFLINE_QUEUE_SIZE frames (oldest dropped first),
+    each for OFFLINE_QUEUE_TTL seconds; at most OFFLINE_QUEUE_MAX_USERS users
+    are tracked (least recently queued for dropped first).
+    """
+
+    def __init__(self):
+        # uid -> (expires_at, frame), least recently queued user first
+        self._queues: "OrderedDict[str, Deque[Tuple[float, str]]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        """Users with frames queued."""
+        return len(self._queues)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def push(self, uids: Iterable[str], frame: str):
+        expires_at = time.monotonic() + OFFLINE_QUEUE_TTL
+        for uid in uids:
+            queue = self._queues.get(uid)
+            if queue is None:
+                queue = self._queues[uid] = deque(maxlen=OFFLINE_QUEUE_SIZE)
+                if len(self._queues) > OFFLINE_QUEUE_MAX_USERS:
+                    self._queues.popitem(last=False)
+            else:
+                self._queues.move_to_end(uid)
+            queue.append((expires_at, frame))
+
+    async def take(self, uid: str) -> List[str]:
+        """Removes and returns a user's unexpired frames, oldest first."""
+        queue = self._queues.pop(uid, None)
+        if not queue:
+            return []
+        now = time.monotonic()
+        return [frame for expires_at, frame in queue if expires_at > now]
+
+
+class RedisOfflineQueue(OfflineQueue):
+    """Queues shared through Redis (offline:<uid> lists), so a user gets them whichever worker they reconnect to.
+
+    Same per-user size and TTL as the local queue; a user's list expires
+    OFFLINE_QUEUE_TTL after its last push instead of counting towards a user cap.
+    """
+
+    def __init__(self, url: str):
+        super().__init__()
+        self.url = url
+        self._redis = None
+
+    def __len__(self) -> int:
+        # Queues live in Redis, not on this worker
+        return 0
+
+    async def start(self):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("❌ FANOUT_BACKEND=redis requires the 'redis' package (pip install redis)")
+        self._redis = redis.from_url(self.url)
+
+    async def stop(self):
+        if self._redis:
+            await self._redis.aclose()
+
+    async def push(self, uids: Iterable[str], frame: str):
+        uids = list(uids)
+        if not uids:
+            return
+        # Expiry (wall clock, shared by every host) on the first line, the encoded frame after it
+        entry = f"{time.time() + OFFLINE_QUEUE_TTL}\n{frame}"
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for uid in uids:
+                key = f"offline:{uid}"
+                pipe.rpush(key, entry)
+                pipe.ltrim(key, -OFFLINE_QUEUE_SIZE, -1)
+                pipe.expire(key, int(OFFLINE_QUEUE_TTL))
+            await pipe.execute()
+
+    async def take(self, uid: str) -> List[str]:
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.lrange(f"offline:{uid}", 0, -1)
+            pipe.delete(f"offline:{uid}")
+            entries, _ = await pipe.execute()
+        now = time.time()
+        frames = []
+        for entry in entries:
+            expires_at, _, frame = entry.decode().partition("\n")
+            if float(expires_at) > now:
+                frames.append(frame)
+        return frames
+
+
+def create_connection_state(bus: FanoutBus, active_connections: Dict[str, Set]) -> Tuple[ConnectionRegistry, OfflineQueue]:
+    """Shares the registry and offline queues through Redis whenever fan-out does."""
+    if isinstance(bus, RedisBus):
+        return RedisConnectionRegistry(bus.url, bus.worker_id), RedisOfflineQueue(bus.url)
+    return LocalConnectionRegistry(active_connections), OfflineQueue()
@@ -1,6 +1,9 @@
 from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+from typing import BinaryIO, Iterable, Iterator, Optional
 import base64
 import os
+import struct
 
 SECRET_KEY = os.getenv("SECRET_KEY")  # 🔥 Must be set in environment variables!
 
@@ -8,40 +11,173 @@ if not SECRET_KEY or len(SECRET_KEY) < 16:
     raise ValueError("SECRET_KEY environment variable must be at least 16 bytes long.")
 
 SECRET_KEY = SECRET_KEY[:16]  # Ensure it's exactly 16 bytes
+_KEY = SECRET_KEY.encode()
 
-def encrypt_message(message: str) -> str:
-    """Encrypts a message using AES."""
-    cipher = AES.new(SECRET_KEY.encode(), AES.MODE_EAX)
-    nonce = cipher.nonce
-    ciphertext, tag = cipher.encrypt_and_digest(message.encode())
-    # Include the tag in the encrypted data
-    return base64.b64encode(nonce + tag + ciphertext).decode()
+# Message envelope written by encrypt_message: "1" = legacy AES-EAX (unprefixed base64 of
+# nonce + tag + ciphertext), "2" = "v2:" + base64 of AES-GCM nonce + ciphertext + tag.
+# Both are always readable, so writers can be switched over without a flag day.
+MESSAGE_CIPHER_VERSION = os.getenv("MESSAGE_CIPHER_VERSION", "1")
+V2_PREFIX = "v2:"
 
-def decrypt_message(encrypted_message: str) -> str:
-    """Decrypts a message using AES."""
+# Streaming file format: header = magic + plaintext chunk size + random nonce prefix,
+# then one AES-GCM record (ciphertext + 16-byte tag) per chunk. Every chunk but the last is full size.
+FILE_MAGIC = b"ECF1"
+FILE_CHUNK_SIZE = int(os.getenv("FILE_CHUNK_SIZE", str(64 * 1024)))
+FILE_HEADER = struct.Struct(">4sI8s")
+FILE_TAG_SIZE = 16
+
+def _encrypt_v1(key: bytes, plaintext: bytes) -> str:
+    cipher = AES.new(key, AES.MODE_EAX)
+    ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+    return base64.b64encode(cipher.nonce + tag + ciphertext).decode()
+
+def _encrypt_v2(key: bytes, plaintext: bytes) -> str:
+    cipher = AES.new(key, AES.MODE_GCM, nonce=get_random_bytes(12))
+    ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+    return V2_PREFIX + base64.b64encode(cipher.nonce + ciphertext + tag).decode()
+
+_ENCRYPTORS = {"1": _encrypt_v1, "2": _encrypt_v2}
+
+def _decrypt(key: bytes, encrypted_message: str) -> str:
+    if encrypted_message.startswith(V2_PREFIX):
+        data = base64.b64decode(encrypted_message[len(V2_PREFIX):])
+        cipher = AES.new(key, AES.MODE_GCM, nonce=data[:12])
+        return cipher.decrypt_and_verify(data[12:-16], data[-16:]).decode()
+
+    # v1: no prefix (base64 never contains ":")
     data = base64.b64decode(encrypted_message)
-    nonce = data[:16]
-    tag = data[16:32]  # Extract the tag
-    ciphertext = data[32:]
-    cipher = AES.new(SECRET_KEY.encode(), AES.MODE_EAX, nonce=nonce)
-    # Verify the tag during decryption
-    plaintext = cipher.decrypt_and_verify(ciphertext, tag)
-    return plaintext.decode()
+    cipher = AES.new(key, AES.MODE_EAX, nonce=data[:16])
+    return cipher.decrypt_and_verify(data[32:], data[16:32]).decode()
+
+def _encryptor(version: Optional[str]):
+    version = version or MESSAGE_CIPHER_VERSION
+    if version not in _ENCRYPTORS:
+        raise ValueError(f"Unknown message cipher version: {version}")
+    return _ENCRYPTORS[version]
+
+def encrypt_message(message: str, version: Optional[str] = None) -> str:
+    """Encrypts a message using AES (envelope version from MESSAGE_CIPHER_VERSION unless given)."""
+    return _encryptor(version)(_KEY, message.encode())
+
+def decrypt_message(encrypted_message: str) -> str:
+    """Decrypts a message using AES; accepts every envelope version."""
+    return _decrypt(_KEY, encrypted_message)
+
+def _chunk_cipher(header: bytes, index: int, final: bool):
+    """AES-GCM cipher for one chunk.
+
+    The nonce is the file's random prefix plus the chunk index, so chunks
+    cannot be reordered; the header and a final-chunk flag are bound as
+    associated data, so a stream cut at a chunk boundary fails to verify.
+    """
+    if index >= 2 ** 32:
+        raise ValueError("File has too many chunks")
+    cipher = AES.new(_KEY, AES.MODE_GCM, nonce=header[8:16] + struct.pack(">I", index))
+    cipher.update(header + (b"\x01" if final else b"\x00"))
+    return cipher
+
+def _rechunk(pieces: Iterable[bytes], size: int) -> Iterator[bytes]:
+    """Regroups arbitrary byte pieces into size-byte chunks (the last one may be shorter)."""
+    buffer = bytearray()
+    for piece in pieces:
+        buffer.extend(piece)
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+def _with_last_flag(chunks: Iterator[bytes]) -> Iterator[tuple]:
+    """Yields (chunk, is_last) pairs, always at least one (empty input gives one empty last chunk)."""
+    previous = next(chunks, b"")
+    for chunk in chunks:
+        yield previous, False
+        previous = chunk
+    yield previous, True
+
+def encrypt_file_stream(pieces: Iterable[bytes], chunk_size: int = FILE_CHUNK_SIZE) -> Iterator[bytes]:
+    """Encrypts a file given as an iterable of byte pieces; yields the header, then one record per chunk."""
+    header = FILE_HEADER.pack(FILE_MAGIC, chunk_size, get_random_bytes(8))
+    yield header
+    for index, (chunk, last) in enumerate(_with_last_flag(_rechunk(pieces, chunk_size))):
+        ciphertext, tag = _chunk_cipher(header, index, last).encrypt_and_digest(chunk)
+        yield ciphertext + tag
+
+def _read_header(header: bytes) -> int:
+    if len(header) != FILE_HEADER.size:
+        raise ValueError("Truncated encrypted file header")
+    magic, chunk_size, _ = FILE_HEADER.unpack(header)
+    if magic != FILE_MAGIC or chunk_size <= 0:
+        raise ValueError("Not a chunked encrypted file")
+    return chunk_size
+
+def decrypt_file_stream(pieces: Iterable[bytes]) -> Iterator[bytes]:
+    """Decrypts a chunked encrypted file given as byte pieces; yields verified plaintext chunk by chunk.
+
+    Raises ValueError on a tampered, reordered or truncated stream.
+    """
+    pieces = iter(pieces)
+    head = bytearray()
+    for piece in pieces:
+        head.extend(piece)
+        if len(head) >= FILE_HEADER.size:
+            break
+    header = bytes(head[:FILE_HEADER.size])
+    chunk_size = _read_header(header)
+
+    def _body():
+        yield bytes(head[FILE_HEADER.size:])
+        yield from pieces
+
+    records = _rechunk(_body(), chunk_size + FILE_TAG_SIZE)
+    for index, (record, last) in enumerate(_with_last_flag(records)):
+        if len(record) < FILE_TAG_SIZE:
+            raise ValueError("Truncated encrypted file")
+        cipher = _chunk_cipher(header, index, last)
+        yield cipher.decrypt_and_verify(record[:-FILE_TAG_SIZE], record[-FILE_TAG_SIZE:])
+
+def decrypt_file_range(encrypted_file: BinaryIO, start: int, end: Optional[int] = None) -> Iterator[bytes]:
+    """Decrypts plaintext bytes [start, end) from a seekable chunked encrypted file.
+
+    Only the chunks covering the range are read and verified.
+    """
+    encrypted_file.seek(0)
+    header = encrypted_file.read(FILE_HEADER.size)
+    chunk_size = _read_header(header)
+    record_size = chunk_size + FILE_TAG_SIZE
+
+    body_size = encrypted_file.seek(0, os.SEEK_END) - FILE_HEADER.size
+    record_count = max(1, -(-body_size // record_size))
+    plaintext_size = body_size - record_count * FILE_TAG_SIZE
+    if plaintext_size < 0:
+        raise ValueError("Truncated encrypted file")
+    end = plaintext_size if end is None else min(end, plaintext_size)
+
+    index = start // chunk_size
+    while start < end:
+        encrypted_file.seek(FILE_HEADER.size + index * record_size)
+        record = encrypted_file.read(record_size)
+        cipher = _chunk_cipher(header, index, index == record_count - 1)
+        chunk = cipher.decrypt_and_verify(record[:-FILE_TAG_SIZE], record[-FILE_TAG_SIZE:])
+        offset = start - index * chunk_size
+        piece = chunk[offset:offset + end - start]
+        yield piece
+        start += len(piece)
+        index += 1
 
 def encrypt_file(file_bytes: bytes) -> bytes:
-    """Encrypts binary file data (e.g., image or PDF)."""
-    cipher = AES.new(SECRET_KEY.encode(), AES.MODE_EAX)
-    nonce = cipher.nonce
-    ciphertext, tag = cipher.encrypt_and_digest(file_bytes)
-    # Store nonce + tag + ciphertext
-    return nonce + tag + ciphertext
+    """Encrypts binary file data (e.g., image or PDF) in the chunked format."""
+    return b"".join(encrypt_file_stream([file_bytes]))
 
 def decrypt_file(encrypted_bytes: bytes) -> bytes:
-    """Decrypts binary file data (e.g., image or PDF)."""
+    """Decrypts binary file data (e.g., image or PDF); reads both the chunked and the older single-tag format."""
+    if encrypted_bytes[:len(FILE_MAGIC)] == FILE_MAGIC:
+        return b"".join(decrypt_file_stream([encrypted_bytes]))
+
     nonce = encrypted_bytes[:16]
     tag = encrypted_bytes[16:32]
     ciphertext = encrypted_bytes[32:]
     
-    cipher = AES.new(SECRET_KEY.encode(), AES.MODE_EAX, nonce=nonce)
+    cipher = AES.new(_KEY, AES.MODE_EAX, nonce=nonce)
     # Verify the tag during decryption
-    return cipher.decrypt_and_verify(ciphertext, tag)
\ No newline at end of file
+    return cipher.decrypt_and_verify(ciphertext, tag)
@@ -0,0 +1,161 @@
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+import asyncio
+import json
+import os
+import uuid
+
+# "local" keeps delivery inside this process; "redis" fans out across every worker subscribed to REDIS_URL
+FANOUT_BACKEND = os.getenv("FANOUT_BACKEND", "local")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+FANOUT_CHANNEL = os.getenv("FANOUT_CHANNEL", "chat:fanout")
+
+# Delivers an encoded frame to the sockets this worker holds for the given UIDs (None = every
+# connected user), skipping an optional excluded UID; the flag marks low-priority frames
+DeliveryHandler = Callable[[Optional[List[str]], str, Optional[str], bool], Awaitable[int]]
+
+# Applies a change another worker made to shared state (cache invalidation, index update, ...)
+EventHandler = Callable[[Dict[str, Any]], None]
+
+
+class FanoutBus:
+    """Routes outbound frames to whichever worker process holds the recipients' sockets.
+
+    WebSocketManager publishes every frame on the bus, already JSON-encoded;
+    each worker registers a handler that writes it to its own local connections.
+
+    The bus also carries events: small notices that one worker changed state
+    that the others keep their own copy of (cached memberships and profiles,
+    the username index). A worker applies its own change directly and emits
+    an event so every other worker applies it too.
+    """
+
+    def __init__(self):
+        self._handler: Optional[DeliveryHandler] = None
+        self._event_handlers: Dict[str, EventHandler] = {}
+        self._event_tasks: Set[asyncio.Task] = set()
+
+    def set_handler(self, handler: DeliveryHandler):
+        self._handler = handler
+
+    def on_event(self, kind: str, handler: EventHandler):
+        self._event_handlers[kind] = handler
+
+    def emit(self, kind: str, payload: Dict[str, Any]):
+        """Sends an event to the other workers without waiting (usable from synchronous code)."""
+        task = asyncio.create_task(self.publish_event(kind, payload))
+        self._event_tasks.add(task)
+        task.add_done_callback(self._event_tasks.discard)
+
+    async def publish_event(self, kind: str, payload: Dict[str, Any]):
+        """Delivers an event to every other worker; a single-process bus has none."""
+        pass
+
+    def _dispatch_event(self, kind: str, payload: Dict[str, Any]):
+        handler = self._event_handlers.get(kind)
+        if handler is not None:
+            handler(payload)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, uids: Optional[List[str]], frame: str, exclude_uid: str = None,
+                      low_priority: bool = False) -> Optional[int]:
+        """Publishes a frame for uids; returns the number of sockets it was queued for, when known."""
+        raise NotImplementedError
+
+
+class LocalBus(FanoutBus):
+    """Single-process bus: frames go straight to this worker's connections."""
+
+    async def publish(self, uids: Optional[List[str]], frame: str, exclude_uid: str = None,
+                      low_priority: bool = False) -> Optional[int]:
+        return await self._handler(uids, frame, exclude_uid, low_priority)
+
+
+class RedisBus(FanoutBus):
+    """Inter-process bus over Redis pub/sub.
+
+    Every worker subscribes to the same channel, so a frame published by the
+    sender's worker reaches the receiver whichever worker (or host) they are
+    connected to. Works with any server speaking the Redis protocol.
+    """
+
+    def __init__(self, url: str = REDIS_URL, channel: str = FANOUT_CHANNEL):
+        super().__init__()
+        self.url = url
+        self.channel = channel
+        self.events_channel = f"{channel}:events"
+        # Events carry their sender so a worker skips the ones it emitted itself
+        self.worker_id = uuid.uuid4().hex
+        self._redis = None
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("❌ FANOUT_BACKEND=redis requires the 'redis' package (pip install redis)")
+
+        self._redis = redis.from_url(self.url)
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.subscribe(self.channel, self.events_channel)
+        self._listener = asyncio.create_task(self._listen())
+        print(f"📡 Fan-out bus subscribed to {self.channel}")
+
+    async def stop(self):
+        if self._listener:
+            self._listener.cancel()
+        if self._pubsub:
+            await self._pubsub.unsubscribe(self.channel, self.events_channel)
+            await self._pubsub.aclose()
+        if self._redis:
+            await self._redis.aclose()
+
+    async def _listen(self):
+        async for message in self._pubsub.listen():
+            if message["type"] != "message":
+                continue
+            channel = message["channel"].decode() if isinstance(message["channel"], bytes) else message["channel"]
+            if channel == self.events_channel:
+                self._receive_event(message["data"])
+                continue
+            try:
+                header, _, frame = message["data"].decode().partition("\n")
+                envelope = json.loads(header)
+                await self._handler(envelope["uids"], frame, envelope.get("exclude"), envelope.get("low", False))
+            except Exception as e:
+                print(f"❌ Error delivering fan-out frame: {e}")
+
+    async def publish(self, uids: Optional[List[str]], frame: str, exclude_uid: str = None,
+                      low_priority: bool = False) -> Optional[int]:
+        # Routing header on the first line, the frame text (sent verbatim to sockets) after it
+        envelope = {"uids": uids, "exclude": exclude_uid, "low": low_priority}
+        await self._redis.publish(self.channel, json.dumps(envelope) + "\n" + frame)
+        return None
+
+    async def publish_event(self, kind: str, payload: Dict[str, Any]):
+        try:
+            await self._redis.publish(self.events_channel, json.dumps({"origin": self.worker_id, "kind": kind, "payload": payload}))
+        except Exception as e:
+            print(f"❌ Error publishing {kind} event: {e}")
+
+    def _receive_event(self, data: bytes):
+        try:
+            event = json.loads(data)
+            if event["origin"] != self.worker_id:
+                self._dispatch_event(event["kind"], event["payload"])
+        except Exception as e:
+            print(f"❌ Error applying fan-out event: {e}")
+
+
+def create_bus(backend: str = FANOUT_BACKEND) -> FanoutBus:
+    """Builds the fan-out bus selected by FANOUT_BACKEND."""
+    if backend == "local":
+        return LocalBus()
+    if backend == "redis":
+        return RedisBus()
+    raise ValueError(f"Unknown FANOUT_BACKEND: {backend}")
@@ -0,0 +1,151 @@
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Set
+from message_writer import MessageWriter
+from repository import FirestoreRepository, group_conversation_id
+from search_index import MessageSearchIndex
+import asyncio
+import os
+import uuid
+
+# Documents deleted per batched commit
+GROUP_DELETE_BATCH_SIZE = int(os.getenv("GROUP_DELETE_BATCH_SIZE", "400"))
+# How long a worker owns a job without recording progress; after that another worker may take it over (seconds)
+GROUP_DELETE_LEASE = float(os.getenv("GROUP_DELETE_LEASE", "120"))
+
+# Job phases, run in this order; a resumed job starts again at its recorded phase (every phase is idempotent)
+PHASES = ("members", "read_markers", "messages", "search_index", "add_requests", "group")
+
+
+class GroupDeletionJobs:
+    """Deletes groups in the background in fixed-size batched commits.
+
+    The group is flagged as deleting (and so hidden) before the request
+    returns. The job then removes it from members' group lists and deletes
+    their read markers for it, commits any of its messages still waiting in
+    the MessageWriter, deletes its messages, their search index rows and its
+    add requests batch by batch, and finally drops the group document. Progress is recorded in
+    group_deletions/{group_id} after every batch, so an interrupted job picks
+    up where it stopped.
+
+    A worker runs a job only while it holds the job's lease, renewed with
+    every progress update. Unfinished jobs whose lease has expired (their
+    worker stopped) are claimed, one worker each, at startup and then every
+    lease period.
+    """
+
+    def __init__(self, repo: FirestoreRepository, writer: MessageWriter, search_index: MessageSearchIndex,
+                 batch_size: int = GROUP_DELETE_BATCH_SIZE, lease: float = GROUP_DELETE_LEASE):
+        self.repo = repo
+        self.writer = writer
+        self.search_index = search_index
+        self.batch_size = batch_size
+        self.lease = lease
+        self.worker_id = uuid.uuid4().hex
+        self._tasks: Set[asyncio.Task] = set()
+        self._running: Set[str] = set()
+        self._resume_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Resumes jobs left unfinished by a previous run, then keeps picking up abandoned ones."""
+        await self._resume_unfinished()
+        self._resume_task = asyncio.create_task(self._resume_loop())
+
+    async def stop(self):
+        if self._resume_task:
+            self._resume_task.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _lease_until(self, now: datetime) -> datetime:
+        return now + timedelta(seconds=self.lease)
+
+    async def _resume_unfinished(self):
+        for job in await self.repo.list_unfinished_group_deletions():
+            if job["group_id"] in self._running:
+                continue
+            now = datetime.now(timezone.utc)
+            claimed = await self.repo.claim_group_deletion(job["group_id"], self.worker_id, self._lease_until(now), now)
+            if claimed is not None:
+                print(f"🗑️ Resuming deletion of group {job['group_id']} at phase {claimed['phase']}")
+                self._spawn(claimed)
+
+    async def _resume_loop(self):
+        while True:
+            await asyncio.sleep(self.lease)
+            try:
+                await self._resume_unfinished()
+            except Exception as e:
+                print(f"❌ Failed to resume group deletions: {e}")
+
+    async def enqueue(self, group_id: str, members: List[str], requested_by: str) -> Dict[str, Any]:
+        """Hides the group right away and starts deleting it; returns the job record."""
+        now = datetime.now(timezone.utc)
+        job = {
+            "group_id": group_id,
+            "requested_by": requested_by,
+            "members": list(members),
+            "status": "running",
+            "phase": PHASES[0],
+            "deleted_messages": 0,
+            "deleted_add_requests": 0,
+            "started_at": now,
+            "updated_at": now,
+            "lease_owner": self.worker_id,
+            "lease_until": self._lease_until(now)
+        }
+        await self.repo.start_group_deletion(group_id, job)
+        self._spawn(job)
+        return job
+
+    def _spawn(self, job: Dict[str, Any]):
+        if job["group_id"] in self._running:
+            return
+        self._running.add(job["group_id"])
+        task = asyncio.create_task(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _progress(self, job: Dict[str, Any], **fields):
+        now = datetime.now(timezone.utc)
+        job.update(fields, updated_at=now, lease_until=self._lease_until(now))
+        await self.repo.update_group_deletion(job["group_id"], {**fields, "updated_at": now, "lease_until": job["lease_until"]})
+
+    async def _delete_in_batches(self, job: Dict[str, Any], delete_batch, counter: str):
+        while True:
+            deleted = await delete_batch(job["group_id"], self.batch_size)
+            if not deleted:
+                return
+            await self._progress(job, **{counter: job.get(counter, 0) + deleted})
+
+    async def _run(self, job: Dict[str, Any]):
+        group_id = job["group_id"]
+        try:
+            for phase in PHASES[PHASES.index(job["phase"]):]:
+                if phase != job["phase"]:
+                    await self._progress(job, phase=phase)
+
+                if phase == "members":
+                    await self.repo.remove_group_from_users(group_id, job.get("members", []), self.batch_size)
+                elif phase == "read_markers":
+                    await self.repo.delete_read_markers(group_conversation_id(group_id), job.get("members", []), self.batch_size)
+                elif phase == "messages":
+                    # Messages accepted before the group was hidden may still be queued; commit them so they get deleted too
+                    await self.writer.flush()
+                    await self._delete_in_batches(job, self.repo.delete_group_messages_batch, "deleted_messages")
+                elif phase == "search_index":
+                    await asyncio.wrap_future(self.search_index.remove_conversation(group_conversation_id(group_id)))
+                elif phase == "add_requests":
+                    await self._delete_in_batches(job, self.repo.delete_add_requests_batch, "deleted_add_requests")
+                else:
+                    await self.repo.delete_group(group_id)
+
+            await self._progress(job, status="done", finished_at=datetime.now(timezone.utc))
+            print(f"🗑️ Group {group_id} deleted ({job['deleted_messages']} messages)")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Left as "running": retried from the recorded phase on the next start
+            print(f"❌ Group deletion {group_id} failed at phase {job['phase']}: {e}")
+        finally:
+            self._running.discard(group_id)
@@ -0,0 +1,111 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from repository import BatchWrite, FirestoreRepository
+import asyncio
+import os
+
+# Firestore allows 500 writes per batch; keep headroom
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "400"))
+# How long the first pending write waits for others to join its batch (seconds)
+WRITE_FLUSH_DELAY = float(os.getenv("WRITE_FLUSH_DELAY_MS", "5")) / 1000
+
+# (document ID, every write for that message, future resolved once they are committed)
+PendingWrite = Tuple[str, List[BatchWrite], asyncio.Future]
+
+
+class MessageWriter:
+    """Write-behind persistence for chat messages.
+
+    write_with_id() queues a message under an ID chosen by the caller and
+    returns at once, so fan-out does not wait on Firestore. Pending writes are grouped into batched
+    commits, flushed when WRITE_BATCH_SIZE writes are waiting or
+    WRITE_FLUSH_DELAY has passed. Each write's future resolves to its
+    document ID once the commit is durable, or raises if the commit failed.
+    Related writes (e.g. conversation summaries) ride in the same commit as
+    their message.
+    """
+
+    def __init__(self, repo: FirestoreRepository, batch_size: int = WRITE_BATCH_SIZE, delay: float = WRITE_FLUSH_DELAY):
+        self.repo = repo
+        self.batch_size = batch_size
+        self.delay = delay
+        self._pending: List[PendingWrite] = []
+        self._pending_writes = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Futures of the batch being committed right now
+        self._committing: List[asyncio.Future] = []
+
+    def __len__(self) -> int:
+        """Writes waiting to be committed."""
+        return self._pending_writes
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the flusher and commits whatever is still pending."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        while self._pending:
+            await self._commit(self._take_batch())
+
+    async def flush(self):
+        """Waits until every write queued so far has been committed (or has failed)."""
+        waiting = self._committing + [durable for _, _, durable in self._pending]
+        if waiting:
+            self._wakeup.set()
+            await asyncio.gather(*waiting, return_exceptions=True)
+
+    def write_with_id(self, collection: str, doc_id: str, data: Dict[str, Any],
+                      related: Iterable[BatchWrite] = ()) -> asyncio.Future:
+        """Queues a document (plus related writes); returns a future that resolves to doc_id once it is durable."""
+        durable = asyncio.get_running_loop().create_future()
+        self._pending.append((doc_id, [(collection, doc_id, data, False), *related], durable))
+        self._pending_writes += len(self._pending[-1][1])
+        self._wakeup.set()
+        return durable
+
+    def _take_batch(self) -> List[PendingWrite]:
+        """Pops pending messages whose writes fit in one commit (always at least one)."""
+        count = 0
+        taken = 0
+        for _, writes, _ in self._pending:
+            if taken and count + len(writes) > self.batch_size:
+                break
+            count += len(writes)
+            taken += 1
+        batch, self._pending = self._pending[:taken], self._pending[taken:]
+        self._pending_writes -= count
+        return batch
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            if self._pending_writes < self.batch_size:
+                # Give concurrent writes a moment to join this batch
+                await asyncio.sleep(self.delay)
+
+            self._wakeup.clear()
+            batch = self._take_batch()
+            if self._pending:
+                self._wakeup.set()
+            await self._commit(batch)
+
+    async def _commit(self, batch: List[PendingWrite]):
+        self._committing = [durable for _, _, durable in batch]
+        try:
+            await self.repo.commit_batch([write for _, writes, _ in batch for write in writes])
+        except Exception as e:
+            print(f"❌ Failed to commit {len(batch)} messages: {e}")
+            for _, _, durable in batch:
+                if not durable.done():
+                    durable.set_exception(e)
+            return
+
+        for doc_id, _, durable in batch:
+            if not durable.done():
+                durable.set_result(doc_id)
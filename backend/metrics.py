@@ -0,0 +1,215 @@
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import math
+
+# Prometheus text exposition format served by /metrics
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Base for metrics rendered by Registry.render().
+
+    Metrics are only updated from the event loop thread, so plain dicts and
+    ints are enough; nothing here takes a lock.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[LabelValues, float] = {}
+        if not labels:
+            # Report 0 rather than nothing before the first increment
+            self._values[()] = 0
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                for key, value in sorted(self._values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Iterable[float], labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> (per-bucket counts, sum)
+        self._series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+        if not labels:
+            self._series[()] = ([0] * len(self.buckets), [0.0])
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = ([0] * len(self.buckets), [0.0])
+        counts, total = series
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        total[0] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Callback(Metric):
+    """A gauge or counter whose value is read from the owning object at scrape time.
+
+    With labels, read() returns {label values: value} instead of a single number.
+    """
+
+    def __init__(self, name: str, help_text: str, read: Callable[[], Any], kind: str = "gauge",
+                 labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self.kind = kind
+        self._read = read
+
+    def samples(self) -> List[str]:
+        if not self.labels:
+            return [f"{self.name} {_format_value(self._read())}"]
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                for key, value in sorted(self._read().items())]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, buckets: Iterable[float], labels: Tuple[str, ...] = ()) -> Histogram:
+        return self.register(Histogram(name, help_text, buckets, labels))
+
+    def callback(self, name: str, help_text: str, read: Callable[[], Any], kind: str = "gauge",
+                 labels: Tuple[str, ...] = ()) -> Callback:
+        return self.register(Callback(name, help_text, read, kind, labels))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+FIRESTORE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FANOUT_SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# 🔹 Realtime layer
+FRAMES_IN = REGISTRY.counter("chat_ws_frames_in_total", "WebSocket frames received from clients.", ("type",))
+FRAMES_OUT = REGISTRY.counter("chat_ws_frames_out_total", "WebSocket frames queued to client sockets.", ("type",))
+FRAMES_DROPPED = REGISTRY.counter("chat_ws_frames_dropped_total", "Frames dropped because a socket's send queue was full.")
+SEND_FAILURES = REGISTRY.counter("chat_ws_send_failures_total", "Sockets dropped after a failed send.")
+SLOW_CONSUMERS = REGISTRY.counter("chat_ws_slow_consumers_total", "Sockets dropped for not keeping up.")
+IDLE_REAPED = REGISTRY.counter("chat_ws_idle_reaped_total", "Sockets closed for not answering heartbeats.")
+FANOUT_SIZE = REGISTRY.histogram("chat_fanout_sockets", "Local sockets each published frame was queued for.",
+                                 FANOUT_SIZE_BUCKETS)
+FANOUT_LATENCY = REGISTRY.histogram("chat_fanout_seconds", "Time to encode a frame and hand it to every recipient (or the bus).",
+                                    LATENCY_BUCKETS)
+
+# 🔹 Firestore (labelled with the endpoint function whose request made the call)
+FIRESTORE_LATENCY = REGISTRY.histogram("chat_firestore_call_seconds", "Firestore call latency, including thread pool wait.",
+                                       FIRESTORE_BUCKETS, ("endpoint",))
+
+# 🔹 Uploads and search
+UPLOADS = REGISTRY.counter("chat_uploads_total", "Files received by /upload.", ("result",))
+UPLOAD_BYTES = REGISTRY.counter("chat_upload_bytes_total", "Bytes received by /upload.")
+SEARCHES = REGISTRY.counter("chat_searches_total", "Search requests.", ("kind", "source"))
+
+# The ASGI scope of the request (or WebSocket) being handled in this context
+current_scope: ContextVar[Optional[dict]] = ContextVar("current_scope", default=None)
+
+
+def current_endpoint() -> str:
+    """Name of the endpoint function handling the current request, or "background"."""
+    scope = current_scope.get()
+    if scope is None:
+        return "background"
+    endpoint = scope.get("endpoint")
+    return getattr(endpoint, "__name__", "unrouted")
+
+
+class RequestScopeMiddleware:
+    """Makes the current request's scope visible to current_endpoint() (HTTP and WebSocket)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        token = current_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_scope.reset(token)
+
+
+def frame_type(frame: str) -> str:
+    """Reads the type of an encoded frame (every frame the server builds starts with its "type")."""
+    if frame.startswith('{"type":"'):
+        return frame[9:frame.find('"', 9)]
+    return "other"
@@ -0,0 +1,120 @@
+from collections import deque
+from fastapi import WebSocket
+from typing import Callable, Deque, Optional, Tuple
+from metrics import FRAMES_DROPPED, SEND_FAILURES, SLOW_CONSUMERS
+import asyncio
+import os
+import time
+
+# Queue limits per connection (frames); low-priority frames stop being queued well before chat frames
+SEND_QUEUE_HIGH_WATER = int(os.getenv("SEND_QUEUE_HIGH_WATER", "256"))
+SEND_QUEUE_MAX = int(os.getenv("SEND_QUEUE_MAX", "1024"))
+SEND_QUEUE_LOW_PRIORITY_LIMIT = int(os.getenv("SEND_QUEUE_LOW_PRIORITY_LIMIT", "32"))
+# How long a connection may stay above the high-water mark before it is dropped (seconds)
+SLOW_CONSUMER_GRACE = float(os.getenv("SLOW_CONSUMER_GRACE", "10"))
+
+
+class Outbox:
+    """Bounded outbound queue with its own writer task for one WebSocket.
+
+    Fan-out only appends to the queue, so a slow client never holds up
+    delivery to anyone else. Low-priority frames (typing, presence) are the
+    first to be dropped under pressure. A connection that stays above the
+    high-water mark for longer than the grace period, or reaches the hard
+    maximum, is reported through on_failure(outbox, slow=True).
+    """
+
+    def __init__(self, websocket: WebSocket, uid: str, on_failure: Callable[["Outbox", bool], None],
+                 high_water: int = SEND_QUEUE_HIGH_WATER, max_size: int = SEND_QUEUE_MAX,
+                 low_priority_limit: int = SEND_QUEUE_LOW_PRIORITY_LIMIT, grace: float = SLOW_CONSUMER_GRACE):
+        self.websocket = websocket
+        self.uid = uid
+        self.high_water = high_water
+        self.max_size = max_size
+        self.low_priority_limit = low_priority_limit
+        self.grace = grace
+        self.dropped = 0
+        self.closed = False
+        self._on_failure = on_failure
+        self._queue: Deque[Tuple[str, bool]] = deque()
+        self._low_priority_queued = 0
+        self._over_limit_since: Optional[float] = None
+        self._wakeup = asyncio.Event()
+        self._writer = asyncio.create_task(self._run())
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def enqueue(self, frame: str, low_priority: bool = False) -> bool:
+        """Queues an encoded frame; returns False if it was dropped."""
+        if self.closed:
+            return False
+
+        size = len(self._queue)
+        if low_priority and size >= self.low_priority_limit:
+            self.dropped += 1
+            FRAMES_DROPPED.inc()
+            return False
+
+        if size >= self.high_water:
+            if self._low_priority_queued:
+                self._drop_oldest_low_priority()
+            now = time.monotonic()
+            if self._over_limit_since is None:
+                self._over_limit_since = now
+            if size >= self.max_size or now - self._over_limit_since > self.grace:
+                self.dropped += 1
+                FRAMES_DROPPED.inc()
+                SLOW_CONSUMERS.inc()
+                self._fail(slow=True)
+                return False
+
+        self._queue.append((frame, low_priority))
+        if low_priority:
+            self._low_priority_queued += 1
+        self._wakeup.set()
+        return True
+
+    def _drop_oldest_low_priority(self):
+        for index, (_, low_priority) in enumerate(self._queue):
+            if low_priority:
+                del self._queue[index]
+                self._low_priority_queued -= 1
+                self.dropped += 1
+                FRAMES_DROPPED.inc()
+                return
+
+    async def _run(self):
+        try:
+            while True:
+                if not self._queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+
+                frame, low_priority = self._queue.popleft()
+                if low_priority:
+                    self._low_priority_queued -= 1
+                await self.websocket.send_text(frame)
+
+                if self._over_limit_since is not None and len(self._queue) < self.high_water:
+                    self._over_limit_since = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Error sending frame to {self.uid}: {e}")
+            SEND_FAILURES.inc()
+            self._fail(slow=False)
+
+    def _fail(self, slow: bool):
+        if not self.closed:
+            self.close()
+            self._on_failure(self, slow)
+
+    def close(self):
+        """Stops the writer task and discards anything still queued."""
+        self.closed = True
+        self._queue.clear()
+        self._low_priority_queued = 0
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
@@ -0,0 +1,259 @@
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set
+from cache import LRUCache
+from fanout import RedisBus
+from repository import FirestoreRepository
+from websocket_manager import WebSocketManager
+import asyncio
+import os
+
+# A user is announced offline only after staying disconnected this long, so reconnects don't flap (seconds)
+PRESENCE_OFFLINE_GRACE = float(os.getenv("PRESENCE_OFFLINE_GRACE", "15"))
+# Last-seen times remembered in memory (older ones are read from users/{uid}.last_seen)
+PRESENCE_LAST_SEEN_CACHE_SIZE = int(os.getenv("PRESENCE_LAST_SEEN_CACHE_SIZE", "50000"))
+# How long last-seen times are kept in Redis before being read from Firestore again (seconds)
+PRESENCE_LAST_SEEN_TTL = int(os.getenv("PRESENCE_LAST_SEEN_TTL", str(7 * 24 * 3600)))
+
+# Stored for users known to have no last_seen, so they are not read from Firestore again
+_NEVER_SEEN = ""
+
+
+class PresenceStore:
+    """Presence state shared by the workers: who is in their offline grace period, and last-seen times.
+
+    get_last_seen() returns only the users it knows about, with None for
+    users known never to have been seen.
+    """
+
+    def __init__(self, manager: WebSocketManager):
+        self.manager = manager
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def begin_leaving(self, uid: str):
+        raise NotImplementedError
+
+    async def cancel_leaving(self, uid: str) -> bool:
+        """Ends a grace period because the user came back; True if one was running."""
+        raise NotImplementedError
+
+    async def finish_leaving(self, uid: str) -> bool:
+        """Ends a grace period that ran out; True if the user is still away."""
+        raise NotImplementedError
+
+    async def online(self, uids: Iterable[str]) -> Set[str]:
+        """Of uids, the users connected somewhere or still within their grace period."""
+        raise NotImplementedError
+
+    async def get_last_seen(self, uids: Iterable[str]) -> Dict[str, Optional[datetime]]:
+        raise NotImplementedError
+
+    async def set_last_seen(self, values: Dict[str, Optional[datetime]]):
+        raise NotImplementedError
+
+
+class LocalPresenceStore(PresenceStore):
+    def __init__(self, manager: WebSocketManager):
+        super().__init__(manager)
+        self.leaving: Set[str] = set()
+        self.last_seen = LRUCache(max_size=PRESENCE_LAST_SEEN_CACHE_SIZE)
+
+    async def begin_leaving(self, uid: str):
+        self.leaving.add(uid)
+
+    async def cancel_leaving(self, uid: str) -> bool:
+        if uid in self.leaving:
+            self.leaving.discard(uid)
+            return True
+        return False
+
+    async def finish_leaving(self, uid: str) -> bool:
+        return await self.cancel_leaving(uid)
+
+    async def online(self, uids: Iterable[str]) -> Set[str]:
+        return {uid for uid in uids if uid in self.manager.active_connections or uid in self.leaving}
+
+    async def get_last_seen(self, uids: Iterable[str]) -> Dict[str, Optional[datetime]]:
+        known = {}
+        for uid in uids:
+            value = self.last_seen.get(uid)
+            if value is not None:
+                known[uid] = None if value == _NEVER_SEEN else value
+        return known
+
+    async def set_last_seen(self, values: Dict[str, Optional[datetime]]):
+        for uid, value in values.items():
+            self.last_seen.set(uid, _NEVER_SEEN if value is None else value)
+
+
+class RedisPresenceStore(PresenceStore):
+    """Presence in Redis: presence:leaving:<uid> marks a grace period, presence:last_seen:<uid> holds an ISO time."""
+
+    def __init__(self, manager: WebSocketManager, url: str, grace: float):
+        super().__init__(manager)
+        self.url = url
+        self.grace = grace
+        self._redis = None
+
+    async def start(self):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("❌ FANOUT_BACKEND=redis requires the 'redis' package (pip install redis)")
+        self._redis = redis.from_url(self.url)
+
+    async def stop(self):
+        if self._redis:
+            await self._redis.aclose()
+
+    async def begin_leaving(self, uid: str):
+        # Outlives the grace period so the worker whose timer fires still finds it
+        await self._redis.set(f"presence:leaving:{uid}", 1, px=int(self.grace * 2000) + 1000)
+
+    async def cancel_leaving(self, uid: str) -> bool:
+        return bool(await self._redis.delete(f"presence:leaving:{uid}"))
+
+    async def finish_leaving(self, uid: str) -> bool:
+        return await self._redis.getdel(f"presence:leaving:{uid}") is not None
+
+    async def online(self, uids: Iterable[str]) -> Set[str]:
+        uids = list(uids)
+        if not uids:
+            return set()
+        connected = await self.manager.registry.connected(uids)
+        rest = [uid for uid in uids if uid not in connected]
+        if not rest:
+            return connected
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for uid in rest:
+                pipe.exists(f"presence:leaving:{uid}")
+            leaving = await pipe.execute()
+        return connected | {uid for uid, exists in zip(rest, leaving) if exists}
+
+    async def get_last_seen(self, uids: Iterable[str]) -> Dict[str, Optional[datetime]]:
+        uids = list(uids)
+        if not uids:
+            return {}
+        values = await self._redis.mget([f"presence:last_seen:{uid}" for uid in uids])
+        known = {}
+        for uid, value in zip(uids, values):
+            if value is not None:
+                value = value.decode()
+                known[uid] = datetime.fromisoformat(value) if value != _NEVER_SEEN else None
+        return known
+
+    async def set_last_seen(self, values: Dict[str, Optional[datetime]]):
+        if not values:
+            return
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for uid, value in values.items():
+                pipe.set(f"presence:last_seen:{uid}", _NEVER_SEEN if value is None else value.isoformat(),
+                         ex=PRESENCE_LAST_SEEN_TTL)
+            await pipe.execute()
+
+
+class PresenceTracker:
+    """Online/last-seen presence, pushed to a user's contacts only.
+
+    The WebSocketManager reports when a user's first socket opens and last
+    socket closes, across all workers. Coming online is announced right
+    away; going offline is announced (and last_seen stored) only once the
+    user has stayed away for the grace period, so a dropped connection that
+    comes straight back, on any worker, is never seen by contacts.
+
+    Grace periods and last-seen times live in the PresenceStore, in Redis
+    whenever fan-out goes through it.
+    """
+
+    def __init__(self, manager: WebSocketManager, repo: FirestoreRepository, grace: float = PRESENCE_OFFLINE_GRACE):
+        self.manager = manager
+        self.repo = repo
+        self.grace = grace
+        if isinstance(manager.bus, RedisBus):
+            self.store: PresenceStore = RedisPresenceStore(manager, manager.bus.url, grace)
+        else:
+            self.store = LocalPresenceStore(manager)
+        self._going_offline: Dict[str, asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        manager.set_presence_handler(self._on_change)
+
+    async def start(self):
+        await self.store.start()
+
+    async def stop(self):
+        for timer in self._going_offline.values():
+            timer.cancel()
+        self._going_offline.clear()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.store.stop()
+
+    def _on_change(self, uid: str, online: bool):
+        if online:
+            timer = self._going_offline.pop(uid, None)
+            if timer is not None:
+                timer.cancel()
+            self._spawn(self._came_online(uid))
+        elif uid not in self._going_offline:
+            loop = asyncio.get_running_loop()
+            self._going_offline[uid] = loop.call_later(self.grace, self._went_offline, uid)
+            self._spawn(self.store.begin_leaving(uid))
+
+    async def _came_online(self, uid: str):
+        if await self.store.cancel_leaving(uid):
+            # Back within the grace period: contacts never saw them leave
+            return
+        await self._announce(uid, True, None)
+
+    def _went_offline(self, uid: str):
+        self._going_offline.pop(uid, None)
+        self._spawn(self._left(uid))
+
+    async def _left(self, uid: str):
+        if not await self.store.finish_leaving(uid):
+            # Came back (possibly on another worker) during the grace period
+            return
+        last_seen = datetime.now(timezone.utc)
+        await self.store.set_last_seen({uid: last_seen})
+        await self._announce(uid, False, last_seen)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _announce(self, uid: str, online: bool, last_seen: Optional[datetime]):
+        try:
+            if last_seen is not None:
+                await self.repo.update_user(uid, {"last_seen": last_seen})
+            user_data = await self.repo.get_user(uid)
+            if user_data is None:
+                return
+            # Contacts are mutual, so the user's own list is everyone allowed to see them; the bus
+            # only delivers to the ones connected somewhere
+            contacts: List[str] = user_data.get("contacts", [])
+            if contacts:
+                await self.manager.send_presence(contacts, uid, online, last_seen)
+        except Exception as e:
+            print(f"❌ Presence update for {uid} failed: {e}")
+
+    async def snapshot(self, uids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Returns {uid: {"online": bool, "last_seen": datetime or None}}.
+
+        Last-seen times not in the store are read from Firestore once and
+        remembered, including for users who have never been seen.
+        """
+        uids = list(uids)
+        if not uids:
+            return {}
+        online, last_seen = await asyncio.gather(self.store.online(uids), self.store.get_last_seen(uids))
+        unknown = [uid for uid in uids if uid not in online and uid not in last_seen]
+        if unknown:
+            fetched = {uid: (user_data or {}).get("last_seen")
+                       for uid, user_data in zip(unknown, await self.repo.get_users(unknown))}
+            await self.store.set_last_seen(fetched)
+            last_seen.update(fetched)
+        return {uid: {"online": uid in online, "last_seen": last_seen.get(uid)} for uid in uids}
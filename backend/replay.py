@@ -0,0 +1,138 @@
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+from fanout import FANOUT_BACKEND, REDIS_URL
+import asyncio
+import os
+
+# Recent message frames kept per conversation for resuming sessions, and how many conversations are kept
+REPLAY_BUFFER_SIZE = int(os.getenv("REPLAY_BUFFER_SIZE", "256"))
+REPLAY_MAX_CONVERSATIONS = int(os.getenv("REPLAY_MAX_CONVERSATIONS", "10000"))
+
+# Returns the last sequence number persisted for a conversation (0 if none)
+LoadLastSeq = Callable[[str], Awaitable[int]]
+
+
+class ReplayBuffer:
+    """Bounded ring buffer of recent outbound message frames per conversation.
+
+    Conversations are evicted least recently written first. since() tells a
+    resuming client what it missed, or returns None when the buffer no longer
+    reaches back far enough and the store has to be asked instead.
+    """
+
+    def __init__(self, size: int = REPLAY_BUFFER_SIZE, max_conversations: int = REPLAY_MAX_CONVERSATIONS):
+        self.size = size
+        self.max_conversations = max_conversations
+        self._frames: "OrderedDict[str, Deque[Tuple[int, dict]]]" = OrderedDict()
+
+    def record(self, conversation_id: str, seq: int, frame: dict):
+        frames = self._frames.get(conversation_id)
+        if frames is None:
+            frames = self._frames[conversation_id] = deque(maxlen=self.size)
+            if len(self._frames) > self.max_conversations:
+                self._frames.popitem(last=False)
+        else:
+            self._frames.move_to_end(conversation_id)
+        frames.append((seq, frame))
+
+    def since(self, conversation_id: str, after_seq: int) -> Optional[List[dict]]:
+        """Frames with seq > after_seq, in order; None if some of them may be missing from the buffer."""
+        frames = self._frames.get(conversation_id)
+        if not frames or frames[0][0] > after_seq + 1:
+            return None
+        missed = []
+        expected = after_seq + 1
+        for seq, frame in frames:
+            if seq < expected:
+                continue
+            # A hole means a frame was sequenced elsewhere (another worker); only the store has it
+            if seq != expected:
+                return None
+            missed.append(frame)
+            expected += 1
+        return missed
+
+
+class Sequencer:
+    """Hands out per-conversation sequence numbers for outbound message frames."""
+
+    def __init__(self, load_last: LoadLastSeq):
+        self._load_last = load_last
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def next(self, conversation_id: str) -> int:
+        raise NotImplementedError
+
+    async def current(self, conversation_id: str) -> int:
+        """The last number handed out for a conversation."""
+        raise NotImplementedError
+
+
+class LocalSequencer(Sequencer):
+    """In-process counters, seeded from the store the first time a conversation is seen."""
+
+    def __init__(self, load_last: LoadLastSeq):
+        super().__init__(load_last)
+        self._last: Dict[str, int] = {}
+        self._loading: Dict[str, asyncio.Future] = {}
+
+    async def current(self, conversation_id: str) -> int:
+        if conversation_id not in self._last:
+            # Concurrent first calls share one store read
+            loading = self._loading.get(conversation_id)
+            if loading is None:
+                loading = self._loading[conversation_id] = asyncio.ensure_future(self._load_last(conversation_id))
+                loading.add_done_callback(lambda _: self._loading.pop(conversation_id, None))
+            self._last.setdefault(conversation_id, await loading)
+        return self._last[conversation_id]
+
+    async def next(self, conversation_id: str) -> int:
+        self._last[conversation_id] = await self.current(conversation_id) + 1
+        return self._last[conversation_id]
+
+
+class RedisSequencer(Sequencer):
+    """Counters shared by every worker (INCR on seq:<conversation_id>), seeded from the store once."""
+
+    def __init__(self, load_last: LoadLastSeq, url: str = REDIS_URL):
+        super().__init__(load_last)
+        self.url = url
+        self._redis = None
+        self._seeded = set()
+
+    async def start(self):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("❌ FANOUT_BACKEND=redis requires the 'redis' package (pip install redis)")
+        self._redis = redis.from_url(self.url)
+
+    async def stop(self):
+        if self._redis:
+            await self._redis.aclose()
+
+    async def _seed(self, conversation_id: str) -> str:
+        key = f"seq:{conversation_id}"
+        if conversation_id not in self._seeded:
+            # No-op if another worker (or an earlier run) already seeded it
+            await self._redis.set(key, await self._load_last(conversation_id), nx=True)
+            self._seeded.add(conversation_id)
+        return key
+
+    async def next(self, conversation_id: str) -> int:
+        return await self._redis.incr(await self._seed(conversation_id))
+
+    async def current(self, conversation_id: str) -> int:
+        return int(await self._redis.get(await self._seed(conversation_id)) or 0)
+
+
+def create_sequencer(load_last: LoadLastSeq, backend: str = FANOUT_BACKEND) -> Sequencer:
+    """Shares counters through Redis whenever fan-out does, so workers never hand out the same number."""
+    if backend == "redis":
+        return RedisSequencer(load_last)
+    return LocalSequencer(load_last)
@@ -0,0 +1,844 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists
+from cache import LRUCache
+from metrics import FIRESTORE_LATENCY, current_endpoint
+import asyncio
+import base64
+import functools
+import hashlib
+import json
+import os
+import time
+
+# Upper bound on concurrent Firestore round trips per worker process
+FIRESTORE_MAX_WORKERS = int(os.getenv("FIRESTORE_MAX_WORKERS", "16"))
+
+# Read-through cache of public user profiles
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "50000"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "300"))
+PROFILE_FIELDS = ("name", "username", "profile_picture_url")
+
+# Group member lists used by the WebSocket paths; writes through this repository keep it current
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "20000"))
+MEMBERSHIP_CACHE_TTL = float(os.getenv("MEMBERSHIP_CACHE_TTL", "600"))
+
+# Documents fetched per batched multi-get round trip
+GET_ALL_CHUNK_SIZE = 100
+
+# Firestore's limit on writes in one batched commit
+BATCH_WRITE_LIMIT = 500
+
+# (collection, doc_id, data, merge) for commit_batch
+BatchWrite = Tuple[str, str, Dict[str, Any], bool]
+
+
+def direct_conversation_id(uid_a: str, uid_b: str) -> str:
+    """Returns the order-independent conversation key for a direct chat."""
+    first, second = sorted((uid_a, uid_b))
+    return f"dm:{first}:{second}"
+
+
+def group_conversation_id(group_id: str) -> str:
+    return f"group:{group_id}"
+
+
+def client_message_id(sender_uid: str, client_id: str) -> str:
+    """Document ID for a message its sender tagged with client_id (the same on every resend)."""
+    return hashlib.sha256(f"{sender_uid}:{client_id}".encode()).hexdigest()[:20]
+
+
+def parse_conversation_id(conversation_id: str) -> Tuple[str, List[str]]:
+    """Splits a conversation key into its kind ("dm" or "group") and IDs."""
+    kind, _, rest = conversation_id.partition(":")
+    parts = rest.split(":") if rest else []
+    if kind == "dm" and len(parts) == 2 and all(parts):
+        return kind, parts
+    if kind == "group" and len(parts) == 1 and parts[0]:
+        return kind, parts
+    raise ValueError(f"Invalid conversation id: {conversation_id}")
+
+
+class ChunkedBatch:
+    """A write batch that commits every BATCH_WRITE_LIMIT writes, so fan-outs over large groups stay under
+    Firestore's limit.
+
+    Writes commit in the order they were queued, so the ones queued first
+    (e.g. the group document) are in the first commit. Up to the limit
+    everything goes in one atomic commit; beyond it each commit is atomic on
+    its own, and a failure leaves the earlier ones in place.
+    """
+
+    def __init__(self, db, limit: int = BATCH_WRITE_LIMIT):
+        self.db = db
+        self.limit = limit
+        self._batch = db.batch()
+        self._count = 0
+
+    def _next(self):
+        if self._count >= self.limit:
+            self._batch.commit()
+            self._batch = self.db.batch()
+            self._count = 0
+        self._count += 1
+        return self._batch
+
+    def set(self, reference, data: Dict[str, Any], merge: bool = False):
+        self._next().set(reference, data, merge=merge)
+
+    def update(self, reference, data: Dict[str, Any]):
+        self._next().update(reference, data)
+
+    def delete(self, reference):
+        self._next().delete(reference)
+
+    def commit(self):
+        if self._count:
+            self._batch.commit()
+
+
+def encode_cursor(message: Dict[str, Any]) -> str:
+    """Builds an opaque page cursor from a message's timestamp and document ID."""
+    timestamp = message.get("timestamp")
+    payload = {"t": timestamp.isoformat() if timestamp else None, "id": message["id"]}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    """Turns an opaque cursor back into Firestore start_after field values."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        timestamp = datetime.fromisoformat(payload["t"]) if payload["t"] else None
+        return {"timestamp": timestamp, "__name__": payload["id"]}
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+class FirestoreRepository:
+    """Async data-access layer for every Firestore collection used by the server.
+
+    The Firestore client is synchronous, so each method runs its whole
+    read/write sequence on a bounded thread pool. A slow round trip then only
+    occupies a pool thread instead of freezing the event loop for every socket.
+    """
+
+    def __init__(self, db, max_workers: int = FIRESTORE_MAX_WORKERS):
+        self.db = db
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="firestore")
+        self.profile_cache = LRUCache(max_size=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+        self.membership_cache = LRUCache(max_size=MEMBERSHIP_CACHE_SIZE, ttl=MEMBERSHIP_CACHE_TTL)
+        # Called with (cache name, key) after a write changes a cached entry, so other workers can drop theirs
+        self.on_cache_change: Optional[Callable[[str, str], None]] = None
+
+    async def _run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Runs a blocking Firestore call on the repository thread pool (timed per endpoint)."""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        finally:
+            FIRESTORE_LATENCY.observe(time.perf_counter() - started, endpoint=current_endpoint())
+
+    @staticmethod
+    def _to_dict(snapshot) -> Optional[Dict[str, Any]]:
+        return snapshot.to_dict() if snapshot.exists else None
+
+    async def _get_all(self, collection: str, doc_ids: Iterable[str]) -> List[Optional[Dict[str, Any]]]:
+        """Fetches many documents with batched multi-gets.
+
+        IDs are de-duplicated and split into GET_ALL_CHUNK_SIZE chunks that run
+        concurrently. The result lines up with doc_ids, with None for
+        documents that do not exist.
+        """
+        doc_ids = list(doc_ids)
+        unique_ids = list(dict.fromkeys(doc_ids))
+        if not unique_ids:
+            return []
+
+        def _fetch(chunk):
+            refs = [self.db.collection(collection).document(doc_id) for doc_id in chunk]
+            return {snapshot.id: snapshot.to_dict() for snapshot in self.db.get_all(refs) if snapshot.exists}
+
+        chunks = [unique_ids[i:i + GET_ALL_CHUNK_SIZE] for i in range(0, len(unique_ids), GET_ALL_CHUNK_SIZE)]
+        found: Dict[str, Dict[str, Any]] = {}
+        for chunk_result in await asyncio.gather(*(self._run(_fetch, chunk) for chunk in chunks)):
+            found.update(chunk_result)
+        return [found.get(doc_id) for doc_id in doc_ids]
+
+    # 🔹 Users
+    async def get_user(self, uid: str) -> Optional[Dict[str, Any]]:
+        """Returns the users/{uid} document, or None if it does not exist."""
+        return await self._run(lambda: self._to_dict(self.db.collection("users").document(uid).get()))
+
+    async def get_users(self, uids: Iterable[str]) -> List[Optional[Dict[str, Any]]]:
+        """Returns users/{uid} documents in the order given, None for missing ones."""
+        return await self._get_all("users", uids)
+
+    async def create_user(self, uid: str, data: Dict[str, Any]) -> None:
+        await self._run(lambda: self.db.collection("users").document(uid).set(data))
+        self.invalidate_profile(uid)
+
+    async def update_user(self, uid: str, fields: Dict[str, Any]) -> None:
+        await self._run(lambda: self.db.collection("users").document(uid).update(fields))
+        self.invalidate_profile(uid)
+
+    @staticmethod
+    def _profile(uid: str, user_data: Dict[str, Any]) -> Dict[str, Any]:
+        profile = {"uid": uid, **{field: user_data.get(field) for field in PROFILE_FIELDS}}
+        profile["username"] = profile["username"] or ""
+        return profile
+
+    async def get_user_profile(self, uid: str) -> Optional[Dict[str, Any]]:
+        """Returns a user's public profile (uid, name, username, profile_picture_url).
+
+        Reads through the profile cache; entries are dropped by every user
+        write made through this repository and otherwise expire after
+        PROFILE_CACHE_TTL seconds.
+        """
+        profile = self.profile_cache.get(uid)
+        if profile is None:
+            user_data = await self.get_user(uid)
+            if user_data is None:
+                return None
+            profile = self._profile(uid, user_data)
+            self.profile_cache.set(uid, profile)
+        return dict(profile)
+
+    async def get_user_profiles(self, uids: Iterable[str]) -> List[Optional[Dict[str, Any]]]:
+        """Returns public profiles in the order given, None for unknown users.
+
+        Cached profiles are served directly and all misses are fetched with a
+        single batched read.
+        """
+        uids = list(uids)
+        profiles = [self.profile_cache.get(uid) for uid in uids]
+        missing = list(dict.fromkeys(uid for uid, profile in zip(uids, profiles) if profile is None))
+        if missing:
+            fetched = {}
+            for uid, user_data in zip(missing, await self.get_users(missing)):
+                if user_data is not None:
+                    fetched[uid] = self._profile(uid, user_data)
+                    self.profile_cache.set(uid, fetched[uid])
+            profiles = [profile if profile is not None else fetched.get(uid) for uid, profile in zip(uids, profiles)]
+        return [dict(profile) if profile is not None else None for profile in profiles]
+
+    def invalidate_profile(self, uid: str):
+        """Drops a cached profile so the next lookup reads Firestore."""
+        self.profile_cache.invalidate(uid)
+        self._cache_changed("profile", uid)
+
+    def _cache_changed(self, cache: str, key: str):
+        if self.on_cache_change is not None:
+            self.on_cache_change(cache, key)
+
+    def drop_cached(self, cache: str, key: str):
+        """Drops an entry another worker changed ("profile" or "membership")."""
+        if cache == "profile":
+            self.profile_cache.invalidate(key)
+        elif cache == "membership":
+            self.membership_cache.invalidate(key)
+
+    async def username_taken(self, username: str) -> bool:
+        def _query():
+            return bool(self.db.collection("users").where("username", "==", username).limit(1).get())
+        return await self._run(_query)
+
+    async def search_users_by_username(self, prefix: str) -> List[Dict[str, Any]]:
+        """Returns user documents whose username starts with prefix."""
+        def _query():
+            query = self.db.collection("users").where("username", ">=", prefix).where("username", "<=", prefix + "\uf8ff")
+            return [doc.to_dict() for doc in query.stream()]
+        return await self._run(_query)
+
+    # 🔹 Contacts
+    async def create_contact_request(self, request_id: str, data: Dict[str, Any]) -> None:
+        await self._run(lambda: self.db.collection("contact_requests").document(request_id).set(data))
+
+    async def get_contact_request(self, request_id: str) -> Optional[Dict[str, Any]]:
+        return await self._run(lambda: self._to_dict(self.db.collection("contact_requests").document(request_id).get()))
+
+    async def update_contact_request(self, request_id: str, fields: Dict[str, Any]) -> None:
+        await self._run(lambda: self.db.collection("contact_requests").document(request_id).update(fields))
+
+    def _existing_user_ids(self, uids: Iterable[str]) -> List[str]:
+        """Of uids, the ones with a users document (one multi-get; run inside a _run call)."""
+        uids = list(dict.fromkeys(uids))
+        refs = [self.db.collection("users").document(uid) for uid in uids]
+        found = {snapshot.id for snapshot in self.db.get_all(refs) if snapshot.exists} if refs else set()
+        return [uid for uid in uids if uid in found]
+
+    def _set_array_field(self, batch, uids: Iterable[str], field: str, change) -> List[str]:
+        """Queues an ArrayUnion/ArrayRemove of one array field on each existing users/{uid} document; returns their UIDs."""
+        existing = self._existing_user_ids(uids)
+        for uid in existing:
+            batch.update(self.db.collection("users").document(uid), {field: change})
+        return existing
+
+    def _seed_read_markers(self, batch, conversation_id: str, uids: Iterable[str], read_count: Optional[int] = None) -> None:
+        """Queues read markers for users joining a conversation, at its current message count (run inside a _run call).
+
+        Without one, a new member's unread count would include every message
+        sent before they joined, and a new contact's chat would not be listed.
+        """
+        if read_count is None:
+            summary = self._to_dict(self.db.collection("conversation_summaries").document(conversation_id).get())
+            read_count = (summary or {}).get("message_count", 0)
+        for uid in uids:
+            batch.set(self.db.collection("users").document(uid).collection("conversations").document(conversation_id), {
+                "conversation_id": conversation_id,
+                "read_count": read_count
+            }, merge=True)
+
+    async def accept_contact_request(self, request_id: str, sender_uid: str, receiver_uid: str) -> None:
+        """Marks a contact request accepted and adds each user to the other's contacts, in one commit."""
+        def _accept():
+            batch = self.db.batch()
+            batch.update(self.db.collection("contact_requests").document(request_id), {"status": "accept"})
+            joined = self._set_array_field(batch, [receiver_uid], "contacts", firestore.ArrayUnion([sender_uid]))
+            joined += self._set_array_field(batch, [sender_uid], "contacts", firestore.ArrayUnion([receiver_uid]))
+            self._seed_read_markers(batch, direct_conversation_id(sender_uid, receiver_uid), joined)
+            batch.commit()
+        await self._run(_accept)
+
+    async def remove_contacts(self, uid: str, contact_uid: str) -> None:
+        """Removes two users from each other's contacts, in one commit."""
+        def _remove():
+            batch = self.db.batch()
+            self._set_array_field(batch, [uid], "contacts", firestore.ArrayRemove([contact_uid]))
+            self._set_array_field(batch, [contact_uid], "contacts", firestore.ArrayRemove([uid]))
+            batch.commit()
+        await self._run(_remove)
+
+    async def list_pending_contact_requests(self, uid: str) -> List[Dict[str, Any]]:
+        """Returns pending contact requests addressed to uid."""
+        def _query():
+            query = self.db.collection("contact_requests").where("receiver", "==", uid).where("status", "==", "pending")
+            return [doc.to_dict() for doc in query.stream()]
+        return await self._run(_query)
+
+    # 🔹 Groups
+    async def create_group(self, data: Dict[str, Any]) -> str:
+        """Creates a group document and adds it to its members' groups arrays; returns its ID.
+
+        The group document goes in the first commit, member updates follow in
+        commits of at most BATCH_WRITE_LIMIT writes.
+        """
+        group_ref = self.db.collection("groups").document()
+        def _create():
+            batch = ChunkedBatch(self.db)
+            batch.set(group_ref, data)
+            joined = self._set_array_field(batch, data.get("members", []), "groups", firestore.ArrayUnion([group_ref.id]))
+            self._seed_read_markers(batch, group_conversation_id(group_ref.id), joined, read_count=0)
+            batch.commit()
+        await self._run_membership_change(group_ref.id, _create)
+        self.membership_cache.set(group_ref.id, tuple(data.get("members", [])))
+        return group_ref.id
+
+    async def get_group(self, group_id: str) -> Optional[Dict[str, Any]]:
+        """Returns groups/{id}, or None if it doesn't exist or is being deleted."""
+        group_data = await self._run(lambda: self._to_dict(self.db.collection("groups").document(group_id).get()))
+        if group_data is not None and group_data.get("deleting"):
+            group_data = None
+        if group_data is None:
+            self.membership_cache.invalidate(group_id)
+        else:
+            self.membership_cache.set(group_id, tuple(group_data.get("members", [])))
+        return group_data
+
+    async def get_group_members(self, group_id: str) -> Optional[Tuple[str, ...]]:
+        """Returns a group's member UIDs, or None if the group does not exist.
+
+        Served from the membership cache, which every group write made through
+        this repository keeps in step with Firestore, so the common case costs
+        no database read.
+        """
+        members = self.membership_cache.get(group_id)
+        if members is None:
+            group_data = await self.get_group(group_id)
+            if group_data is None:
+                return None
+            members = tuple(group_data.get("members", []))
+        return members
+
+    async def get_groups(self, group_ids: Iterable[str]) -> List[Optional[Dict[str, Any]]]:
+        """Returns groups/{id} documents in the order given, None for missing ones (and ones being deleted)."""
+        return [None if group_data is not None and group_data.get("deleting") else group_data
+                for group_data in await self._get_all("groups", group_ids)]
+
+    async def _run_membership_change(self, group_id: str, write: Callable[[], None]) -> None:
+        """Runs a ChunkedBatch membership write; if it fails part-way, every worker drops its cached members."""
+        try:
+            await self._run(write)
+        except Exception:
+            self.membership_cache.invalidate(group_id)
+            self._cache_changed("membership", group_id)
+            raise
+
+    def _change_cached_members(self, group_id: str, added: Iterable[str] = (), removed: Iterable[str] = ()):
+        """Applies a committed membership change to the cached member tuple, if one is cached."""
+        self._cache_changed("membership", group_id)
+        members = self.membership_cache.get(group_id)
+        if members is None:
+            return
+        removed = set(removed)
+        members = tuple(uid for uid in members if uid not in removed)
+        self.membership_cache.set(group_id, members + tuple(uid for uid in dict.fromkeys(added) if uid not in members))
+
+    async def add_group_members(self, group_id: str, uids: Iterable[str]) -> None:
+        """Adds users to a group and the group to their groups arrays (ArrayUnion, so concurrent changes
+        are never overwritten). New members start with nothing unread.
+
+        The group's member list is updated in the first commit, users' documents
+        and read markers follow in commits of at most BATCH_WRITE_LIMIT writes.
+        """
+        uids = list(uids)
+        def _add():
+            batch = ChunkedBatch(self.db)
+            batch.update(self.db.collection("groups").document(group_id), {"members": firestore.ArrayUnion(uids)})
+            joined = self._set_array_field(batch, uids, "groups", firestore.ArrayUnion([group_id]))
+            self._seed_read_markers(batch, group_conversation_id(group_id), joined)
+            batch.commit()
+        await self._run_membership_change(group_id, _add)
+        self._change_cached_members(group_id, added=uids)
+
+    async def remove_group_member(self, group_id: str, uid: str) -> None:
+        """Removes a user from a group, the group from their groups array and their read marker for it, in one commit."""
+        def _remove():
+            batch = self.db.batch()
+            batch.update(self.db.collection("groups").document(group_id), {"members": firestore.ArrayRemove([uid])})
+            self._set_array_field(batch, [uid], "groups", firestore.ArrayRemove([group_id]))
+            batch.delete(self.db.collection("users").document(uid).collection("conversations").document(group_conversation_id(group_id)))
+            batch.commit()
+        await self._run(_remove)
+        self._change_cached_members(group_id, removed=[uid])
+
+    async def delete_group(self, group_id: str) -> None:
+        def _delete():
+            batch = self.db.batch()
+            batch.delete(self.db.collection("groups").document(group_id))
+            batch.delete(self.db.collection("conversation_summaries").document(group_conversation_id(group_id)))
+            batch.commit()
+        await self._run(_delete)
+        self.membership_cache.invalidate(group_id)
+        self._cache_changed("membership", group_id)
+
+    # 🔹 Group deletion jobs (group_deletions/{group_id})
+    async def start_group_deletion(self, group_id: str, job: Dict[str, Any]) -> None:
+        """Records a deletion job and flags the group as being deleted, in one commit."""
+        def _start():
+            batch = self.db.batch()
+            batch.set(self.db.collection("group_deletions").document(group_id), job)
+            batch.update(self.db.collection("groups").document(group_id), {"deleting": True})
+            batch.commit()
+        await self._run(_start)
+        self.membership_cache.invalidate(group_id)
+        self._cache_changed("membership", group_id)
+
+    async def get_group_deletion(self, group_id: str) -> Optional[Dict[str, Any]]:
+        return await self._run(lambda: self._to_dict(self.db.collection("group_deletions").document(group_id).get()))
+
+    async def update_group_deletion(self, group_id: str, fields: Dict[str, Any]) -> None:
+        await self._run(lambda: self.db.collection("group_deletions").document(group_id).update(fields))
+
+    async def list_unfinished_group_deletions(self) -> List[Dict[str, Any]]:
+        def _query():
+            return [doc.to_dict() for doc in self.db.collection("group_deletions").where("status", "==", "running").stream()]
+        return await self._run(_query)
+
+    async def claim_group_deletion(self, group_id: str, owner: str, lease_until: datetime, now: datetime) -> Optional[Dict[str, Any]]:
+        """Takes the lease on a running deletion job unless another worker holds an unexpired one.
+
+        Runs in a transaction, so of several workers resuming the same job
+        only one gets it. Returns the job, or None if it was not claimed.
+        """
+        job_ref = self.db.collection("group_deletions").document(group_id)
+        @firestore.transactional
+        def _claim(transaction):
+            job = self._to_dict(job_ref.get(transaction=transaction))
+            if job is None or job.get("status") != "running":
+                return None
+            if job.get("lease_owner") not in (None, owner) and job.get("lease_until") and job["lease_until"] > now:
+                return None
+            transaction.update(job_ref, {"lease_owner": owner, "lease_until": lease_until})
+            return {**job, "lease_owner": owner, "lease_until": lease_until}
+        return await self._run(lambda: _claim(self.db.transaction()))
+
+    async def remove_group_from_users(self, group_id: str, uids: Iterable[str], batch_size: int = 400) -> None:
+        """Removes group_id from each existing user's groups array (ArrayRemove, batch_size users per commit)."""
+        uids = list(uids)
+        def _remove(chunk):
+            batch = self.db.batch()
+            if self._set_array_field(batch, chunk, "groups", firestore.ArrayRemove([group_id])):
+                batch.commit()
+        for start in range(0, len(uids), batch_size):
+            await self._run(_remove, uids[start:start + batch_size])
+
+    async def delete_read_markers(self, conversation_id: str, uids: Iterable[str], batch_size: int = 400) -> None:
+        """Deletes users/{uid}/conversations/{conversation_id} for each user (batch_size per commit)."""
+        uids = list(uids)
+        def _delete(chunk):
+            batch = self.db.batch()
+            for uid in chunk:
+                batch.delete(self.db.collection("users").document(uid).collection("conversations").document(conversation_id))
+            batch.commit()
+        for start in range(0, len(uids), batch_size):
+            await self._run(_delete, uids[start:start + batch_size])
+
+    async def has_pending_add_request(self, group_id: str, new_member_uid: str) -> bool:
+        def _query():
+            add_requests_ref = self.db.collection("groups").document(group_id).collection("add_requests")
+            return bool(add_requests_ref.where("new_member_uid", "==", new_member_uid).where("status", "==", "pending").limit(1).get())
+        return await self._run(_query)
+
+    async def create_add_request(self, group_id: str, data: Dict[str, Any]) -> None:
+        await self._run(lambda: self.db.collection("groups").document(group_id).collection("add_requests").add(data))
+
+    async def get_add_request(self, group_id: str, request_id: str) -> Optional[Dict[str, Any]]:
+        def _get():
+            return self._to_dict(self.db.collection("groups").document(group_id).collection("add_requests").document(request_id).get())
+        return await self._run(_get)
+
+    async def update_add_request(self, group_id: str, request_id: str, fields: Dict[str, Any]) -> None:
+        def _update():
+            self.db.collection("groups").document(group_id).collection("add_requests").document(request_id).update(fields)
+        await self._run(_update)
+
+    async def accept_add_request(self, group_id: str, request_id: str, new_member_uid: str) -> None:
+        """Marks an add-member request accepted and adds the member to the group (request and group first)."""
+        def _accept():
+            batch = ChunkedBatch(self.db)
+            group_ref = self.db.collection("groups").document(group_id)
+            batch.update(group_ref.collection("add_requests").document(request_id), {"status": "accepted"})
+            batch.update(group_ref, {"members": firestore.ArrayUnion([new_member_uid])})
+            joined = self._set_array_field(batch, [new_member_uid], "groups", firestore.ArrayUnion([group_id]))
+            self._seed_read_markers(batch, group_conversation_id(group_id), joined)
+            batch.commit()
+        await self._run_membership_change(group_id, _accept)
+        self._change_cached_members(group_id, added=[new_member_uid])
+
+    async def list_pending_add_requests(self, group_id: str) -> List[Dict[str, Any]]:
+        """Returns pending add-member requests for a group, each with its document ID."""
+        def _query():
+            add_requests_ref = self.db.collection("groups").document(group_id).collection("add_requests")
+            return [{**doc.to_dict(), "id": doc.id} for doc in add_requests_ref.where("status", "==", "pending").stream()]
+        return await self._run(_query)
+
+    # 🔹 Messages
+    def new_document_id(self, collection: str) -> str:
+        """Generates a Firestore document ID locally (no round trip)."""
+        return self.db.collection(collection).document().id
+
+    async def document_exists(self, collection: str, doc_id: str) -> bool:
+        return await self._run(lambda: self.db.collection(collection).document(doc_id).get().exists)
+
+    async def commit_batch(self, writes: List[BatchWrite]) -> None:
+        """Applies (collection, doc_id, data, merge) writes in a single batched commit.
+
+        merge=False creates/replaces the document; merge=True merges the
+        fields into it (so Increment and friends can be used).
+        """
+        def _commit():
+            batch = self.db.batch()
+            for collection, doc_id, data, merge in writes:
+                batch.set(self.db.collection(collection).document(doc_id), data, merge=merge)
+            batch.commit()
+        await self._run(_commit)
+
+    # 🔹 Conversation summaries
+    @staticmethod
+    def conversation_summary_writes(conversation_id: str, message_id: str, message_data: Dict[str, Any],
+                                    receiver_uid: Optional[str] = None) -> List[BatchWrite]:
+        """Writes that keep the conversation list current; committed together with the message.
+
+        conversation_summaries/{conversation_id} holds the last message (still
+        encrypted) and a message_count. Each participant has a read marker in
+        users/{uid}/conversations/{conversation_id}; unread = message_count -
+        read_count. The sender's own message counts as read; a DM receiver's
+        marker is created so the conversation shows up in their list.
+        """
+        kind, _ = parse_conversation_id(conversation_id)
+        sender_uid = message_data["sender"]
+        writes: List[BatchWrite] = [
+            ("conversation_summaries", conversation_id, {
+                "conversation_id": conversation_id,
+                "kind": kind,
+                "last_message_id": message_id,
+                "last_message": message_data.get("message"),
+                "last_sender": sender_uid,
+                "last_type": message_data.get("type", "text"),
+                "timestamp": message_data.get("timestamp", firestore.SERVER_TIMESTAMP),
+                "message_count": firestore.Increment(1)
+            }, True),
+            (f"users/{sender_uid}/conversations", conversation_id, {
+                "conversation_id": conversation_id,
+                "read_count": firestore.Increment(1)
+            }, True)
+        ]
+        if "seq" in message_data:
+            writes[0][2]["last_seq"] = message_data["seq"]
+        if receiver_uid:
+            writes.append((f"users/{receiver_uid}/conversations", conversation_id, {"conversation_id": conversation_id}, True))
+        return writes
+
+    async def get_last_seq(self, conversation_id: str) -> int:
+        """Returns the last message sequence number stored for a conversation (0 if none)."""
+        summary = await self._run(lambda: self._to_dict(self.db.collection("conversation_summaries").document(conversation_id).get()))
+        return (summary or {}).get("last_seq", 0)
+
+    async def list_messages_after_seq(self, conversation_id: str, after_seq: int, limit: int) -> List[Dict[str, Any]]:
+        """Returns up to limit messages of a conversation with seq > after_seq, oldest first (each with "id").
+
+        Needs composite indexes on (conversation_id, seq) for messages and (group_id, seq) for group_messages.
+        """
+        kind, ids = parse_conversation_id(conversation_id)
+        collection, field, value = ("messages", "conversation_id", conversation_id) if kind == "dm" else ("group_messages", "group_id", ids[0])
+        def _query():
+            query = (self.db.collection(collection).where(field, "==", value).where("seq", ">", after_seq)
+                     .order_by("seq").limit(limit))
+            return [{**doc.to_dict(), "id": doc.id} for doc in query.stream()]
+        return await self._run(_query)
+
+    async def list_conversation_markers(self, uid: str) -> List[Dict[str, Any]]:
+        """Returns a user's read markers (conversation_id, read_count)."""
+        def _query():
+            return [doc.to_dict() for doc in self.db.collection("users").document(uid).collection("conversations").stream()]
+        return await self._run(_query)
+
+    async def get_conversation_summaries(self, conversation_ids: Iterable[str]) -> List[Optional[Dict[str, Any]]]:
+        return await self._get_all("conversation_summaries", conversation_ids)
+
+    async def mark_conversation_read(self, uid: str, conversation_id: str) -> None:
+        """Moves a user's read marker up to the conversation's current message count."""
+        def _mark():
+            summary = self._to_dict(self.db.collection("conversation_summaries").document(conversation_id).get())
+            self.db.collection("users").document(uid).collection("conversations").document(conversation_id).set({
+                "conversation_id": conversation_id,
+                "read_count": (summary or {}).get("message_count", 0)
+            }, merge=True)
+        await self._run(_mark)
+
+    async def list_direct_messages(self, uid_a: str, uid_b: str, limit: Optional[int] = None,
+                                   before: Optional[str] = None, after: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Returns one page of a direct conversation, newest first."""
+        conversation_id = direct_conversation_id(uid_a, uid_b)
+        return await self._run(self._history_page, "messages", "conversation_id", conversation_id, limit, before, after)
+
+    async def list_group_messages(self, group_id: str, limit: Optional[int] = None,
+                                  before: Optional[str] = None, after: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Returns one page of a group's messages, newest first."""
+        return await self._run(self._history_page, "group_messages", "group_id", group_id, limit, before, after)
+
+    def _history_page(self, collection: str, key_field: str, key: str, limit: Optional[int],
+                      before: Optional[str], after: Optional[str]) -> List[Dict[str, Any]]:
+        """Runs a single ordered query for one page of history.
+
+        Messages are ordered by server timestamp with the document ID as a tie
+        breaker, so a cursor always points at an exact position. ``before``
+        walks back into older messages, ``after`` fetches newer ones; either
+        way the page is returned newest first and only ``limit`` documents
+        are read.
+        """
+        direction = firestore.Query.ASCENDING if after else firestore.Query.DESCENDING
+        query = (
+            self.db.collection(collection)
+            .where(key_field, "==", key)
+            .order_by("timestamp", direction=direction)
+            .order_by("__name__", direction=direction)
+        )
+        cursor = after or before
+        if cursor:
+            query = query.start_after(decode_cursor(cursor))
+        if limit:
+            query = query.limit(limit)
+
+        messages = [{**doc.to_dict(), "id": doc.id} for doc in query.stream()]
+        if after:
+            messages.reverse()
+        return messages
+
+    async def run_migration(self, name: str, migrate: Callable[[], Awaitable[int]]) -> Optional[int]:
+        """Runs a one-off data migration unless some worker already ran or started it; returns its count, or None if skipped.
+
+        migrations/{name} records it; delete that document to run it again.
+        """
+        migration_ref = self.db.collection("migrations").document(name)
+        try:
+            await self._run(lambda: migration_ref.create({"status": "running", "started_at": firestore.SERVER_TIMESTAMP}))
+        except AlreadyExists:
+            return None
+        try:
+            count = await migrate()
+        except Exception:
+            # Let the next start try again
+            await self._run(migration_ref.delete)
+            raise
+        await self._run(lambda: migration_ref.update({"status": "done", "count": count, "finished_at": firestore.SERVER_TIMESTAMP}))
+        return count
+
+    async def backfill_conversation_ids(self, batch_size: int = 500) -> int:
+        """Adds conversation_id to direct messages stored before it existed.
+
+        Walks the messages collection in document-ID order, batch_size
+        documents at a time, and returns how many documents were updated.
+        """
+        def _backfill():
+            updated = 0
+            last_doc = None
+            while True:
+                query = self.db.collection("messages").order_by("__name__").limit(batch_size)
+                if last_doc is not None:
+                    query = query.start_after(last_doc)
+                docs = list(query.stream())
+                if not docs:
+                    return updated
+
+                batch = self.db.batch()
+                pending = 0
+                for doc in docs:
+                    data = doc.to_dict()
+                    if "conversation_id" not in data and data.get("sender") and data.get("receiver"):
+                        batch.update(doc.reference, {"conversation_id": direct_conversation_id(data["sender"], data["receiver"])})
+                        pending += 1
+                if pending:
+                    batch.commit()
+                    updated += pending
+                last_doc = docs[-1]
+        return await self._run(_backfill)
+
+    async def backfill_direct_conversations(self, batch_size: int = 500) -> int:
+        """Creates conversation summaries and read markers for direct chats that predate them.
+
+        Walks the messages collection in document-ID order, then for each
+        direct conversation writes a summary (last message, message_count) if
+        it has none, and a read marker for each participant who lacks one.
+        Backfilled history counts as read. Returns how many conversations
+        were changed.
+        """
+        def _backfill():
+            conversations: Dict[str, Dict[str, Any]] = {}
+            last_doc = None
+            while True:
+                query = self.db.collection("messages").order_by("__name__").limit(batch_size)
+                if last_doc is not None:
+                    query = query.start_after(last_doc)
+                docs = list(query.stream())
+                if not docs:
+                    break
+                for doc in docs:
+                    data = doc.to_dict()
+                    conversation_id = data.get("conversation_id")
+                    if not conversation_id or not conversation_id.startswith("dm:"):
+                        continue
+                    seen = conversations.setdefault(conversation_id, {"count": 0, "last_id": None, "last": None})
+                    seen["count"] += 1
+                    timestamp = data.get("timestamp")
+                    if seen["last"] is None or (timestamp is not None and (seen["last"].get("timestamp") is None or timestamp >= seen["last"]["timestamp"])):
+                        seen["last_id"], seen["last"] = doc.id, data
+                last_doc = docs[-1]
+
+            changed = 0
+            conversation_ids = list(conversations)
+            # Up to three writes per conversation (summary and two markers)
+            step = max(1, batch_size // 3)
+            for start in range(0, len(conversation_ids), step):
+                chunk = conversation_ids[start:start + step]
+                summary_refs = [self.db.collection("conversation_summaries").document(conversation_id) for conversation_id in chunk]
+                summaries = {snapshot.id: snapshot.to_dict() for snapshot in self.db.get_all(summary_refs) if snapshot.exists}
+                marker_refs = [self.db.collection("users").document(uid).collection("conversations").document(conversation_id)
+                               for conversation_id in chunk for uid in parse_conversation_id(conversation_id)[1]]
+                has_marker = {snapshot.reference.path for snapshot in self.db.get_all(marker_refs) if snapshot.exists}
+
+                batch = self.db.batch()
+                pending = 0
+                for conversation_id in chunk:
+                    seen = conversations[conversation_id]
+                    summary = summaries.get(conversation_id)
+                    queued = False
+                    if summary is None:
+                        last = seen["last"]
+                        batch.set(self.db.collection("conversation_summaries").document(conversation_id), {
+                            "conversation_id": conversation_id,
+                            "kind": "dm",
+                            "last_message_id": seen["last_id"],
+                            "last_message": last.get("message"),
+                            "last_sender": last.get("sender"),
+                            "last_type": last.get("type", "text"),
+                            "timestamp": last.get("timestamp"),
+                            "message_count": seen["count"]
+                        })
+                        queued = True
+                    read_count = seen["count"] if summary is None else summary.get("message_count", 0)
+                    for uid in parse_conversation_id(conversation_id)[1]:
+                        marker_ref = self.db.collection("users").document(uid).collection("conversations").document(conversation_id)
+                        if summary is None or marker_ref.path not in has_marker:
+                            batch.set(marker_ref, {"conversation_id": conversation_id, "read_count": read_count}, merge=True)
+                            queued = True
+                    if queued:
+                        pending += 1
+                if pending:
+                    batch.commit()
+                    changed += pending
+            return changed
+        return await self._run(_backfill)
+
+    async def scan_collection(self, collection: str, batch_size: int = 500) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Streams a whole collection in document-ID order, batch_size documents (with "id") at a time."""
+        last_doc = None
+        while True:
+            def _page(last_doc=last_doc):
+                query = self.db.collection(collection).order_by("__name__").limit(batch_size)
+                if last_doc is not None:
+                    query = query.start_after(last_doc)
+                return list(query.stream())
+            docs = await self._run(_page)
+            if not docs:
+                return
+            yield [{"id": doc.id, **doc.to_dict()} for doc in docs]
+            last_doc = docs[-1]
+
+    def _delete_batch(self, query, batch_size: int) -> int:
+        """Deletes up to batch_size documents matched by query in one batched commit; returns how many."""
+        docs = list(query.limit(batch_size).stream())
+        if docs:
+            batch = self.db.batch()
+            for doc in docs:
+                batch.delete(doc.reference)
+            batch.commit()
+        return len(docs)
+
+    async def delete_group_messages_batch(self, group_id: str, batch_size: int = 400) -> int:
+        """Deletes one batch of a group's messages; returns how many were removed (0 once none are left)."""
+        query = self.db.collection("group_messages").where("group_id", "==", group_id)
+        return await self._run(self._delete_batch, query, batch_size)
+
+    async def delete_add_requests_batch(self, group_id: str, batch_size: int = 400) -> int:
+        """Deletes one batch of a group's add_requests subcollection; returns how many were removed."""
+        query = self.db.collection("groups").document(group_id).collection("add_requests")
+        return await self._run(self._delete_batch, query, batch_size)
+
+    # 🔹 Uploads
+    async def add_upload(self, data: Dict[str, Any]) -> None:
+        await self._run(lambda: self.db.collection("uploads").add(data))
+
+    @staticmethod
+    def _upload_hash_id(uid: str, resource_type: str, digest: str) -> str:
+        # Scoped to the uploader: a file URL is only handed back to someone who uploaded that content
+        return f"{uid}:{resource_type}:{digest}"
+
+    async def get_upload_by_hash(self, uid: str, resource_type: str, digest: str) -> Optional[Dict[str, Any]]:
+        """Looks up a file this user already stored, by resource type and the SHA-256 of its content."""
+        doc_id = self._upload_hash_id(uid, resource_type, digest)
+        return await self._run(lambda: self._to_dict(self.db.collection("upload_hashes").document(doc_id).get()))
+
+    async def add_upload_hash(self, uid: str, resource_type: str, digest: str, data: Dict[str, Any]) -> None:
+        doc_id = self._upload_hash_id(uid, resource_type, digest)
+        await self._run(lambda: self.db.collection("upload_hashes").document(doc_id).set(data))
+
+    async def list_uploads(self, uid: str) -> List[Dict[str, Any]]:
+        """Returns a user's uploads, newest first."""
+        def _query():
+            query = self.db.collection("uploads").where("uid", "==", uid).order_by("timestamp", direction=firestore.Query.DESCENDING)
+            return [doc.to_dict() for doc in query.stream()]
+        return await self._run(_query)
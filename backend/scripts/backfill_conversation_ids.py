@@ -0,0 +1,23 @@
+"""Adds conversation_id to direct messages written before history became conversation-keyed.
+
+The server runs this itself on first start (recorded in migrations/conversation_ids).
+To run it by hand, from the backend directory with the same environment as the server:
+
+    python scripts/backfill_conversation_ids.py
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import repo  # noqa: E402
+
+
+async def main():
+    updated = await repo.backfill_conversation_ids()
+    print(f"✅ Backfilled conversation_id on {updated} messages")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,26 @@
+"""Adds conversation summaries and read markers to direct chats from before the conversation list existed.
+
+Without a read marker, such a chat is missing from GET /conversations until
+someone sends a new message in it. The server runs this itself on first start
+(recorded in migrations/direct_conversation_summaries). To run it by hand, from
+the backend directory with the same environment as the server (after
+backfill_conversation_ids.py):
+
+    python scripts/backfill_conversation_summaries.py
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import repo  # noqa: E402
+
+
+async def main():
+    changed = await repo.backfill_direct_conversations()
+    print(f"✅ Backfilled summaries/read markers for {changed} direct conversations")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
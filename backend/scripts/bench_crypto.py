@@ -0,0 +1,56 @@
+"""Compares message encryption envelopes: per-message encrypt and decrypt latency.
+
+Run from the backend directory (a throwaway SECRET_KEY is used if none is set):
+
+    python scripts/bench_crypto.py [--count 20000] [--sizes 32,256,4096,65536]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SECRET_KEY", "benchmark-secret-key")
+
+from encryption import decrypt_message, encrypt_message  # noqa: E402
+
+VERSIONS = ("1", "2")
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def bench_single(version: str, messages):
+    """Times encrypt_message / decrypt_message one call at a time; returns sorted latencies in µs."""
+    encrypt_times, decrypt_times = [], []
+    for message in messages:
+        start = time.perf_counter()
+        encrypted = encrypt_message(message, version)
+        middle = time.perf_counter()
+        decrypt_message(encrypted)
+        end = time.perf_counter()
+        encrypt_times.append((middle - start) * 1e6)
+        decrypt_times.append((end - middle) * 1e6)
+    return sorted(encrypt_times), sorted(decrypt_times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=20000, help="messages per size and version")
+    parser.add_argument("--sizes", default="32,256,4096,65536", help="comma-separated message sizes in bytes")
+    args = parser.parse_args()
+
+    print(f"{'ver':>3} {'size':>6} | {'enc p50':>8} {'enc p99':>8} {'dec p50':>8} {'dec p99':>8} (µs)")
+    for size in (int(value) for value in args.sizes.split(",")):
+        count = max(100, min(args.count, args.count * 256 // size))
+        messages = ["x" * size] * count
+        for version in VERSIONS:
+            encrypt_times, decrypt_times = bench_single(version, messages)
+            print(f"{'v' + version:>3} {size:>6} | {statistics.median(encrypt_times):8.1f} {percentile(encrypt_times, 0.99):8.1f}"
+                  f" {statistics.median(decrypt_times):8.1f} {percentile(decrypt_times, 0.99):8.1f}")
+
+
+if __name__ == "__main__":
+    main()
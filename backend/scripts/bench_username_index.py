@@ -0,0 +1,78 @@
+"""Benchmarks the in-memory username prefix index on synthetic users.
+
+Needs no Firestore or environment; run from the backend directory:
+
+    python scripts/bench_username_index.py [--users 1000000] [--queries 100000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from username_index import UsernameIndex  # noqa: E402
+
+ALPHABET = string.ascii_letters + string.digits
+
+
+class SyntheticUsers:
+    """Stands in for the repository: scan_collection("users") yields generated user documents."""
+
+    def __init__(self, count: int):
+        self.count = count
+
+    async def scan_collection(self, collection, batch_size):
+        rng = random.Random(42)
+        for start in range(0, self.count, batch_size):
+            batch = []
+            for n in range(start, min(start + batch_size, self.count)):
+                username = "".join(rng.choices(ALPHABET, k=rng.randint(4, 14)))
+                batch.append({"id": f"uid{n}", "username": username, "name": f"User {n}", "profile_picture_url": None})
+            yield batch
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark the username prefix index")
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=100_000)
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    index = UsernameIndex()
+    start = time.perf_counter()
+    await index.load(SyntheticUsers(args.users), batch_size=10_000)
+    print(f"Load: {time.perf_counter() - start:.2f}s for {len(index)} usernames")
+
+    rng = random.Random(7)
+    for prefix_length in (2, 3, 5):
+        prefixes = ["".join(rng.choices(ALPHABET, k=prefix_length)) for _ in range(args.queries)]
+        latencies = []
+        matches = 0
+        for prefix in prefixes:
+            begin = time.perf_counter()
+            matches += len(index.search(prefix, args.limit))
+            latencies.append((time.perf_counter() - begin) * 1e6)
+        latencies.sort()
+        print(f"Search prefix len {prefix_length}: p50 {statistics.median(latencies):.1f}µs"
+              f" p99 {percentile(latencies, 0.99):.1f}µs, avg {matches / len(prefixes):.1f} matches")
+
+    latencies = []
+    for n in range(10_000):
+        begin = time.perf_counter()
+        index.upsert({"uid": f"new{n}", "username": "".join(rng.choices(ALPHABET, k=10)), "name": "New"})
+        latencies.append((time.perf_counter() - begin) * 1e6)
+    latencies.sort()
+    print(f"Insert: p50 {statistics.median(latencies):.1f}µs p99 {percentile(latencies, 0.99):.1f}µs")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
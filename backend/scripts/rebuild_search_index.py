@@ -0,0 +1,61 @@
+"""Rebuilds the message search index from the stored (encrypted) history.
+
+Streams messages and group_messages in batches, decrypts each batch and
+indexes it in one transaction. Run from the backend directory, with the same
+environment as the server:
+
+    python scripts/rebuild_search_index.py [--batch-size 500] [--keep]
+
+Without --keep the index is emptied first; with it, already indexed messages are skipped.
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repository import direct_conversation_id, group_conversation_id  # noqa: E402
+from search_index import to_epoch  # noqa: E402
+from server import decrypt_chunk, repo, search_index  # noqa: E402
+
+
+def index_rows(collection: str, batch):
+    texts = decrypt_chunk([data.get("message") for data in batch])
+    for data, text in zip(batch, texts):
+        if text is None or not data.get("sender"):
+            continue
+        if collection == "messages":
+            if not data.get("receiver"):
+                continue
+            conversation_id = data.get("conversation_id") or direct_conversation_id(data["sender"], data["receiver"])
+            receiver = data["receiver"]
+        else:
+            if not data.get("group_id"):
+                continue
+            conversation_id = group_conversation_id(data["group_id"])
+            receiver = None
+        yield data["id"], conversation_id, data["sender"], receiver, to_epoch(data.get("timestamp")), text
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Rebuild the message search index")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--keep", action="store_true", help="don't clear the index first")
+    args = parser.parse_args()
+
+    if not args.keep:
+        await search_index.clear()
+
+    for collection in ("messages", "group_messages"):
+        indexed = 0
+        async for batch in repo.scan_collection(collection, args.batch_size):
+            rows = list(index_rows(collection, batch))
+            await search_index.add_many(rows)
+            indexed += len(rows)
+            print(f"🔎 {collection}: {indexed} indexed")
+        print(f"✅ Indexed {indexed} {collection}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
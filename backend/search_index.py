@@ -0,0 +1,223 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import asyncio
+import fcntl
+import os
+import re
+import socket
+import sqlite3
+import threading
+
+# SQLite file holding the full-text index, one per host and shared by that host's workers.
+# It stores message plaintext, so keep it on the server's private disk.
+SEARCH_INDEX_PATH = os.getenv("SEARCH_INDEX_PATH", "search_index.db")
+# Identifies the host (and so the index file) a change was made on; set it if hostnames are not unique
+SEARCH_INDEX_HOST = os.getenv("SEARCH_INDEX_HOST", socket.gethostname())
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "2"))
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "100"))
+
+# (message_id, conversation_id, sender, receiver or None for group messages, epoch seconds, plaintext)
+IndexRow = Tuple[str, str, str, Optional[str], float, str]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    rowid INTEGER PRIMARY KEY,
+    message_id TEXT NOT NULL UNIQUE,
+    conversation_id TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    receiver TEXT,
+    timestamp REAL NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_conversation ON messages (conversation_id, timestamp);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    text, content='messages', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+END;
+"""
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def build_match_query(query: str) -> Optional[str]:
+    """Turns free text into an FTS5 query: every word must match, the last one as a prefix."""
+    words = _WORD.findall(query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def to_epoch(timestamp: Any) -> float:
+    if isinstance(timestamp, datetime):
+        return timestamp.timestamp()
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    return datetime.now(timezone.utc).timestamp()
+
+
+class MessageSearchIndex:
+    """Full-text index over decrypted chat messages, kept in a local SQLite FTS5 database.
+
+    Writes go through a single writer thread and are fire-and-forget, so the
+    chat path never waits on the index. Searches run on a small reader pool
+    (WAL mode lets them proceed while a write is in progress).
+
+    There is one index file per host, shared by the workers on it. A worker
+    writes its own changes (new messages, purged conversations) to that file
+    and reports them to on_change, tagged with its host. On every other host
+    exactly one worker applies them through apply(): the one holding the
+    file's lock (<path>.lock). So every host's index has every message and
+    each change is applied once per host.
+    """
+
+    def __init__(self, path: str = SEARCH_INDEX_PATH, workers: int = SEARCH_WORKERS, host: str = SEARCH_INDEX_HOST):
+        self.path = path
+        self.host = host
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search-write")
+        self._readers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="search-read")
+        self._local = threading.local()
+        self._lock_file = None
+        # Called with each change made on this worker, in the form apply() takes
+        self.on_change: Optional[Callable[[Dict[str, Any]], None]] = None
+        self._writer.submit(self._setup).result()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            # Other workers on this host write to the same file
+            connection.execute("PRAGMA busy_timeout=5000")
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _setup(self):
+        connection = self._connection()
+        connection.executescript(_SCHEMA)
+        connection.commit()
+
+    def _insert(self, rows: List[IndexRow]):
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO messages (message_id, conversation_id, sender, receiver, timestamp, text)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+    def _insert_logged(self, rows: List[IndexRow]):
+        try:
+            self._insert(rows)
+        except Exception as e:
+            print(f"❌ Failed to index {len(rows)} messages: {e}")
+
+    def add(self, message_id: str, conversation_id: str, sender: str, receiver: Optional[str], timestamp: Any, text: str):
+        """Queues one message for indexing without waiting for it."""
+        row = (message_id, conversation_id, sender, receiver, to_epoch(timestamp), text)
+        self._writer.submit(self._insert_logged, [row])
+        self._changed({"op": "add", "row": list(row)})
+
+    def _changed(self, change: Dict[str, Any]):
+        if self.on_change is not None:
+            self.on_change({**change, "host": self.host})
+
+    def _owns_host_copy(self) -> bool:
+        """True if this worker applies other hosts' changes to this host's file (it holds the file lock)."""
+        if self._lock_file is None:
+            lock_file = open(f"{self.path}.lock", "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            # Held until this process exits
+            self._lock_file = lock_file
+        return True
+
+    def apply(self, change: Dict[str, Any]):
+        """Applies a change made on another host ("add" or "purge"), without reporting it again."""
+        if change.get("host") == self.host or not self._owns_host_copy():
+            return
+        if change.get("op") == "add":
+            self._writer.submit(self._insert_logged, [tuple(change["row"])])
+        elif change.get("op") == "purge":
+            self._writer.submit(self._remove_conversation, change["conversation_id"])
+
+    async def add_many(self, rows: Iterable[IndexRow]):
+        """Indexes a batch of messages in one transaction (used by the rebuild script)."""
+        await asyncio.get_running_loop().run_in_executor(self._writer, self._insert, list(rows))
+
+    def _remove_conversation(self, conversation_id: str):
+        connection = self._connection()
+        with connection:
+            # External-content FTS rows are removed by replaying each row's text as a 'delete' command
+            connection.execute(
+                "INSERT INTO messages_fts (messages_fts, rowid, text)"
+                " SELECT 'delete', rowid, text FROM messages WHERE conversation_id = ?",
+                (conversation_id,)
+            )
+            connection.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+
+    def remove_conversation(self, conversation_id: str) -> Future:
+        """Queues removal of every indexed message of a conversation; returns a future callers may wait on."""
+        future = self._writer.submit(self._remove_conversation, conversation_id)
+        self._changed({"op": "purge", "conversation_id": conversation_id})
+        return future
+
+    async def clear(self):
+        def _clear():
+            connection = self._connection()
+            with connection:
+                connection.execute("DELETE FROM messages")
+                connection.execute("INSERT INTO messages_fts (messages_fts) VALUES ('delete-all')")
+        await asyncio.get_running_loop().run_in_executor(self._writer, _clear)
+
+    def _search(self, match: str, uid: str, group_ids: List[str], conversation_id: Optional[str],
+                limit: int) -> List[Dict[str, Any]]:
+        # Scope: direct messages the caller sent or received, plus messages of their groups
+        scope = ["m.receiver = ?", "(m.sender = ? AND m.receiver IS NOT NULL)"]
+        params: List[Any] = [match, uid, uid]
+        if group_ids:
+            scope.append(f"m.conversation_id IN ({', '.join('?' * len(group_ids))})")
+            params.extend(group_ids)
+        sql = (
+            "SELECT m.message_id, m.conversation_id, m.sender, m.receiver, m.timestamp, m.text"
+            " FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid"
+            f" WHERE messages_fts MATCH ? AND ({' OR '.join(scope)})"
+        )
+        if conversation_id:
+            sql += " AND m.conversation_id = ?"
+            params.append(conversation_id)
+        sql += " ORDER BY m.timestamp DESC LIMIT ?"
+        params.append(limit)
+
+        results = []
+        for message_id, conversation, sender, receiver, timestamp, text in self._connection().execute(sql, params):
+            result = {
+                "id": message_id,
+                "conversation_id": conversation,
+                "sender": sender,
+                "text": text,
+                "timestamp": datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+            }
+            if receiver:
+                result["receiver"] = receiver
+            results.append(result)
+        return results
+
+    async def search(self, query: str, uid: str, group_conversation_ids: List[str],
+                     conversation_id: Optional[str] = None, limit: int = 20) -> List[Dict[str, Any]]:
+        """Returns the newest messages matching query within the caller's conversations."""
+        match = build_match_query(query)
+        if match is None:
+            return []
+        limit = max(1, min(limit, SEARCH_MAX_RESULTS))
+        return await asyncio.get_running_loop().run_in_executor(
+            self._readers, self._search, match, uid, group_conversation_ids, conversation_id, limit
+        )
@@ -1,14 +1,30 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, Request, UploadFile, File, Form ,Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
 import firebase_admin
 from firebase_admin import auth, firestore, credentials, storage
 from encryption import encrypt_message, decrypt_message
 from websocket_manager import WebSocketManager
+from fanout import create_bus
+from message_writer import MessageWriter
+from typing_coalescer import TypingCoalescer
+from repository import FirestoreRepository, client_message_id, direct_conversation_id, group_conversation_id, parse_conversation_id, encode_cursor
+from search_index import MessageSearchIndex
+from username_index import UsernameIndex
+from replay import create_sequencer
+from group_deletion import GroupDeletionJobs
+from presence import PresenceTracker
+from cache import LRUCache
+from uploads import upload_slots, measure_upload, push_to_storage
+from metrics import REGISTRY, CONTENT_TYPE, FRAMES_IN, UPLOADS, UPLOAD_BYTES, SEARCHES, RequestScopeMiddleware
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import os
 import json
+import hashlib
 import uuid
 from datetime import datetime
-from typing import Optional, List
+from typing import Dict, Optional, List, Tuple
 import cloudinary
 import cloudinary.uploader
 
@@ -23,6 +39,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ✅ Request scope for metrics (labels Firestore latency with the endpoint that made the call)
+app.add_middleware(RequestScopeMiddleware)
+
 
 
 # ✅ Initialize Firebase Admin SDK
@@ -42,8 +61,212 @@ if not firebase_admin._apps:
 # ✅ Initialize Firestore
 db = firestore.client()
 
-# ✅ WebSocket Manager
-websocket_manager = WebSocketManager()
+# ✅ Async data-access layer (all handlers go through this)
+repo = FirestoreRepository(db)
+
+# ✅ WebSocket Manager (fan-out bus chosen by FANOUT_BACKEND: "local" or "redis")
+bus = create_bus()
+websocket_manager = WebSocketManager(bus)
+
+# ✅ Cached memberships/profiles changed by this worker are dropped on every other worker too
+repo.on_cache_change = lambda cache, key: bus.emit("invalidate", {"cache": cache, "key": key})
+bus.on_event("invalidate", lambda event: repo.drop_cached(event["cache"], event["key"]))
+
+# ✅ Online/last-seen presence, pushed to contacts (sockets are kept honest by server pings)
+presence = PresenceTracker(websocket_manager, repo)
+
+# ✅ Write-behind message persistence (batched commits)
+message_writer = MessageWriter(repo)
+
+# ✅ Per-conversation sequence numbers on message frames (shared through Redis when fan-out is)
+sequencer = create_sequencer(repo.get_last_seq)
+
+# ✅ Full-text index over decrypted messages (SQLite FTS5, one file per host)
+search_index = MessageSearchIndex()
+# ✅ Messages indexed or purged here reach every other host's index
+search_index.on_change = lambda change: bus.emit("search_index", change)
+bus.on_event("search_index", search_index.apply)
+
+# ✅ Background group deletion (batched, resumable, one worker per job)
+group_deletions = GroupDeletionJobs(repo, message_writer, search_index)
+
+# ✅ In-memory username prefix index for /search_users (loaded in the background at startup)
+username_index = UsernameIndex()
+# ✅ Username/profile changes made here are replayed into every other worker's index
+username_index.on_change = lambda change: bus.emit("username_index", change)
+bus.on_event("username_index", username_index.apply)
+background_tasks = set()
+
+
+async def forward_typing(kind: str, sender_uid: str, target: str, typing: bool):
+    """Delivers a coalesced typing (or stopped-typing) indicator."""
+    if kind == "dm":
+        await websocket_manager.send_typing_indicator(target, sender_uid, typing)
+        return
+
+    # Membership is only checked for frames that are actually forwarded (served from the cache)
+    members = await repo.get_group_members(target)
+    if members is None or sender_uid not in members:
+        return
+    await websocket_manager.send_group_typing_indicator(
+        group_id=target,
+        sender_uid=sender_uid,
+        members=members,
+        typing=typing
+    )
+
+
+# ✅ Typing indicators: at most one per (sender, target) per interval, auto-stop after a timeout
+typing_coalescer = TypingCoalescer(forward_typing)
+
+# ✅ Metrics read from live objects at scrape time (see GET /metrics)
+# Optional bearer token required to scrape /metrics
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+REGISTRY.callback("chat_ws_active_sockets", "Open WebSocket connections on this worker.",
+                  lambda: websocket_manager.socket_count)
+REGISTRY.callback("chat_ws_active_users", "Users with at least one open WebSocket on this worker.",
+                  lambda: len(websocket_manager.active_connections))
+REGISTRY.callback("chat_offline_queue_users", "Users with events queued while offline (in-process queue; Redis queues are not counted).",
+                  lambda: len(websocket_manager.offline))
+REGISTRY.callback("chat_message_writer_pending_writes", "Writes waiting for the next batched commit.",
+                  lambda: len(message_writer))
+REGISTRY.callback("chat_typing_forwarded_total", "Typing indicators forwarded.",
+                  lambda: typing_coalescer.stats()["forwarded"], kind="counter")
+REGISTRY.callback("chat_typing_suppressed_total", "Typing frames absorbed by the coalescer.",
+                  lambda: typing_coalescer.stats()["suppressed"], kind="counter")
+REGISTRY.callback("chat_typing_stops_sent_total", "Stopped-typing indicators sent.",
+                  lambda: typing_coalescer.stats()["stops_sent"], kind="counter")
+REGISTRY.callback("chat_typing_active", "Typing bursts currently in progress.",
+                  lambda: typing_coalescer.stats()["active"])
+
+
+def cache_stat(field: str) -> Dict[tuple, int]:
+    """One LRUCache.stats() field for every shared cache, keyed by cache name."""
+    caches = {
+        "token": token_cache,
+        "profile": repo.profile_cache,
+        "membership": repo.membership_cache,
+        "decrypted": decrypted_cache
+    }
+    return {(name,): cache.stats()[field] for name, cache in caches.items()}
+
+
+REGISTRY.callback("chat_cache_hits_total", "Cache lookups served from memory.",
+                  lambda: cache_stat("hits"), kind="counter", labels=("cache",))
+REGISTRY.callback("chat_cache_misses_total", "Cache lookups that missed or found an expired entry.",
+                  lambda: cache_stat("misses"), kind="counter", labels=("cache",))
+REGISTRY.callback("chat_cache_entries", "Entries currently held by each cache.",
+                  lambda: cache_stat("size"), labels=("cache",))
+
+# Inbound frame types counted by name; anything else a client sends is counted as "other"
+INBOUND_FRAME_TYPES = {"message", "typing", "group_message", "group_typing", "read", "pong", "notification"}
+
+
+@app.on_event("startup")
+async def start_websocket_manager():
+    await websocket_manager.start()
+    await presence.start()
+    await message_writer.start()
+    await sequencer.start()
+    await group_deletions.start()
+    for job in (username_index.load(repo), run_migrations()):
+        task = asyncio.create_task(job)
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+
+async def run_migrations():
+    """Backfills data written before conversation-keyed history, once per deployment (see migrations/{name})."""
+    for name, migrate in (("conversation_ids", repo.backfill_conversation_ids),
+                          ("direct_conversation_summaries", repo.backfill_direct_conversations)):
+        try:
+            count = await repo.run_migration(name, migrate)
+            if count is not None:
+                print(f"✅ Migration {name} done ({count} documents)")
+        except Exception as e:
+            print(f"❌ Migration {name} failed: {e}")
+            return
+
+
+@app.on_event("shutdown")
+async def stop_websocket_manager():
+    await group_deletions.stop()
+    await presence.stop()
+    await message_writer.stop()
+    await sequencer.stop()
+    await websocket_manager.stop()
+
+
+def acknowledge_when_durable(websocket: WebSocket, client_id: Optional[str], message_id: str, durable: asyncio.Future):
+    """Sends an "ack" frame to the socket that sent a message once its write has committed."""
+    def _send_ack(future: asyncio.Future):
+        status = "ok"
+        if future.cancelled() or future.exception() is not None:
+            status = "error"
+        websocket_manager.send_to_socket(websocket, {
+            "type": "ack",
+            "client_id": client_id,
+            "message_id": message_id,
+            "status": status
+        })
+    durable.add_done_callback(_send_ack)
+
+
+# Sends accepted recently, by message ID: a resend of one of these is acknowledged again, not stored twice
+CLIENT_SEND_CACHE_SIZE = int(os.getenv("CLIENT_SEND_CACHE_SIZE", "50000"))
+CLIENT_SEND_CACHE_TTL = float(os.getenv("CLIENT_SEND_CACHE_TTL", "600"))
+MAX_CLIENT_ID_LENGTH = 64
+recent_sends = LRUCache(max_size=CLIENT_SEND_CACHE_SIZE, ttl=CLIENT_SEND_CACHE_TTL)
+
+
+async def claim_send(websocket: WebSocket, sender_uid: str, client_id, collection: str,
+                     resend: bool) -> Tuple[Optional[str], Optional[asyncio.Future]]:
+    """Returns (message_id, claim) for an incoming message, or (None, None) for a resend that was already stored."""
+    if not isinstance(client_id, str) or not 0 < len(client_id) <= MAX_CLIENT_ID_LENGTH:
+        return repo.new_document_id(collection), None
+
+    message_id = client_message_id(sender_uid, client_id)
+    earlier = recent_sends.get(message_id)
+    if earlier is not None:
+        acknowledge_when_durable(websocket, client_id, message_id, earlier)
+        return None, None
+
+    claim = asyncio.get_running_loop().create_future()
+    recent_sends.set(message_id, claim)
+    if resend:
+        try:
+            stored = await repo.document_exists(collection, message_id)
+        except Exception:
+            recent_sends.invalidate(message_id)
+            claim.cancel()
+            raise
+        if stored:
+            claim.set_result(message_id)
+            acknowledge_when_durable(websocket, client_id, message_id, claim)
+            return None, None
+    return message_id, claim
+
+
+def settle_claim(message_id: str, claim: Optional[asyncio.Future], durable: asyncio.Future):
+    """Resolves a claim with the outcome of its write; a failed write may be sent again."""
+    if claim is None:
+        return
+    def _settle(future: asyncio.Future):
+        if future.cancelled() or future.exception() is not None:
+            recent_sends.invalidate(message_id)
+            claim.cancel()
+        else:
+            claim.set_result(future.result())
+    durable.add_done_callback(_settle)
+
+
+def index_when_durable(durable: asyncio.Future, message_id: str, conversation_id: str, sender_uid: str,
+                       receiver_uid: Optional[str], text: str):
+    """Adds a message to the search index once its write has committed."""
+    def _index(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is None:
+            search_index.add(message_id, conversation_id, sender_uid, receiver_uid, datetime.now(), text)
+    durable.add_done_callback(_index)
 
 
 # ✅ Initialize Cloudinary
@@ -57,16 +280,29 @@ cloudinary.config(
 
 
 
+# ✅ Verified-token cache (keyed by SHA-256 of the token, expires at the token's "exp")
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+token_cache = LRUCache(max_size=TOKEN_CACHE_SIZE)
+
+
 # ✅ Token Verification
 def verify_token(token: str):
     """Verifies Firebase ID token and returns user UID."""
+    token_digest = hashlib.sha256(token.encode()).hexdigest()
+    uid = token_cache.get(token_digest)
+    if uid is not None:
+        return uid
+
     try:
         decoded_token = auth.verify_id_token(token)
-        return decoded_token["uid"]
     except Exception as e:
         print(f"❌ Token verification failed: {e}")
         return None
 
+    uid = decoded_token["uid"]
+    token_cache.set(token_digest, uid, expires_at=decoded_token.get("exp"))
+    return uid
+
 
 # ✅ Register User
 from fastapi import Request
@@ -87,7 +323,7 @@ async def register_user(user_data: dict, request: Request):
         user = auth.create_user(email=email, password=password, display_name=name)
 
         # Store user info in Firestore with empty username and no profile picture initially
-        db.collection("users").document(user.uid).set({
+        new_user = {
             "name": name,
             "email": email,
             "uid": user.uid,
@@ -95,7 +331,9 @@ async def register_user(user_data: dict, request: Request):
             "profile_picture_url": None,  # Add this field
             "contacts": [],
             "groups": []
-        })
+        }
+        await repo.create_user(user.uid, new_user)
+        username_index.upsert(new_user)
 
         return {
             "message": "User registered successfully!", 
@@ -121,11 +359,10 @@ async def login_user(user_data: dict):
     try:
         user = auth.get_user_by_email(email)
         # Get user's data from Firestore
-        user_doc = db.collection("users").document(user.uid).get()
-        if not user_doc.exists:
+        user_data = await repo.get_user(user.uid)
+        if user_data is None:
             raise HTTPException(status_code=404, detail="User data not found")
         
-        user_data = user_doc.to_dict()
         name = user_data.get("name", "User")
         username = user_data.get("username", "")  # Get username (empty if not set)
         profile_picture_url = user_data.get("profile_picture_url", None)  # Get profile picture
@@ -190,10 +427,20 @@ async def websocket_endpoint(websocket: WebSocket):
         print(f"✅ User {sender_uid} authenticated")
         await websocket_manager.connect(websocket, sender_uid)
 
+        # 🔹 Resuming client: {"resume": {conversation_id: last seen seq}} -> replay what it missed
+        if isinstance(auth_data.get("resume"), dict):
+            await replay_missed_messages(websocket, sender_uid, auth_data["resume"])
+
         while True:
             data = await websocket.receive_json()
+            websocket_manager.touch(websocket)
             message_type = data.get("type", "message")
+            FRAMES_IN.inc(type=message_type if message_type in INBOUND_FRAME_TYPES else "other")
             
+            if message_type == "pong":
+                # Heartbeat reply; receiving it already marked the socket alive
+                continue
+
             if message_type == "message":
                 receiver_uid = data.get("receiver")
                 text = data.get("text")
@@ -204,13 +451,23 @@ async def websocket_endpoint(websocket: WebSocket):
                 if not receiver_uid or not text:
                     continue
 
+                # A resend of a message already accepted is only acknowledged again
+                message_id, claim = await claim_send(websocket, sender_uid, data.get("client_id"), "messages", data.get("resend", False))
+                if message_id is None:
+                    continue
+
                 # Create message data
+                conversation_id = direct_conversation_id(sender_uid, receiver_uid)
                 message_data = {
                     "sender": sender_uid,
                     "receiver": receiver_uid,
+                    "conversation_id": conversation_id,
+                    "seq": await sequencer.next(conversation_id),
                     "timestamp": firestore.SERVER_TIMESTAMP,
                     "type": "text"
                 }
+                if claim is not None:
+                    message_data["client_id"] = data["client_id"]
 
                 # Add file data if present
                 if file_url:
@@ -224,14 +481,24 @@ async def websocket_endpoint(websocket: WebSocket):
                 # Encrypt message text
                 message_data["message"] = encrypt_message(text)
 
-                # Store in Firestore
-                db.collection("messages").add(message_data)
+                # Queue the write (batched commit); the sender gets an ack once it is durable
+                durable = message_writer.write_with_id("messages", message_id, message_data, repo.conversation_summary_writes(
+                    message_data["conversation_id"], message_id, message_data, receiver_uid=receiver_uid
+                ))
+                settle_claim(message_id, claim, durable)
+                decrypted_cache.set(message_id, text)
+                acknowledge_when_durable(websocket, data.get("client_id"), message_id, durable)
+                index_when_durable(durable, message_id, message_data["conversation_id"], sender_uid, receiver_uid, text)
 
                 # Prepare data to send to receiver
                 send_data = {
                     "type": "message",
+                    "id": message_id,
+                    "client_id": message_data.get("client_id"),
                     "sender": sender_uid,
                     "text": text,
+                    "conversation_id": conversation_id,
+                    "seq": message_data["seq"],
                     "timestamp": datetime.now().isoformat()
                 }
                 if file_url:
@@ -243,12 +510,13 @@ async def websocket_endpoint(websocket: WebSocket):
 
                 # Send to receiver if online
                 await websocket_manager.send_message(receiver_uid, send_data, sender_uid)
+                await typing_coalescer.stop("dm", sender_uid, receiver_uid)
 
             elif message_type == "typing":
                 receiver_uid = data.get("receiver")
                 if receiver_uid:
-                    # Forward typing indicator to receiver
-                    await websocket_manager.send_typing_indicator(receiver_uid, sender_uid)
+                    # Forward typing indicator to receiver (coalesced per sender/receiver)
+                    await typing_coalescer.typing("dm", sender_uid, receiver_uid)
                         
             elif message_type == "group_message":
                 group_id = data.get("group_id")
@@ -260,22 +528,27 @@ async def websocket_endpoint(websocket: WebSocket):
                 if not group_id or not text:
                     continue
                 
-                # Verify user is in the group
-                group_ref = db.collection("groups").document(group_id).get()
-                if not group_ref.exists:
+                # Verify user is in the group (served from the membership cache)
+                members = await repo.get_group_members(group_id)
+                if members is None or sender_uid not in members:
                     continue
                 
-                group_data = group_ref.to_dict()
-                if sender_uid not in group_data.get("members", []):
+                # A resend of a message already accepted is only acknowledged again
+                message_id, claim = await claim_send(websocket, sender_uid, data.get("client_id"), "group_messages", data.get("resend", False))
+                if message_id is None:
                     continue
                 
                 # Create message data
+                conversation_id = group_conversation_id(group_id)
                 message_data = {
                     "group_id": group_id,
                     "sender": sender_uid,
+                    "seq": await sequencer.next(conversation_id),
                     "timestamp": firestore.SERVER_TIMESTAMP,
                     "type": "text"
                 }
+                if claim is not None:
+                    message_data["client_id"] = data["client_id"]
 
                 # Add file data if present
                 if file_url:
@@ -289,15 +562,25 @@ async def websocket_endpoint(websocket: WebSocket):
                 # Encrypt message text
                 message_data["message"] = encrypt_message(text)
                 
-                # Store in Firestore
-                db.collection("group_messages").add(message_data)
+                # Queue the write (batched commit); the sender gets an ack once it is durable
+                durable = message_writer.write_with_id("group_messages", message_id, message_data, repo.conversation_summary_writes(
+                    conversation_id, message_id, message_data
+                ))
+                settle_claim(message_id, claim, durable)
+                decrypted_cache.set(message_id, text)
+                acknowledge_when_durable(websocket, data.get("client_id"), message_id, durable)
+                index_when_durable(durable, message_id, conversation_id, sender_uid, None, text)
                 
                 # Prepare data to send to group members
                 send_data = {
                     "type": "group_message",
+                    "id": message_id,
+                    "client_id": message_data.get("client_id"),
                     "group_id": group_id,
                     "sender": sender_uid,
                     "text": text,
+                    "conversation_id": conversation_id,
+                    "seq": message_data["seq"],
                     "timestamp": datetime.now().isoformat()
                 }
                 if file_url:
@@ -312,8 +595,9 @@ async def websocket_endpoint(websocket: WebSocket):
                     group_id=group_id,
                     sender_uid=sender_uid,
                     message_data=send_data,
-                    members=group_data.get("members", [])
+                    members=members
                 )
+                await typing_coalescer.stop("group", sender_uid, group_id)
 
             elif message_type == "group_typing":
                 group_id = data.get("group_id")
@@ -321,20 +605,21 @@ async def websocket_endpoint(websocket: WebSocket):
                 if not group_id:
                     continue
                 
-                # Verify user is in the group
-                group_ref = db.collection("groups").document(group_id).get()
-                if not group_ref.exists:
+                # Coalesced per sender/group; membership is verified when a frame is forwarded
+                await typing_coalescer.typing("group", sender_uid, group_id)
+
+            elif message_type == "read":
+                # Read acknowledgement: the client has seen everything in this conversation
+                conversation_id = data.get("conversation_id")
+                if not conversation_id:
                     continue
-                
-                group_data = group_ref.to_dict()
-                if sender_uid not in group_data.get("members", []):
+                try:
+                    await check_conversation_access(sender_uid, conversation_id)
+                except HTTPException:
                     continue
-                
-                await websocket_manager.send_group_typing_indicator(
-                    group_id=group_id,
-                    sender_uid=sender_uid,
-                    members=group_data.get("members", [])
-                )
+                # The message being acknowledged may still be queued for its batched commit
+                await message_writer.flush()
+                await repo.mark_conversation_read(sender_uid, conversation_id)
 
             elif message_type == "notification":
                 # Handle custom notification types if needed
@@ -343,12 +628,15 @@ async def websocket_endpoint(websocket: WebSocket):
     except WebSocketDisconnect:
         print(f"🔴 User {sender_uid} disconnected")
         if sender_uid:
-            await websocket_manager.disconnect(sender_uid)
+            await websocket_manager.disconnect(sender_uid, websocket)
     except Exception as e:
         print(f"🔥 WebSocket Error: {e}")
         if sender_uid:
-            await websocket_manager.disconnect(sender_uid)
-        await websocket.close(code=1011)
+            await websocket_manager.disconnect(sender_uid, websocket)
+        try:
+            await websocket.close(code=1011)
+        except RuntimeError:
+            pass  # Already closed (e.g. dropped as a slow consumer)
 
 
 
@@ -358,29 +646,27 @@ async def get_contacts(uid: str, request: Request):
     """Retrieves the contact list of a user, including names, UIDs, and profile pictures."""
     # Verify the token from Authorization header
     token = request.headers.get("Authorization", "").replace("Bearer ", "")
-    if not token or not verify_token(token):
+    requester_uid = verify_token(token)
+    if not token or not requester_uid:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    user_ref = db.collection("users").document(uid).get()
+    user_data = await repo.get_user(uid)
 
-    if not user_ref.exists:
+    if user_data is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    user_data = user_ref.to_dict()
     contact_uids = user_data.get("contacts", [])
 
-    # Fetch full user details for each contact
+    # Contacts' online/last-seen status is only shown to the user themselves
+    contact_presence = await presence.snapshot(contact_uids) if requester_uid == uid else {}
+
+    # Fetch full user details for all contacts in one batched read
     contacts = []
-    for contact_uid in contact_uids:
-        contact_ref = db.collection("users").document(contact_uid).get()
-        if contact_ref.exists:
-            contact_data = contact_ref.to_dict()
-            contacts.append({
-                "uid": contact_uid,
-                "name": contact_data.get("name", "Unknown"),
-                "username": contact_data.get("username", ""),
-                "profile_picture_url": contact_data.get("profile_picture_url", None)  # Add profile picture
-            })
+    for contact_profile in await repo.get_user_profiles(contact_uids):
+        if contact_profile is not None:
+            contact_profile["name"] = contact_profile["name"] or "Unknown"
+            contact_profile.update(contact_presence.get(contact_profile["uid"], {}))
+            contacts.append(contact_profile)
 
     return {"contacts": contacts}
 
@@ -400,13 +686,12 @@ async def add_contact(uid: str, contact_data: dict, request: Request):
         raise HTTPException(status_code=400, detail="Missing contact UID")
 
     # Check if users exist
-    user_ref = db.collection("users").document(uid).get()
-    contact_ref = db.collection("users").document(contact_uid).get()
+    user_data = await repo.get_user(uid)
+    contact_user = await repo.get_user(contact_uid)
 
-    if not user_ref.exists or not contact_ref.exists:
+    if user_data is None or contact_user is None:
         raise HTTPException(status_code=404, detail="User or contact not found")
 
-    user_data = user_ref.to_dict()
     contacts = user_data.get("contacts", [])
 
     if contact_uid == uid:
@@ -419,7 +704,7 @@ async def add_contact(uid: str, contact_data: dict, request: Request):
     request_id = str(uuid.uuid4())
 
     # Store request in Firestore
-    db.collection("contact_requests").document(request_id).set({
+    await repo.create_contact_request(request_id, {
         "request_id": request_id,
         "sender": uid,
         "sender_name": user_data.get("name", "Unknown"),
@@ -454,70 +739,93 @@ async def remove_contact(uid: str, contact_data: dict, request: Request):
     if not contact_uid:
         raise HTTPException(status_code=400, detail="Missing contact UID")
 
-    user_ref = db.collection("users").document(uid)
-    user_doc = user_ref.get()
+    user_data = await repo.get_user(uid)
 
-    if not user_doc.exists:
+    if user_data is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    user_data = user_doc.to_dict()
     contacts = user_data.get("contacts", [])
 
     if contact_uid not in contacts:
         raise HTTPException(status_code=400, detail="Contact not found")
 
-    # Remove contact from user's contacts
-    contacts.remove(contact_uid)
-    user_ref.update({"contacts": contacts})
+    # Remove each user from the other's contacts (two-way removal, one commit)
+    await repo.remove_contacts(uid, contact_uid)
 
-    # Also remove user from contact's contacts list (two-way removal)
-    contact_ref = db.collection("users").document(contact_uid)
-    contact_doc = contact_ref.get()
+    return {"message": "Contact removed successfully"}
 
-    if contact_doc.exists:
-        contact_data = contact_doc.to_dict()
-        contact_contacts = contact_data.get("contacts", [])
 
-        if uid in contact_contacts:
-            contact_contacts.remove(uid)
-            contact_ref.update({"contacts": contact_contacts})
+# History page sizes for /conversations/{conversation_id}/messages
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+HISTORY_MAX_PAGE_SIZE = 500
 
-    return {"message": "Contact removed successfully"}
 
+# Decryption runs off the event loop; recently decrypted bodies are cached by document ID
+DECRYPT_WORKERS = int(os.getenv("DECRYPT_WORKERS", "4"))
+DECRYPT_CHUNK_SIZE = 64
+DECRYPTED_CACHE_SIZE = int(os.getenv("DECRYPTED_CACHE_SIZE", "20000"))
+decrypt_pool = ThreadPoolExecutor(max_workers=DECRYPT_WORKERS, thread_name_prefix="decrypt")
+decrypted_cache = LRUCache(max_size=DECRYPTED_CACHE_SIZE)
 
-# ✅ Get Messages
-@app.get("/messages/{user_id}/{contact_id}")
-async def get_messages(user_id: str, contact_id: str, request: Request, limit: Optional[int] = None):
-    """Retrieves chat history between two users."""
-    # Verify the token from Authorization header
-    token = request.headers.get("Authorization", "").replace("Bearer ", "")
-    if not token or not verify_token(token):
-        raise HTTPException(status_code=401, detail="Unauthorized")
 
+def decrypt_chunk(encrypted_messages: List[Optional[str]]) -> List[Optional[str]]:
+    """Decrypts one chunk on the decrypt pool; bodies that are missing or fail verification come back as None."""
+    plaintexts = []
+    for encrypted_message in encrypted_messages:
+        try:
+            plaintexts.append(decrypt_message(encrypted_message))
+        except Exception:
+            plaintexts.append(None)
+    return plaintexts
+
+
+async def decrypt_stored_messages(stored_messages: List[dict]) -> List[Optional[str]]:
+    """Returns the plaintext of each stored message (None if it can't be decrypted).
+
+    Cached bodies are reused; the rest are split into chunks and decrypted in
+    parallel on the decrypt pool.
+    """
+    texts = [decrypted_cache.get(data["id"]) for data in stored_messages]
+    missing = [i for i, text in enumerate(texts) if text is None]
+    if not missing:
+        return texts
+
+    loop = asyncio.get_running_loop()
+    chunks = [missing[i:i + DECRYPT_CHUNK_SIZE] for i in range(0, len(missing), DECRYPT_CHUNK_SIZE)]
+    results = await asyncio.gather(*(
+        loop.run_in_executor(decrypt_pool, decrypt_chunk, [stored_messages[i].get("message") for i in chunk])
+        for chunk in chunks
+    ))
+
+    for chunk, plaintexts in zip(chunks, results):
+        for i, text in zip(chunk, plaintexts):
+            if text is not None:
+                texts[i] = text
+                decrypted_cache.set(stored_messages[i]["id"], text)
+    return texts
+
+
+async def format_history(stored_messages: List[dict]) -> List[dict]:
+    """Decrypts stored message documents into the shape the frontend renders."""
+    texts = await decrypt_stored_messages(stored_messages)
     messages = []
-    
-    # Get messages where user_id sent to contact_id
-    sent_query = db.collection("messages").where("sender", "==", user_id).where("receiver", "==", contact_id)
-    
-    # Get messages where contact_id sent to user_id
-    received_query = db.collection("messages").where("sender", "==", contact_id).where("receiver", "==", user_id)
-    
-    if limit:
-        sent_query = sent_query.limit(limit)
-        received_query = received_query.limit(limit)
-    
-    # Process sent messages
-    for msg in sent_query.stream():
-        data = msg.to_dict()
+    for data, text in zip(stored_messages, texts):
+        if text is None:
+            print(f"Error processing message:/decripting {data['id']}")
+            continue
         try:
             message = {
+                "id": data["id"],
                 "sender": data["sender"],
-                "receiver": data["receiver"],
-                "text": decrypt_message(data["message"]),
+                "text": text,
                 "timestamp": data["timestamp"],
                 "type": data.get("type", "text")  # Default to text if not specified
             }
-            
+            if "receiver" in data:
+                message["receiver"] = data["receiver"]
+            if "group_id" in data:
+                message["group_id"] = data["group_id"]
+
             # Add file metadata if present
             if "file_url" in data:
                 message.update({
@@ -525,45 +833,259 @@ async def get_messages(user_id: str, contact_id: str, request: Request, limit: O
                     "file_type": data["file_type"],
                     "file_size": data["file_size"]
                 })
-                
+
             messages.append(message)
         except Exception as e:
             print(f"Error processing message:/decripting {e}")
-    
-    # Process received messages
-    for msg in received_query.stream():
-        data = msg.to_dict()
-        try:
-            message = {
-                "sender": data["sender"],
-                "receiver": data["receiver"],
-                "text": decrypt_message(data["message"]),
-                "timestamp": data["timestamp"],
-                "type": data.get("type", "text")  # Default to text if not specified
-            }
-            
-            # Add file metadata if present
-            if "file_url" in data:
-                message.update({
-                    "file_url": data["file_url"],
-                    "file_type": data["file_type"],
-                    "file_size": data["file_size"]
-                })
-                
-            messages.append(message)
-        except Exception as e:
-            print(f"Error processing message: /decripting {e}")
-    
-    # Sort messages by timestamp (newest first)
-    messages.sort(key=lambda x: x["timestamp"] if x["timestamp"] else datetime.min, reverse=True)
-    
-    # Limit the total number of messages if requested
-    if limit and len(messages) > limit:
-        messages = messages[:limit]
-        
     return messages
 
 
+async def load_history(kind: str, ids: List[str], limit: Optional[int]) -> List[dict]:
+    """Loads the latest page of a direct or group conversation, newest first."""
+    _, messages = await load_history_page(kind, ids, limit, None, None)
+    return messages
+
+
+async def load_history_page(kind: str, ids: List[str], limit: Optional[int], before: Optional[str],
+                            after: Optional[str]) -> Tuple[List[dict], List[dict]]:
+    """Like load_history, but also returns the stored documents the page was built from (for cursors)."""
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either 'before' or 'after', not both")
+    try:
+        if kind == "dm":
+            stored_messages = await repo.list_direct_messages(ids[0], ids[1], limit, before, after)
+        else:
+            stored_messages = await repo.list_group_messages(ids[0], limit, before, after)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return stored_messages, await format_history(stored_messages)
+
+
+# ✅ Get Messages
+@app.get("/messages/{user_id}/{contact_id}")
+async def get_messages(user_id: str, contact_id: str, request: Request, limit: Optional[int] = None):
+    """Retrieves chat history between two users (newest first; paged by /conversations/{id}/messages)."""
+    # Verify the token from Authorization header
+    token = request.headers.get("Authorization", "").replace("Bearer ", "")
+    if not token or not verify_token(token):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    return await load_history("dm", [user_id, contact_id], limit)
+
+
+async def check_conversation_access(uid: str, conversation_id: str):
+    """Parses a conversation ID and checks uid takes part in it; returns (kind, ids)."""
+    try:
+        kind, ids = parse_conversation_id(conversation_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if kind == "dm":
+        if uid not in ids:
+            raise HTTPException(status_code=403, detail="Not a participant of this conversation")
+    else:
+        members = await repo.get_group_members(ids[0])
+        if members is None:
+            raise HTTPException(status_code=404, detail="Group not found")
+        if uid not in members:
+            raise HTTPException(status_code=403, detail="User is not a member of this group")
+    return kind, ids
+
+
+# Resume limits: conversations looked at per handshake, and messages replayed from the store per conversation
+RESUME_MAX_CONVERSATIONS = int(os.getenv("RESUME_MAX_CONVERSATIONS", "200"))
+REPLAY_STORE_LIMIT = int(os.getenv("REPLAY_STORE_LIMIT", "200"))
+
+
+async def load_missed_frames(conversation_id: str, kind: str, after_seq: int) -> Optional[List[dict]]:
+    """Rebuilds message frames with seq > after_seq from the store; None if more than REPLAY_STORE_LIMIT are missing."""
+    stored_messages = await repo.list_messages_after_seq(conversation_id, after_seq, REPLAY_STORE_LIMIT + 1)
+    if len(stored_messages) > REPLAY_STORE_LIMIT:
+        return None
+
+    frames = []
+    for data, text in zip(stored_messages, await decrypt_stored_messages(stored_messages)):
+        if text is None:
+            continue
+        frame = {
+            "type": "message" if kind == "dm" else "group_message",
+            "id": data["id"],
+            "sender": data["sender"],
+            "text": text,
+            "timestamp": data.get("timestamp"),
+            "conversation_id": conversation_id,
+            "seq": data["seq"]
+        }
+        if kind == "dm":
+            frame["receiver"] = data.get("receiver")
+        else:
+            frame["group_id"] = data.get("group_id")
+        if data.get("client_id"):
+            frame["client_id"] = data["client_id"]
+        if "file_url" in data:
+            frame.update({
+                "file_url": data["file_url"],
+                "file_type": data.get("file_type"),
+                "file_size": data.get("file_size")
+            })
+        frames.append(frame)
+    return frames
+
+
+async def replay_missed_messages(websocket: WebSocket, uid: str, last_seen: dict):
+    """Queues the frames a reconnecting client missed (replay buffer first, then the store, else a "resync")."""
+    replayed = 0
+    for conversation_id, after_seq in list(last_seen.items())[:RESUME_MAX_CONVERSATIONS]:
+        if not isinstance(after_seq, int):
+            continue
+        try:
+            kind, _ = await check_conversation_access(uid, conversation_id)
+        except HTTPException:
+            continue
+
+        latest = await sequencer.current(conversation_id)
+        if latest <= after_seq:
+            continue
+
+        frames = websocket_manager.replay.since(conversation_id, after_seq)
+        if frames is None or (frames[-1]["seq"] if frames else after_seq) < latest:
+            frames = await load_missed_frames(conversation_id, kind, after_seq)
+            if frames is None:
+                websocket_manager.send_to_socket(websocket, {"type": "resync", "conversation_id": conversation_id})
+                continue
+
+        for frame in frames:
+            # Same audience as live delivery: the sender's own messages aren't echoed back
+            if frame["sender"] != uid:
+                websocket_manager.send_to_socket(websocket, {**frame, "replayed": True})
+                replayed += 1
+
+    websocket_manager.send_to_socket(websocket, {"type": "resumed", "replayed": replayed})
+    if replayed:
+        print(f"⏪ Replayed {replayed} missed messages to {uid}")
+
+
+# ✅ Get Conversation List (one summary per chat)
+@app.get("/conversations")
+async def get_conversations(request: Request):
+    """Returns the caller's chats with their last message and unread count, most recent first."""
+    token = request.headers.get("Authorization", "").replace("Bearer ", "")
+    uid = verify_token(token)
+    if not token or not uid:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    user_data, markers = await asyncio.gather(repo.get_user(uid), repo.list_conversation_markers(uid))
+    if user_data is None:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    read_counts = {marker["conversation_id"]: marker.get("read_count", 0) for marker in markers}
+    # Direct chats come from the read markers, groups from the user's group list (left groups drop out)
+    conversation_ids = [conversation_id for conversation_id in read_counts if conversation_id.startswith("dm:")]
+    conversation_ids += [group_conversation_id(group_id) for group_id in user_data.get("groups", [])]
+    summaries = await repo.get_conversation_summaries(conversation_ids)
+
+    with_messages = [summary for summary in summaries if summary is not None]
+    previews = await decrypt_stored_messages([
+        {"id": summary["last_message_id"], "message": summary.get("last_message")} for summary in with_messages
+    ])
+    preview_by_id = {summary["conversation_id"]: text for summary, text in zip(with_messages, previews)}
+
+    conversations = []
+    for conversation_id, summary in zip(conversation_ids, summaries):
+        kind, ids = parse_conversation_id(conversation_id)
+        conversation = {
+            "conversation_id": conversation_id,
+            "kind": kind,
+            # The other participant for direct chats, the group ID for groups
+            "peer": next((other for other in ids if other != uid), uid) if kind == "dm" else ids[0],
+            "last_message": None,
+            "last_sender": None,
+            "last_type": None,
+            "timestamp": None,
+            "unread": 0
+        }
+        if summary is not None:
+            conversation.update({
+                "last_message": preview_by_id.get(conversation_id),
+                "last_sender": summary.get("last_sender"),
+                "last_type": summary.get("last_type"),
+                "timestamp": summary.get("timestamp"),
+                "unread": max(0, summary.get("message_count", 0) - read_counts.get(conversation_id, 0))
+            })
+        conversations.append(conversation)
+
+    conversations.sort(key=lambda conversation: conversation["timestamp"].timestamp() if conversation["timestamp"] else 0, reverse=True)
+    return {"conversations": conversations}
+
+
+# ✅ Mark Conversation Read
+@app.post("/conversations/{conversation_id}/read")
+async def mark_conversation_read(conversation_id: str, request: Request):
+    """Resets the caller's unread count for a conversation."""
+    token = request.headers.get("Authorization", "").replace("Bearer ", "")
+    uid = verify_token(token)
+    if not token or not uid:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    await check_conversation_access(uid, conversation_id)
+    await message_writer.flush()
+    await repo.mark_conversation_read(uid, conversation_id)
+    return {"conversation_id": conversation_id, "unread": 0}
+
+
+# ✅ Get Conversation History (cursor-paginated)
+@app.get("/conversations/{conversation_id}/messages")
+async def get_conversation_messages(conversation_id: str, request: Request, limit: int = HISTORY_PAGE_SIZE,
+                                    before: Optional[str] = None, after: Optional[str] = None):
+    """Returns one page of a conversation with opaque cursors for older and newer pages.
+
+    conversation_id is "dm:<uid>:<uid>" (UIDs sorted) or "group:<group_id>".
+    """
+    token = request.headers.get("Authorization", "").replace("Bearer ", "")
+    uid = verify_token(token)
+    if not token or not uid:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    kind, ids = await check_conversation_access(uid, conversation_id)
+
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    stored_messages, messages = await load_history_page(kind, ids, limit, before, after)
+
+    # Cursors come from the stored page, so messages that failed to decrypt don't end paging early
+    return {
+        "conversation_id": conversation_id,
+        "messages": messages,
+        # Older page exists only if this one came back full
+        "before": encode_cursor(stored_messages[-1]) if len(stored_messages) == limit else None,
+        "after": encode_cursor(stored_messages[0]) if stored_messages else after
+    }
+
+
+# ✅ Search Messages
+@app.get("/search/messages")
+async def search_messages(q: str, request: Request, conversation_id: Optional[str] = None, limit: int = 20):
+    """Full-text search over the caller's direct and group conversations (newest matches first)."""
+    token = request.headers.get("Authorization", "").replace("Bearer ", "")
+    uid = verify_token(token)
+    if not token or not uid:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    if conversation_id:
+        try:
+            parse_conversation_id(conversation_id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    user_data = await repo.get_user(uid)
+    if user_data is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    group_ids = [group_conversation_id(group_id) for group_id in user_data.get("groups", [])]
+
+    results = await search_index.search(q, uid, group_ids, conversation_id, limit)
+    SEARCHES.inc(kind="messages", source="index")
+    return {"query": q, "results": results}
+
+
 # ✅ Get Contact Requests
 @app.get("/contact_requests/{uid}")
 async def get_contact_requests(uid: str, request: Request):
@@ -574,17 +1096,12 @@ async def get_contact_requests(uid: str, request: Request):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
     # Query requests where user is the receiver and status is pending
-    requests_query = db.collection("contact_requests").where("receiver", "==", uid).where("status", "==", "pending")
-    
-    pending_requests = []
-    for req in requests_query.stream():
-        data = req.to_dict()
-        # Get sender's profile picture
-        sender_ref = db.collection("users").document(data["sender"]).get()
-        if sender_ref.exists:
-            sender_data = sender_ref.to_dict()
-            data["sender_profile_picture_url"] = sender_data.get("profile_picture_url", None)
-        pending_requests.append(data)
+    pending_requests = await repo.list_pending_contact_requests(uid)
+    # Get senders' profile pictures in one batched read
+    sender_profiles = await repo.get_user_profiles(data["sender"] for data in pending_requests)
+    for data, sender_profile in zip(pending_requests, sender_profiles):
+        if sender_profile is not None:
+            data["sender_profile_picture_url"] = sender_profile["profile_picture_url"]
     
     return {"requests": pending_requests}
 
@@ -603,48 +1120,27 @@ async def respond_to_contact_request(request_id: str, response_data: dict, reque
         raise HTTPException(status_code=400, detail="Invalid response. Must be 'accept' or 'decline'")
     
     # Get the request from Firestore
-    req_ref = db.collection("contact_requests").document(request_id)
-    req_doc = req_ref.get()
+    req_data = await repo.get_contact_request(request_id)
     
-    if not req_doc.exists:
+    if req_data is None:
         raise HTTPException(status_code=404, detail="Contact request not found")
     
-    req_data = req_doc.to_dict()
-    
-    # Update request status
-    req_ref.update({"status": response})
-    
-    # If accepted, add contacts to each other's list
-    if response == "accept":
+    if response == "decline":
+        await repo.update_contact_request(request_id, {"status": response})
+    else:
         sender_uid = req_data.get("sender")
         receiver_uid = req_data.get("receiver")
         
-        # Add sender to receiver's contacts
-        receiver_ref = db.collection("users").document(receiver_uid)
-        receiver_doc = receiver_ref.get()
-        if receiver_doc.exists:
-            receiver_data = receiver_doc.to_dict()
-            receiver_contacts = receiver_data.get("contacts", [])
-            if sender_uid not in receiver_contacts:
-                receiver_contacts.append(sender_uid)
-                receiver_ref.update({"contacts": receiver_contacts})
-        
-        # Add receiver to sender's contacts
-        sender_ref = db.collection("users").document(sender_uid)
-        sender_doc = sender_ref.get()
-        if sender_doc.exists:
-            sender_data = sender_doc.to_dict()
-            sender_contacts = sender_data.get("contacts", [])
-            if receiver_uid not in sender_contacts:
-                sender_contacts.append(receiver_uid)
-                sender_ref.update({"contacts": sender_contacts})
+        # Mark the request accepted and add the users to each other's contacts in one commit
+        await repo.accept_contact_request(request_id, sender_uid, receiver_uid)
         
         # Notify the sender that request was accepted
+        receiver_profile = await repo.get_user_profile(receiver_uid) or {}
         await websocket_manager.send_notification(sender_uid, {
             "type": "contact_request_accepted",
             "request_id": request_id,
             "receiver_uid": receiver_uid,
-            "receiver_name": receiver_data.get("name", "Unknown"),
+            "receiver_name": receiver_profile.get("name") or "Unknown",
             "timestamp": datetime.now().isoformat()
         })
     
@@ -668,11 +1164,12 @@ async def create_group(group_data: dict, request: Request):
         raise HTTPException(status_code=400, detail="Group name is required")
 
     # Ensure creator is in members list
+    members = list(dict.fromkeys(members))
     if uid not in members:
         members.append(uid)
 
-    # Create group in Firestore with privacy setting
-    group_ref = db.collection("groups").add({
+    # Create group in Firestore with privacy setting (also adds it to each member's groups list)
+    group_id = await repo.create_group({
         "name": group_name,
         "creator": uid,
         "members": members,
@@ -680,29 +1177,17 @@ async def create_group(group_data: dict, request: Request):
         "created_at": firestore.SERVER_TIMESTAMP
     })
 
-    group_id = group_ref[1].id
-
-    # Add group ID to each member's groups list
+    # Notify members about new group (except creator)
     for member_uid in members:
-        user_ref = db.collection("users").document(member_uid)
-        user_doc = user_ref.get()
-
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            user_groups = user_data.get("groups", [])
-            user_groups.append(group_id)
-            user_ref.update({"groups": user_groups})
-
-            # Notify members about new group (except creator)
-            if member_uid != uid:
-                await websocket_manager.send_notification(member_uid, {
-                    "type": "notification",
-                    "notification_type": "new_group",
-                    "group_id": group_id,
-                    "group_name": group_name,
-                    "creator": uid,
-                    "is_private": is_private
-                })
+        if member_uid != uid:
+            await websocket_manager.send_notification(member_uid, {
+                "type": "notification",
+                "notification_type": "new_group",
+                "group_id": group_id,
+                "group_name": group_name,
+                "creator": uid,
+                "is_private": is_private
+            })
 
     return {"message": "Group created successfully", "group_id": group_id, "is_private": is_private}
 
@@ -715,18 +1200,15 @@ async def get_groups(uid: str, request: Request):
     if not token or not verify_token(token):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    user_ref = db.collection("users").document(uid).get()
-    if not user_ref.exists:
+    user_data = await repo.get_user(uid)
+    if user_data is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    user_data = user_ref.to_dict()
     group_ids = user_data.get("groups", [])
 
     groups = []
-    for group_id in group_ids:
-        group_doc = db.collection("groups").document(group_id).get()
-        if group_doc.exists:
-            group_data = group_doc.to_dict()
+    for group_id, group_data in zip(group_ids, await repo.get_groups(group_ids)):
+        if group_data is not None:
             
             # Ensure members are UIDs, not usernames
             member_uids = group_data.get("members", [])
@@ -759,33 +1241,39 @@ async def send_group_message(group_id: str, message_data: dict, request: Request
         raise HTTPException(status_code=400, detail="Message text is required")
     
     # Check if group exists and user is a member
-    group_ref = db.collection("groups").document(group_id).get()
+    members = await repo.get_group_members(group_id)
     
-    if not group_ref.exists:
+    if members is None:
         raise HTTPException(status_code=404, detail="Group not found")
     
-    group_data = group_ref.to_dict()
-    members = group_data.get("members", [])
-    
     if sender_uid not in members:
         raise HTTPException(status_code=403, detail="User is not a member of this group")
     
     # Encrypt message text
     encrypted_text = encrypt_message(text)
     
-    # Store message in Firestore
-    message_ref = db.collection("group_messages").add({
+    # Store message in Firestore (joins the next batched commit)
+    conversation_id = group_conversation_id(group_id)
+    stored_message = {
         "group_id": group_id,
         "sender": sender_uid,
         "message": encrypted_text,
+        "seq": await sequencer.next(conversation_id),
         "timestamp": firestore.SERVER_TIMESTAMP
-    })
+    }
+    message_id = repo.new_document_id("group_messages")
+    durable = message_writer.write_with_id("group_messages", message_id, stored_message, repo.conversation_summary_writes(
+        conversation_id, message_id, stored_message
+    ))
+    decrypted_cache.set(message_id, text)
+    index_when_durable(durable, message_id, conversation_id, sender_uid, None, text)
+    await durable
     
     # Send message to all online group members except sender
     await websocket_manager.send_group_message(
         group_id=group_id,
         sender_uid=sender_uid,
-        text=text,
+        message_data={"id": message_id, "text": text, "conversation_id": conversation_id, "seq": stored_message["seq"]},
         members=members
     )
     
@@ -795,7 +1283,7 @@ async def send_group_message(group_id: str, message_data: dict, request: Request
 # ✅ Get Group Messages
 @app.get("/groups/{group_id}/messages")
 async def get_group_messages(group_id: str, request: Request, limit: Optional[int] = None):
-    """Retrieves messages from a group chat."""
+    """Retrieves messages from a group chat (newest first; paged by /conversations/{id}/messages)."""
     # Verify the token from Authorization header
     token = request.headers.get("Authorization", "").replace("Bearer ", "")
     uid = verify_token(token)
@@ -803,48 +1291,17 @@ async def get_group_messages(group_id: str, request: Request, limit: Optional[in
         raise HTTPException(status_code=401, detail="Unauthorized")
 
     # Check if group exists and user is a member
-    group_ref = db.collection("groups").document(group_id).get()
+    members = await repo.get_group_members(group_id)
     
-    if not group_ref.exists:
+    if members is None:
         raise HTTPException(status_code=404, detail="Group not found")
     
-    group_data = group_ref.to_dict()
-    members = group_data.get("members", [])
-    
     if uid not in members:
         raise HTTPException(status_code=403, detail="User is not a member of this group")
     
-    # Query messages
-    query = db.collection("group_messages").where("group_id", "==", group_id).order_by("timestamp", direction=firestore.Query.DESCENDING)
-    
-    if limit:
-        query = query.limit(limit)
-    
-    messages = []
-    for msg in query.stream():
-        data = msg.to_dict()
-        try:
-            message = {
-                "group_id": data["group_id"],
-                "sender": data["sender"],
-                "text": decrypt_message(data["message"]),
-                "timestamp": data["timestamp"],
-                "type": data.get("type", "text")  # Default to text if not specified
-            }
-            
-            # Add file metadata if present
-            if "file_url" in data:
-                message.update({
-                    "file_url": data["file_url"],
-                    "file_type": data["file_type"],
-                    "file_size": data["file_size"]
-                })
-                
-            messages.append(message)
-        except Exception as e:
-            print(f"Error processing message: {e}")
-    
-    return messages
+    return await load_history("group", [group_id], limit)
+
+
 @app.post("/set_username")
 async def set_username(user_data: dict, request: Request):
     """Sets the username for a user after registration."""
@@ -867,13 +1324,13 @@ async def set_username(user_data: dict, request: Request):
         raise HTTPException(status_code=400, detail="Username can only contain letters and numbers")
 
     # Check if username is already taken
-    existing_users = db.collection("users").where("username", "==", username).get()
-    if existing_users:
+    if await repo.username_taken(username):
         raise HTTPException(status_code=400, detail="Username already taken")
 
     # Update the user's document with the username
-    user_ref = db.collection("users").document(uid)
-    user_ref.update({"username": username})
+    await repo.update_user(uid, {"username": username})
+    profile = await repo.get_user_profile(uid)
+    username_index.upsert({**(profile or {}), "uid": uid, "username": username})
 
     return {"message": "Username set successfully"}
 # ✅ Update User Name
@@ -893,8 +1350,8 @@ async def update_user_name(user_data: dict, request: Request):
     
     try:
         # Update the user's document with the new name
-        user_ref = db.collection("users").document(uid)
-        user_ref.update({"name": new_name})
+        await repo.update_user(uid, {"name": new_name})
+        username_index.update_profile(uid, name=new_name)
         
         # Also update the display name in Firebase Auth
         auth.update_user(uid, display_name=new_name)
@@ -913,14 +1370,16 @@ async def search_users(q: str, request: Request):
     if not q or len(q) < 2:
         return {"users": []}
 
+    # Served from the in-memory index once it has loaded
+    if username_index.ready:
+        SEARCHES.inc(kind="users", source="index")
+        return {"users": username_index.search(q)}
+    SEARCHES.inc(kind="users", source="firestore")
+
     try:
         # Search for users whose name starts with the query (case insensitive)
-        users_ref = db.collection("users")
-        query = users_ref.where("username", ">=", q).where("username", "<=", q + "\uf8ff")
-        
         results = []
-        for doc in query.stream():
-            user_data = doc.to_dict()
+        for user_data in await repo.search_users_by_username(q):
             # Don't return sensitive information
             results.append({
                 "uid": user_data.get("uid"),
@@ -951,8 +1410,6 @@ ALLOWED_FILE_TYPES = {
     "application/x-rar-compressed"
 }
 
-from io import BytesIO  # 🔧 Import nécessaire
-
 @app.post("/upload")
 async def upload_file(
         file: UploadFile = File(...),
@@ -967,20 +1424,6 @@ async def upload_file(
         if not uid:
             raise HTTPException(status_code=401, detail="Invalid token")
 
-        # Check file size
-        file_size = 0
-        file_content = bytearray()
-
-        # Read file in chunks
-        while chunk := await file.read(8192):
-            file_size += len(chunk)
-            if file_size > MAX_FILE_SIZE:
-                raise HTTPException(
-                    status_code=413,
-                    detail=f"File too large. Maximum size is {MAX_FILE_SIZE / (1024 * 1024)}MB"
-                )
-            file_content.extend(chunk)
-
         # Check file type
         content_type = file.content_type
         if content_type not in ALLOWED_FILE_TYPES:
@@ -989,95 +1432,133 @@ async def upload_file(
                 detail=f"Unsupported file type: {content_type}"
             )
 
-        # Generate unique filename
-        file_ext = os.path.splitext(file.filename)[1].lower()
-        unique_filename = f"{uid}_{uuid.uuid4()}{file_ext}"
+        async with upload_slots:
+            return await store_upload(uid, file, content_type)
 
-        try:
-            # Set base upload options
-            upload_options = {
-                "folder": f"chat_files/{uid}",
-                "public_id": os.path.splitext(unique_filename)[0],
-                "overwrite": True
-            }
+    except HTTPException as http_error:
+        raise http_error
+    except Exception as e:
+        print(f"Upload error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-            # Détermine le type de ressource Cloudinary
-            if content_type.startswith('image/'):
-                upload_options["resource_type"] = "image"
-                upload_options.update({
-                    "eager": [
-                        {"width": 800, "height": 800, "crop": "limit", "quality": "auto"},
-                        {"width": 400, "height": 400, "crop": "limit", "quality": "auto"}
-                    ],
-                    "eager_async": True
-                })
-            elif content_type.startswith('video/'):
-                upload_options["resource_type"] = "video"
-                upload_options.update({
-                    "eager": [
-                        {"width": 640, "height": 480, "crop": "limit", "quality": "auto"}
-                    ],
-                    "eager_async": True
-                })
-            else:
-                # PDF, fichiers texte, zip, etc.
-                upload_options["resource_type"] = "raw"
 
-            # ✅ Upload vers Cloudinary
-            upload_result = cloudinary.uploader.upload(BytesIO(file_content), **upload_options)
+async def store_upload(uid: str, file: UploadFile, content_type: str):
+    """Streams one validated upload to Cloudinary and records it (caller holds an upload slot)."""
+    # Check file size and hash the content (read through the spooled body in chunks, never held in memory)
+    file_size, digest = await measure_upload(file, MAX_FILE_SIZE)
+    UPLOAD_BYTES.inc(file_size)
 
-            if not upload_result or "secure_url" not in upload_result:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Failed to upload file to storage"
-                )
+    # Cloudinary resource type: images and videos get derived versions, everything else (PDF, text, zip...) is raw
+    if content_type.startswith('image/'):
+        resource_type = "image"
+    elif content_type.startswith('video/'):
+        resource_type = "video"
+    else:
+        resource_type = "raw"
+
+    # Same content already stored by this user (e.g. a forwarded file): reuse it instead of uploading again
+    stored = await repo.get_upload_by_hash(uid, resource_type, digest)
+    if stored:
+        UPLOADS.inc(result="deduplicated")
+        await repo.add_upload({
+            "uid": uid,
+            "filename": file.filename,
+            "file_url": stored["file_url"],
+            "file_type": content_type,
+            "file_size": file_size,
+            "sha256": digest,
+            "timestamp": firestore.SERVER_TIMESTAMP
+        })
+        return {
+            "success": True,
+            "file_url": stored["file_url"],
+            "file_type": content_type,
+            "file_size": file_size
+        }
+
+    # Generate unique filename
+    file_ext = os.path.splitext(file.filename)[1].lower()
+    unique_filename = f"{uid}_{uuid.uuid4()}{file_ext}"
+
+    try:
+        # Set base upload options
+        upload_options = {
+            "folder": f"chat_files/{uid}",
+            "public_id": os.path.splitext(unique_filename)[0],
+            "overwrite": True,
+            "resource_type": resource_type
+        }
 
-            # 🔥 Enregistrer dans Firestore
-            db.collection("uploads").add({
-                "uid": uid,
-                "filename": file.filename,
-                "file_url": upload_result["secure_url"],
-                "file_type": content_type,
-                "file_size": file_size,
-                "timestamp": firestore.SERVER_TIMESTAMP
+        if resource_type == "image":
+            upload_options.update({
+                "eager": [
+                    {"width": 800, "height": 800, "crop": "limit", "quality": "auto"},
+                    {"width": 400, "height": 400, "crop": "limit", "quality": "auto"}
+                ],
+                "eager_async": True
+            })
+        elif resource_type == "video":
+            upload_options.update({
+                "eager": [
+                    {"width": 640, "height": 480, "crop": "limit", "quality": "auto"}
+                ],
+                "eager_async": True
             })
 
-            return {
-                "success": True,
-                "file_url": upload_result["secure_url"],
-                "file_type": content_type,
-                "file_size": file_size
-            }
+        # ✅ Upload vers Cloudinary
+        upload_result = await push_to_storage(file, **upload_options)
 
-        except Exception as upload_error:
-            print(f"Cloudinary upload error: {str(upload_error)}")
+        if not upload_result or "secure_url" not in upload_result:
             raise HTTPException(
                 status_code=500,
-                detail="Failed to upload file to storage service"
+                detail="Failed to upload file to storage"
             )
 
-    except HTTPException as http_error:
-        raise http_error
-    except Exception as e:
-        print(f"Upload error: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        # 🔥 Enregistrer dans Firestore
+        await repo.add_upload({
+            "uid": uid,
+            "filename": file.filename,
+            "file_url": upload_result["secure_url"],
+            "file_type": content_type,
+            "file_size": file_size,
+            "sha256": digest,
+            "timestamp": firestore.SERVER_TIMESTAMP
+        })
+        await repo.add_upload_hash(uid, resource_type, digest, {
+            "file_url": upload_result["secure_url"],
+            "file_type": content_type,
+            "file_size": file_size,
+            "timestamp": firestore.SERVER_TIMESTAMP
+        })
+        UPLOADS.inc(result="stored")
+
+        return {
+            "success": True,
+            "file_url": upload_result["secure_url"],
+            "file_type": content_type,
+            "file_size": file_size
+        }
+
+    except Exception as upload_error:
+        print(f"Cloudinary upload error: {str(upload_error)}")
+        UPLOADS.inc(result="failed")
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to upload file to storage service"
+        )
+
 
 # Get_uploads
 @app.get("/uploads/{uid}")
 async def get_uploads(uid: str, request: Request):
     """Retrieve all files uploaded by a specific user."""
     token = request.headers.get("Authorization", "").replace("Bearer ", "")
-    if not token or not auth.verify_id_token(token):
+    if not token or not verify_token(token):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
     try:
-        db = firestore.client()
-        uploads = db.collection("uploads").where("uid", "==", uid).order_by("timestamp", direction=firestore.Query.DESCENDING).stream()
-
-
         results = []
-        for doc in uploads:
-            data = doc.to_dict()
+        for data in await repo.list_uploads(uid):
             results.append({
                 "filename": data.get("filename"),
                 "file_url": data.get("file_url"),
@@ -1098,26 +1579,15 @@ async def get_group_details(group_id: str, request: Request):
     if not token or not uid:
         raise HTTPException(status_code=401, detail="Unauthorized")
     
-    group_ref = db.collection("groups").document(group_id).get()
-    if not group_ref.exists:
+    group_data = await repo.get_group(group_id)
+    if group_data is None:
         raise HTTPException(status_code=404, detail="Group not found")
     
-    group_data = group_ref.to_dict()
     if uid not in group_data.get("members", []):
         raise HTTPException(status_code=403, detail="Not a group member")
     
     # Get member details with profile pictures
-    members_info = []
-    for member_uid in group_data["members"]:
-        user_doc = db.collection("users").document(member_uid).get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            members_info.append({
-                "uid": member_uid,
-                "name": user_data.get("name"),
-                "username": user_data.get("username", ""),
-                "profile_picture_url": user_data.get("profile_picture_url", None)  # Add profile picture
-            })
+    members_info = [profile for profile in await repo.get_user_profiles(group_data["members"]) if profile is not None]
     
     return {
         "id": group_id,
@@ -1140,58 +1610,40 @@ async def add_group_members(group_id: str, member_data: dict, request: Request):
         raise HTTPException(status_code=400, detail="No members provided")
     
     # Verify group exists and user is the creator
-    group_ref = db.collection("groups").document(group_id)
-    group_doc = group_ref.get()
+    group_data = await repo.get_group(group_id)
     
-    if not group_doc.exists:
+    if group_data is None:
         raise HTTPException(status_code=404, detail="Group not found")
     
-    group_data = group_doc.to_dict()
     if group_data["creator"] != uid:
         raise HTTPException(status_code=403, detail="Only group creator can add members")
     
-    # Get current members
+    # Members not already in the group
     current_members = group_data.get("members", [])
-    added_members = []
+    added_members = [member_uid for member_uid in dict.fromkeys(new_members) if member_uid not in current_members]
     
-    # Add new members
-    for member_uid in new_members:
-        if member_uid not in current_members:
-            current_members.append(member_uid)
-            added_members.append(member_uid)
+    # Add them to the group and the group to their groups lists in one commit
+    if added_members:
+        await repo.add_group_members(group_id, added_members)
     
-    # Update group
-    group_ref.update({"members": current_members})
+    # Get updated group data (includes members added concurrently by others)
+    updated_group_data = await repo.get_group(group_id) or {**group_data, "members": current_members + added_members}
     
-    # Get updated group data
-    updated_group_data = group_ref.get().to_dict()
-    
-    # Add group to new members' groups list
+    # Notify new members
     for member_uid in added_members:
-        user_ref = db.collection("users").document(member_uid)
-        user_doc = user_ref.get()
-        
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            user_groups = user_data.get("groups", [])
-            if group_id not in user_groups:
-                user_groups.append(group_id)
-                user_ref.update({"groups": user_groups})
-            
-            # Notify new members
-            await websocket_manager.send_notification(member_uid, {
-                "type": "notification",
-                "notification_type": "added_to_group",
-                "group_id": group_id,
-                "group_name": group_data["name"],
-                "adder_uid": uid
-            })
+        await websocket_manager.send_notification(member_uid, {
+            "type": "notification",
+            "notification_type": "added_to_group",
+            "group_id": group_id,
+            "group_name": group_data["name"],
+            "adder_uid": uid
+        })
     
     # Send group update to ALL members (including existing ones)
     await websocket_manager.send_group_update(
         group_id=group_id,
         group_data=updated_group_data,
-        members=current_members
+        members=updated_group_data.get("members", [])
     )
     
     return {"message": "Members added successfully", "added_members": added_members}
@@ -1205,13 +1657,11 @@ async def remove_group_member(group_id: str, member_uid: str, request: Request):
         raise HTTPException(status_code=401, detail="Unauthorized")
     
     # Verify group exists and user is the creator
-    group_ref = db.collection("groups").document(group_id)
-    group_doc = group_ref.get()
+    group_data = await repo.get_group(group_id)
     
-    if not group_doc.exists:
+    if group_data is None:
         raise HTTPException(status_code=404, detail="Group not found")
     
-    group_data = group_doc.to_dict()
     if group_data["creator"] != uid:
         raise HTTPException(status_code=403, detail="Only group creator can remove members")
     
@@ -1223,27 +1673,16 @@ async def remove_group_member(group_id: str, member_uid: str, request: Request):
     if member_uid not in current_members:
         raise HTTPException(status_code=400, detail="User is not a group member")
     
-    current_members.remove(member_uid)
-    group_ref.update({"members": current_members})
-    
-    # Remove group from member's groups list
-    user_ref = db.collection("users").document(member_uid)
-    user_doc = user_ref.get()
+    # Remove member from group and group from member's groups list in one commit
+    await repo.remove_group_member(group_id, member_uid)
     
-    if user_doc.exists:
-        user_data = user_doc.to_dict()
-        user_groups = user_data.get("groups", [])
-        if group_id in user_groups:
-            user_groups.remove(group_id)
-            user_ref.update({"groups": user_groups})
-        
-        # Notify removed member
-        await websocket_manager.send_notification(member_uid, {
-            "type": "notification",
-            "notification_type": "removed_from_group",
-            "group_id": group_id,
-            "group_name": group_data["name"]
-        })
+    # Notify removed member
+    await websocket_manager.send_notification(member_uid, {
+        "type": "notification",
+        "notification_type": "removed_from_group",
+        "group_id": group_id,
+        "group_name": group_data["name"]
+    })
     
     return {"message": "Member removed successfully"}
 @app.get("/user_details/{uid}")
@@ -1253,20 +1692,18 @@ async def get_user_details(uid: str, request: Request):
     if not token or not verify_token(token):
         raise HTTPException(status_code=401, detail="Unauthorized")
     
-    user_ref = db.collection("users").document(uid).get()
-    if not user_ref.exists:
+    user_profile = await repo.get_user_profile(uid)
+    if user_profile is None:
         raise HTTPException(status_code=404, detail="User not found")
     
-    user_data = user_ref.to_dict()
-    return {
-        "uid": uid,
-        "name": user_data.get("name"),
-        "username": user_data.get("username", ""),
-        "profile_picture_url": user_data.get("profile_picture_url", None)  # Add profile picture
-    }
-@app.delete("/groups/{group_id}")
+    return user_profile
+@app.delete("/groups/{group_id}", status_code=202)
 async def delete_group(group_id: str, request: Request):
-    """Deletes a group (creator only)."""
+    """Deletes a group (creator only).
+
+    The group disappears for its members right away; its messages and
+    requests are removed by a background job (see GET /groups/{group_id}/deletion).
+    """
     # Verify the token from Authorization header
     token = request.headers.get("Authorization", "").replace("Bearer ", "")
     uid = verify_token(token)
@@ -1274,44 +1711,49 @@ async def delete_group(group_id: str, request: Request):
         raise HTTPException(status_code=401, detail="Unauthorized")
     
     # Get group data
-    group_ref = db.collection("groups").document(group_id)
-    group_doc = group_ref.get()
+    group_data = await repo.get_group(group_id)
     
-    if not group_doc.exists:
+    if group_data is None:
         raise HTTPException(status_code=404, detail="Group not found")
     
-    group_data = group_doc.to_dict()
     
     # Verify user is the creator
     if group_data["creator"] != uid:
         raise HTTPException(status_code=403, detail="Only group creator can delete the group")
     
     try:
-        # Delete group messages first
-        messages_query = db.collection("group_messages").where("group_id", "==", group_id)
-        for message in messages_query.stream():
-            message.reference.delete()
-        
-        # Remove group from all members' groups list
-        for member_uid in group_data.get("members", []):
-            user_ref = db.collection("users").document(member_uid)
-            user_doc = user_ref.get()
-            
-            if user_doc.exists:
-                user_data = user_doc.to_dict()
-                user_groups = user_data.get("groups", [])
-                if group_id in user_groups:
-                    user_groups.remove(group_id)
-                    user_ref.update({"groups": user_groups})
-        
-        # Finally delete the group
-        group_ref.delete()
-        
-        return {"message": "Group deleted successfully"}
+        job = await group_deletions.enqueue(group_id, group_data.get("members", []), uid)
+        return {"message": "Group deletion started", "group_id": group_id, "status": job["status"]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/groups/{group_id}/deletion")
+async def get_group_deletion(group_id: str, request: Request):
+    """Reports the progress of a group deletion (to the user who requested it)."""
+    token = request.headers.get("Authorization", "").replace("Bearer ", "")
+    uid = verify_token(token)
+    if not token or not uid:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    job = await repo.get_group_deletion(group_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No deletion for this group")
+    if job.get("requested_by") != uid:
+        raise HTTPException(status_code=403, detail="Only the user who deleted the group can see its progress")
+
+    return {
+        "group_id": group_id,
+        "status": job.get("status"),
+        "phase": job.get("phase"),
+        "deleted_messages": job.get("deleted_messages", 0),
+        "deleted_add_requests": job.get("deleted_add_requests", 0),
+        "started_at": job.get("started_at"),
+        "updated_at": job.get("updated_at"),
+        "finished_at": job.get("finished_at")
+    }
+
+
 @app.post("/upload_profile_picture")
 async def upload_profile_picture(
     file: UploadFile = File(...),
@@ -1330,16 +1772,19 @@ async def upload_profile_picture(
         if file.content_type not in ["image/jpeg", "image/png", "image/gif", "image/webp"]:
             raise HTTPException(status_code=400, detail="File must be an image (JPEG, PNG, GIF, or WEBP)")
 
-        # Upload to Cloudinary with user-specific folder
-        upload_result = cloudinary.uploader.upload(
-            file.file,
-            folder=f"profile_pictures/{uid}",
-            transformation=[
-                {"width": 300, "height": 300, "crop": "fill"},
-                {"quality": "auto"},
-                {"fetch_format": "auto"}
-            ]
-        )
+        # Upload to Cloudinary with user-specific folder (streamed in chunks off the event loop)
+        async with upload_slots:
+            await measure_upload(file, MAX_FILE_SIZE)  # enforces the size limit
+            upload_result = await push_to_storage(
+                file,
+                folder=f"profile_pictures/{uid}",
+                resource_type="image",
+                transformation=[
+                    {"width": 300, "height": 300, "crop": "fill"},
+                    {"quality": "auto"},
+                    {"fetch_format": "auto"}
+                ]
+            )
 
         # Get secure URL
         profile_picture_url = upload_result.get("secure_url")
@@ -1348,9 +1793,10 @@ async def upload_profile_picture(
         # ✅ Update Firebase Auth (like display_name)
         auth.update_user(uid, photo_url=profile_picture_url)  # Critical fix
         # Update user record
-        db.collection("users").document(uid).update({
+        await repo.update_user(uid, {
             "profile_picture_url": profile_picture_url
         })
+        username_index.update_profile(uid, profile_picture_url=profile_picture_url)
 
         # Notify client
         await websocket_manager.send_profile_picture_update(uid, profile_picture_url)
@@ -1377,13 +1823,12 @@ async def get_profile_picture(authorization: str = Header(None)):
         if not uid:
             raise HTTPException(status_code=401, detail="Invalid token")
 
-        user_ref = db.collection("users").document(uid)
-        user_doc = user_ref.get()
+        user_profile = await repo.get_user_profile(uid)
 
-        if not user_doc.exists:
+        if user_profile is None:
             raise HTTPException(status_code=404, detail="User not found")
 
-        profile_picture_url = user_doc.to_dict().get("profile_picture_url")
+        profile_picture_url = user_profile["profile_picture_url"]
 
         if not profile_picture_url:
             return {"success": True, "message": "No profile picture set yet", "profile_picture_url": None}
@@ -1402,17 +1847,7 @@ async def batch_user_details(uids: List[str], request: Request):
     if not token or not verify_token(token):
         raise HTTPException(status_code=401, detail="Unauthorized")
     
-    users = []
-    for uid in uids:
-        user_ref = db.collection("users").document(uid).get()
-        if user_ref.exists:
-            user_data = user_ref.to_dict()
-            users.append({
-                "uid": uid,
-                "name": user_data.get("name"),
-                "username": user_data.get("username", ""),
-                "profile_picture_url": user_data.get("profile_picture_url", None)
-            })
+    users = [profile for profile in await repo.get_user_profiles(uids) if profile is not None]
     
     return {"users": users}
 
@@ -1428,11 +1863,9 @@ async def request_add_member(group_id: str, request_data: dict, request: Request
     if not new_member_uid:
         raise HTTPException(status_code=400, detail="No new member UID provided")
 
-    group_ref = db.collection("groups").document(group_id)
-    group_doc = group_ref.get()
-    if not group_doc.exists:
+    group_data = await repo.get_group(group_id)
+    if group_data is None:
         raise HTTPException(status_code=404, detail="Group not found")
-    group_data = group_doc.to_dict()
     if requester_uid not in group_data.get("members", []):
         raise HTTPException(status_code=403, detail="Only group members can request to add members")
     if not group_data.get("is_private", False):
@@ -1441,12 +1874,10 @@ async def request_add_member(group_id: str, request_data: dict, request: Request
         raise HTTPException(status_code=400, detail="User is already a member")
 
     # Store request in subcollection
-    add_requests_ref = group_ref.collection("add_requests")
     # Prevent duplicate requests
-    existing = add_requests_ref.where("new_member_uid", "==", new_member_uid).where("status", "==", "pending").get()
-    if existing:
+    if await repo.has_pending_add_request(group_id, new_member_uid):
         raise HTTPException(status_code=400, detail="A pending request for this user already exists")
-    add_requests_ref.add({
+    await repo.create_add_request(group_id, {
         "requester_uid": requester_uid,
         "new_member_uid": new_member_uid,
         "status": "pending",
@@ -1461,19 +1892,12 @@ async def list_add_requests(group_id: str, request: Request):
     owner_uid = verify_token(token)
     if not token or not owner_uid:
         raise HTTPException(status_code=401, detail="Unauthorized")
-    group_ref = db.collection("groups").document(group_id)
-    group_doc = group_ref.get()
-    if not group_doc.exists:
+    group_data = await repo.get_group(group_id)
+    if group_data is None:
         raise HTTPException(status_code=404, detail="Group not found")
-    group_data = group_doc.to_dict()
     if group_data["creator"] != owner_uid:
         raise HTTPException(status_code=403, detail="Only the group owner can view requests")
-    add_requests_ref = group_ref.collection("add_requests")
-    requests = []
-    for req in add_requests_ref.where("status", "==", "pending").stream():
-        data = req.to_dict()
-        data["id"] = req.id
-        requests.append(data)
+    requests = await repo.list_pending_add_requests(group_id)
     return {"requests": requests}
 
 @app.post("/groups/{group_id}/add_requests/{request_id}/respond")
@@ -1483,52 +1907,44 @@ async def respond_add_request(group_id: str, request_id: str, response_data: dic
     owner_uid = verify_token(token)
     if not token or not owner_uid:
         raise HTTPException(status_code=401, detail="Unauthorized")
-    group_ref = db.collection("groups").document(group_id)
-    group_doc = group_ref.get()
-    if not group_doc.exists:
+    group_data = await repo.get_group(group_id)
+    if group_data is None:
         raise HTTPException(status_code=404, detail="Group not found")
-    group_data = group_doc.to_dict()
     if group_data["creator"] != owner_uid:
         raise HTTPException(status_code=403, detail="Only the group owner can respond to requests")
-    add_requests_ref = group_ref.collection("add_requests")
-    req_doc = add_requests_ref.document(request_id).get()
-    if not req_doc.exists:
+    req_data = await repo.get_add_request(group_id, request_id)
+    if req_data is None:
         raise HTTPException(status_code=404, detail="Request not found")
-    req_data = req_doc.to_dict()
     if req_data["status"] != "pending":
         raise HTTPException(status_code=400, detail="Request already handled")
     action = response_data.get("action")  # "accept" or "decline"
     if action not in ["accept", "decline"]:
         raise HTTPException(status_code=400, detail="Invalid action")
     if action == "accept":
-        # Add member to group
-        current_members = group_data.get("members", [])
-        if req_data["new_member_uid"] not in current_members:
-            current_members.append(req_data["new_member_uid"])
-            group_ref.update({"members": current_members})
-            # Add group to user's group list
-            user_ref = db.collection("users").document(req_data["new_member_uid"])
-            user_doc = user_ref.get()
-            if user_doc.exists:
-                user_data = user_doc.to_dict()
-                user_groups = user_data.get("groups", [])
-                if group_id not in user_groups:
-                    user_groups.append(group_id)
-                    user_ref.update({"groups": user_groups})
+        # Mark the request accepted, add member to group and group to user's group list, in one commit
+        await repo.accept_add_request(group_id, request_id, req_data["new_member_uid"])
         
         # Get updated group data
-        updated_group_data = group_ref.get().to_dict()
+        updated_group_data = await repo.get_group(group_id) or group_data
         
         # Send update to all members
         await websocket_manager.send_group_update(
             group_id=group_id,
             group_data=updated_group_data,
-            members=current_members
+            members=updated_group_data.get("members", [])
         )
         
-        add_requests_ref.document(request_id).update({"status": "accepted"})
         return {"message": "Member added to group"}
     else:
-        add_requests_ref.document(request_id).update({"status": "declined"})
+        await repo.update_add_request(group_id, request_id, {"status": "declined"})
         return {"message": "Request declined"}
-    
\ No newline at end of file
+    
+
+
+# ✅ Metrics (Prometheus text format)
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    """Exposes this worker's metrics for Prometheus to scrape."""
+    if METRICS_TOKEN and request.headers.get("Authorization", "") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
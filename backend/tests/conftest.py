@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The backend modules are imported as top-level modules, as uvicorn does from this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# encryption refuses to import without a key
+os.environ.setdefault("SECRET_KEY", "test-secret-key-0123")
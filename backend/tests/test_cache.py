@@ -0,0 +1,53 @@
+import cache
+from cache import LRUCache
+
+
+class Clock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_least_recently_used_entry_is_evicted():
+    entries = LRUCache(max_size=2)
+    entries.set("a", 1)
+    entries.set("b", 2)
+    assert entries.get("a") == 1
+    entries.set("c", 3)
+    assert entries.get("b") is None
+    assert entries.get("a") == 1 and entries.get("c") == 3
+    assert entries.stats() == {"size": 2, "max_size": 2, "hits": 3, "misses": 1}
+
+
+def test_ttl_expiry(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "time", clock)
+    entries = LRUCache(ttl=30)
+    entries.set("a", 1)
+    clock.now += 29
+    assert entries.get("a") == 1
+    clock.now += 1
+    assert entries.get("a") is None
+    assert len(entries) == 0
+
+
+def test_explicit_expiry_overrides_ttl(monkeypatch):
+    # verify_token caches a UID until the token's own exp
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "time", clock)
+    entries = LRUCache(ttl=3600)
+    entries.set("token", "uid1", expires_at=clock.now + 60)
+    clock.now += 59
+    assert entries.get("token") == "uid1"
+    clock.now += 1
+    assert entries.get("token") is None
+
+
+def test_invalidate():
+    entries = LRUCache()
+    entries.set("a", 1)
+    entries.invalidate("a")
+    entries.invalidate("missing")
+    assert entries.get("a") is None
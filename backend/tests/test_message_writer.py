@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from message_writer import MessageWriter
+from repository import client_message_id
+
+
+class FakeRepository:
+    """Records each commit_batch call instead of writing to Firestore."""
+
+    def __init__(self, fail_times: int = 0):
+        self.commits = []
+        self.fail_times = fail_times
+
+    async def commit_batch(self, writes):
+        await asyncio.sleep(0)
+        if self.fail_times:
+            self.fail_times -= 1
+            raise RuntimeError("commit failed")
+        self.commits.append(list(writes))
+
+
+def run_with_writer(repo, scenario, **options):
+    async def main():
+        writer = MessageWriter(repo, **options)
+        await writer.start()
+        try:
+            return await scenario(writer)
+        finally:
+            await writer.stop()
+    return asyncio.run(main())
+
+
+def test_concurrent_writes_share_one_commit():
+    repo = FakeRepository()
+
+    async def scenario(writer):
+        futures = [writer.write_with_id("messages", f"m{index}", {"n": index}) for index in range(5)]
+        assert len(writer) == 5
+        return await asyncio.gather(*futures)
+
+    assert run_with_writer(repo, scenario, delay=0.01) == ["m0", "m1", "m2", "m3", "m4"]
+    assert len(repo.commits) == 1
+    assert [doc_id for _, doc_id, _, _ in repo.commits[0]] == ["m0", "m1", "m2", "m3", "m4"]
+
+
+def test_related_writes_stay_with_their_message():
+    repo = FakeRepository()
+
+    async def scenario(writer):
+        related = [("conversation_summaries", "dm:a:b", {"count": 1}, True)]
+        futures = [writer.write_with_id("messages", f"m{index}", {}, related) for index in range(3)]
+        await asyncio.gather(*futures)
+
+    # Two writes per message and three writes per commit: one message per commit
+    run_with_writer(repo, scenario, batch_size=3, delay=0.01)
+    assert [[doc_id for _, doc_id, _, _ in commit] for commit in repo.commits] == [
+        ["m0", "dm:a:b"], ["m1", "dm:a:b"], ["m2", "dm:a:b"]
+    ]
+
+
+def test_failed_commit_fails_its_acks():
+    repo = FakeRepository(fail_times=1)
+
+    async def scenario(writer):
+        first = writer.write_with_id("messages", "m1", {})
+        with pytest.raises(RuntimeError):
+            await first
+        return await writer.write_with_id("messages", "m2", {})
+
+    assert run_with_writer(repo, scenario, delay=0) == "m2"
+    assert [[doc_id for _, doc_id, _, _ in commit] for commit in repo.commits] == [["m2"]]
+
+
+def test_flush_waits_for_queued_writes():
+    repo = FakeRepository()
+
+    async def scenario(writer):
+        durable = writer.write_with_id("messages", "m1", {})
+        await writer.flush()
+        assert durable.done()
+        assert len(writer) == 0
+
+    run_with_writer(repo, scenario, delay=0.01)
+    assert len(repo.commits) == 1
+
+
+def test_stop_commits_pending_writes():
+    repo = FakeRepository()
+
+    async def scenario(writer):
+        writer.write_with_id("messages", "m1", {})
+
+    run_with_writer(repo, scenario, delay=60)
+    assert [[doc_id for _, doc_id, _, _ in commit] for commit in repo.commits] == [["m1"]]
+
+
+def test_resend_with_same_client_id_rewrites_one_document():
+    repo = FakeRepository()
+    message_id = client_message_id("alice", "c-1")
+    assert message_id == client_message_id("alice", "c-1")
+    assert message_id != client_message_id("bob", "c-1")
+
+    async def scenario(writer):
+        # The original and a resend after a dropped ack land on the same document
+        await writer.write_with_id("messages", message_id, {"message": "hi"})
+        await writer.write_with_id("messages", client_message_id("alice", "c-1"), {"message": "hi"})
+
+    run_with_writer(repo, scenario, delay=0)
+    assert {doc_id for commit in repo.commits for _, doc_id, _, _ in commit} == {message_id}
@@ -0,0 +1,106 @@
+import asyncio
+import functools
+
+import outbox
+import websocket_manager
+from outbox import Outbox
+
+
+class StalledSocket:
+    """A client that never reads: send_text blocks until released."""
+
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+        self.release = asyncio.Event()
+
+    async def send_text(self, frame):
+        await self.release.wait()
+        self.sent.append(frame)
+
+    async def close(self, code=None):
+        self.closed_with = code
+
+
+def test_low_priority_frames_dropped_first():
+    async def scenario():
+        failures = []
+        box = Outbox(StalledSocket(), "uid1", lambda box, slow: failures.append(slow),
+                     high_water=4, max_size=8, low_priority_limit=2)
+        await asyncio.sleep(0)  # the writer takes the first frame and blocks on it
+        assert box.enqueue("chat-0")
+        await asyncio.sleep(0)
+        assert box.enqueue("typing-1", low_priority=True)
+        assert box.enqueue("chat-2")
+        # At the low-priority limit: typing is refused, chat still fits
+        assert not box.enqueue("typing-3", low_priority=True)
+        assert box.enqueue("chat-4")
+        assert box.enqueue("chat-5")
+        # Over the high-water mark the queued typing frame makes room for chat
+        assert box.enqueue("chat-6")
+        assert [frame for frame, _ in box._queue] == ["chat-2", "chat-4", "chat-5", "chat-6"]
+        assert box.dropped == 2
+        assert failures == []
+        box.close()
+
+    asyncio.run(scenario())
+
+
+def test_hard_maximum_reports_slow_consumer():
+    async def scenario():
+        failures = []
+        box = Outbox(StalledSocket(), "uid1", lambda box, slow: failures.append(slow),
+                     high_water=2, max_size=3, grace=60)
+        assert box.enqueue("chat-0")
+        await asyncio.sleep(0)  # the writer takes chat-0 and blocks on it
+        for index in range(1, 4):
+            assert box.enqueue(f"chat-{index}")
+        assert failures == []
+        assert not box.enqueue("chat-4")
+        assert failures == [True]
+        assert box.closed and len(box) == 0
+        assert not box.enqueue("chat-5")
+
+    asyncio.run(scenario())
+
+
+def test_grace_period_over_high_water(monkeypatch):
+    async def scenario():
+        now = [100.0]
+        monkeypatch.setattr(outbox.time, "monotonic", lambda: now[0])
+        failures = []
+        box = Outbox(StalledSocket(), "uid1", lambda box, slow: failures.append(slow),
+                     high_water=2, max_size=100, grace=10)
+        for index in range(3):
+            assert box.enqueue(f"chat-{index}")
+        now[0] += 5
+        assert box.enqueue("chat-3")
+        assert failures == []
+        now[0] += 6
+        assert not box.enqueue("chat-4")
+        assert failures == [True]
+
+    asyncio.run(scenario())
+
+
+def test_slow_consumer_closed_with_1013(monkeypatch):
+    monkeypatch.setattr(websocket_manager, "Outbox", functools.partial(Outbox, high_water=2, max_size=3))
+
+    async def scenario():
+        manager = websocket_manager.WebSocketManager()
+        slow, healthy = StalledSocket(), StalledSocket()
+        healthy.release.set()
+        await manager.connect(slow, "slow")
+        await manager.connect(healthy, "healthy")
+        for index in range(6):
+            await manager.deliver_local(["slow", "healthy"], f'{{"type":"message","n":{index}}}')
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.01)
+
+        assert slow.closed_with == websocket_manager.SLOW_CONSUMER_CLOSE_CODE
+        assert "slow" not in manager.active_connections
+        assert slow not in manager.outboxes
+        assert len(healthy.sent) == 6
+        assert "healthy" in manager.active_connections
+
+    asyncio.run(scenario())
@@ -0,0 +1,74 @@
+import asyncio
+
+from repository import FirestoreRepository
+
+
+class FakeDocument:
+    def __init__(self, store, doc_id):
+        self.store = store
+        self.id = doc_id
+
+    def get(self):
+        return FakeSnapshot(self.id, self.store.get(self.id))
+
+    def update(self, fields):
+        self.store[self.id].update(fields)
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class FakeDb:
+    """Just enough of a Firestore client for users/{uid} reads and updates, counting reads."""
+
+    def __init__(self, users):
+        self.users = users
+        self.reads = 0
+
+    def collection(self, name):
+        assert name == "users"
+        return self
+
+    def document(self, doc_id):
+        self.reads += 1
+        return FakeDocument(self.users, doc_id)
+
+
+def test_profile_cache_is_dropped_on_write():
+    db = FakeDb({"uid1": {"name": "Ada", "username": "ada"}})
+    repo = FirestoreRepository(db)
+    changes = []
+    repo.on_cache_change = lambda name, key: changes.append((name, key))
+
+    async def scenario():
+        assert (await repo.get_user_profile("uid1"))["name"] == "Ada"
+        assert (await repo.get_user_profile("uid1"))["name"] == "Ada"
+        assert db.reads == 1
+
+        await repo.update_user("uid1", {"name": "Ada L."})
+        assert changes == [("profile", "uid1")]
+        assert (await repo.get_user_profile("uid1"))["name"] == "Ada L."
+
+    asyncio.run(scenario())
+
+
+def test_profile_dropped_by_another_worker():
+    db = FakeDb({"uid1": {"name": "Ada", "username": "ada"}})
+    repo = FirestoreRepository(db)
+
+    async def scenario():
+        await repo.get_user_profile("uid1")
+        # Another worker wrote the user and announced it over the bus
+        db.users["uid1"]["name"] = "Ada L."
+        assert (await repo.get_user_profile("uid1"))["name"] == "Ada"
+        repo.drop_cached("profile", "uid1")
+        assert (await repo.get_user_profile("uid1"))["name"] == "Ada L."
+
+    asyncio.run(scenario())
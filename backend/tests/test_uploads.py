@@ -0,0 +1,61 @@
+import asyncio
+import io
+
+import cloudinary.uploader
+import pytest
+from fastapi import UploadFile
+
+import uploads
+
+
+@pytest.fixture
+def sent_parts(monkeypatch):
+    """Records every chunk upload_large() would send to Cloudinary instead of sending it."""
+    parts = []
+
+    def fake_upload_large_part(file, http_headers=None, **options):
+        parts.append({"file": file, "headers": http_headers, "options": options})
+        return {"public_id": "stored", "secure_url": "https://res.example.com/stored"}
+
+    monkeypatch.setattr(cloudinary.uploader, "upload_large_part", fake_upload_large_part)
+    return parts
+
+
+def make_upload(content: bytes, filename: str = "avatar.png") -> UploadFile:
+    return UploadFile(file=io.BytesIO(content), filename=filename)
+
+
+def test_profile_picture_options(sent_parts):
+    upload = make_upload(b"\x89PNG" + b"0" * 100)
+    result = asyncio.run(uploads.push_to_storage(
+        upload,
+        folder="profile_pictures/uid1",
+        resource_type="image",
+        transformation=[{"width": 300, "height": 300, "crop": "fill"}]
+    ))
+
+    assert result["secure_url"] == "https://res.example.com/stored"
+    assert len(sent_parts) == 1
+    options = sent_parts[0]["options"]
+    assert options["resource_type"] == "image"
+    assert options["folder"] == "profile_pictures/uid1"
+    assert options["transformation"] == [{"width": 300, "height": 300, "crop": "fill"}]
+    assert options["filename"] == "avatar.png"
+    assert options["chunk_size"] == uploads.UPLOAD_CHUNK_SIZE
+
+
+def test_resource_type_is_never_raw_by_default(sent_parts):
+    asyncio.run(uploads.push_to_storage(make_upload(b"data", "notes.txt"), folder="chat_files/uid1"))
+
+    assert sent_parts[0]["options"]["resource_type"] == "auto"
+
+
+def test_upload_file_stays_open(sent_parts, monkeypatch):
+    monkeypatch.setattr(uploads, "UPLOAD_CHUNK_SIZE", 4)
+    upload = make_upload(b"0123456789")
+    asyncio.run(uploads.push_to_storage(upload, resource_type="raw"))
+
+    assert [part["file"][1] for part in sent_parts] == [b"0123", b"4567", b"89"]
+    assert not upload.file.closed
+    upload.file.seek(0)
+    assert upload.file.read() == b"0123456789"
@@ -0,0 +1,84 @@
+from typing import Awaitable, Callable, Dict, Set, Tuple
+import asyncio
+import os
+import time
+
+# Forward at most one typing indicator per (sender, target) in this window (seconds).
+# Kept under the 2 s the frontend shows an indicator for, so it stays visible while someone types.
+TYPING_INTERVAL = float(os.getenv("TYPING_INTERVAL", "1.5"))
+# Send an automatic "stopped typing" after this long without a typing frame (seconds)
+TYPING_TIMEOUT = float(os.getenv("TYPING_TIMEOUT", "5"))
+
+# (kind, sender_uid, target) where kind is "dm" (target = receiver UID) or "group" (target = group ID)
+TypingKey = Tuple[str, str, str]
+# forward(kind, sender_uid, target, is_typing)
+ForwardTyping = Callable[[str, str, str, bool], Awaitable[None]]
+
+
+class TypingCoalescer:
+    """Coalesces per-keystroke typing frames into at most one indicator per interval.
+
+    Every typing frame re-arms a stop timer. If no frame arrives before the
+    timeout, recipients get one "stopped typing" indicator. Counters record
+    how many frames were forwarded and how many were suppressed.
+    """
+
+    def __init__(self, forward: ForwardTyping, interval: float = TYPING_INTERVAL, timeout: float = TYPING_TIMEOUT):
+        self.interval = interval
+        self.timeout = timeout
+        self.forwarded = 0
+        self.suppressed = 0
+        self.stops_sent = 0
+        self._forward = forward
+        self._last_forwarded: Dict[TypingKey, float] = {}
+        self._stop_timers: Dict[TypingKey, asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def typing(self, kind: str, sender_uid: str, target: str) -> bool:
+        """Handles one typing frame; returns True if it was forwarded."""
+        key = (kind, sender_uid, target)
+        self._arm_stop_timer(key)
+
+        now = time.monotonic()
+        last = self._last_forwarded.get(key)
+        if last is not None and now - last < self.interval:
+            self.suppressed += 1
+            return False
+
+        self._last_forwarded[key] = now
+        self.forwarded += 1
+        await self._forward(kind, sender_uid, target, True)
+        return True
+
+    async def stop(self, kind: str, sender_uid: str, target: str):
+        """Ends a typing burst right away (e.g. the sender just sent the message)."""
+        key = (kind, sender_uid, target)
+        timer = self._stop_timers.pop(key, None)
+        if timer is None:
+            return
+        timer.cancel()
+        self._last_forwarded.pop(key, None)
+        self.stops_sent += 1
+        await self._forward(kind, sender_uid, target, False)
+
+    def _arm_stop_timer(self, key: TypingKey):
+        timer = self._stop_timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        self._stop_timers[key] = asyncio.get_running_loop().call_later(self.timeout, self._expire, key)
+
+    def _expire(self, key: TypingKey):
+        self._stop_timers.pop(key, None)
+        self._last_forwarded.pop(key, None)
+        self.stops_sent += 1
+        task = asyncio.create_task(self._forward(*key, False))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "forwarded": self.forwarded,
+            "suppressed": self.suppressed,
+            "stops_sent": self.stops_sent,
+            "active": len(self._stop_timers)
+        }
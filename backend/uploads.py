@@ -0,0 +1,68 @@
+from fastapi import HTTPException, UploadFile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Tuple
+import asyncio
+import hashlib
+import os
+import cloudinary.uploader
+
+# Bytes read per step while measuring an upload (the body is already spooled to a temp file by Starlette)
+UPLOAD_READ_SIZE = int(os.getenv("UPLOAD_READ_SIZE", str(64 * 1024)))
+# Size of each part pushed to Cloudinary (its chunked upload API needs at least 5 MB per part)
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(6 * 1024 * 1024)))
+# Uploads processed at once across the worker; further requests wait for a slot
+MAX_CONCURRENT_UPLOADS = int(os.getenv("MAX_CONCURRENT_UPLOADS", "4"))
+
+upload_slots = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+_upload_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS, thread_name_prefix="upload")
+
+
+async def measure_upload(file: UploadFile, max_size: int) -> Tuple[int, str]:
+    """Reads the upload through once, chunk by chunk, and rewinds it.
+
+    Returns its size and the hex SHA-256 of its content. Raises 413 as soon
+    as max_size is exceeded. Nothing is buffered in memory beyond one chunk.
+    """
+    size = 0
+    digest = hashlib.sha256()
+    while chunk := await file.read(UPLOAD_READ_SIZE):
+        size += len(chunk)
+        if size > max_size:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File too large. Maximum size is {max_size / (1024 * 1024)}MB"
+            )
+        digest.update(chunk)
+    await file.seek(0)
+    return size, digest.hexdigest()
+
+
+class _KeepOpen:
+    """Wraps a file so upload_large() (which closes what it uploads) leaves it open for its UploadFile."""
+
+    def __init__(self, file):
+        self._file = file
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+async def push_to_storage(file: UploadFile, **options: Any) -> Dict[str, Any]:
+    """Uploads a (spooled) file to Cloudinary in UPLOAD_CHUNK_SIZE parts on the upload pool.
+
+    Callers should pass resource_type: chunked uploads are stored as "raw"
+    files when it is missing, so "auto" is used in that case.
+    """
+    options.setdefault("filename", file.filename or "upload")
+    options.setdefault("resource_type", "auto")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _upload_executor,
+        lambda: cloudinary.uploader.upload_large(_KeepOpen(file.file), chunk_size=UPLOAD_CHUNK_SIZE, **options)
+    )
@@ -0,0 +1,144 @@
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import os
+
+# Matches returned by /search_users
+SEARCH_USERS_LIMIT = int(os.getenv("SEARCH_USERS_LIMIT", "20"))
+USERNAME_INDEX_LOAD_BATCH = int(os.getenv("USERNAME_INDEX_LOAD_BATCH", "1000"))
+
+# uid -> (username, name, profile_picture_url)
+UserRecord = Tuple[str, Optional[str], Optional[str]]
+
+
+class UsernameIndex:
+    """In-process, case-insensitive username prefix index.
+
+    Lowercased usernames are kept sorted next to their UIDs, so a prefix
+    lookup is one binary search plus a scan of the first k matches. It is
+    filled from Firestore once at startup (searches fall back to Firestore
+    until that finishes) and kept current by the endpoints that change
+    usernames, names and profile pictures. Those changes are reported to
+    on_change so other workers can replay them through apply().
+    """
+
+    def __init__(self):
+        self.ready = False
+        self._keys: List[str] = []
+        self._uids: List[str] = []
+        self._records: Dict[str, UserRecord] = {}
+        # Called with a change made on this worker, in the form apply() takes
+        self.on_change: Optional[Callable[[Dict[str, Any]], None]] = None
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _find(self, key: str, uid: str) -> int:
+        index = bisect_left(self._keys, key)
+        while index < len(self._keys) and self._keys[index] == key:
+            if self._uids[index] == uid:
+                return index
+            index += 1
+        return -1
+
+    def _insert_key(self, key: str, uid: str):
+        if not self.ready:
+            # Still loading: sorted once at the end
+            self._keys.append(key)
+            self._uids.append(uid)
+            return
+        index = bisect_left(self._keys, key)
+        self._keys.insert(index, key)
+        self._uids.insert(index, uid)
+
+    def _remove_key(self, key: str, uid: str):
+        if not self.ready:
+            for index, existing_uid in enumerate(self._uids):
+                if existing_uid == uid and self._keys[index] == key:
+                    del self._keys[index], self._uids[index]
+                    return
+            return
+        index = self._find(key, uid)
+        if index >= 0:
+            del self._keys[index], self._uids[index]
+
+    def _changed(self, change: Dict[str, Any]):
+        if self.on_change is not None:
+            self.on_change(change)
+
+    def apply(self, change: Dict[str, Any]):
+        """Applies a change another worker made ("upsert" or "profile"), without reporting it again."""
+        if change.get("op") == "upsert":
+            self._upsert(change)
+        elif change.get("op") == "profile":
+            self._update_profile(change["uid"], change.get("name"), change.get("profile_picture_url"))
+
+    def upsert(self, user_data: Dict[str, Any]):
+        """Adds or replaces a user (a user document or the same fields)."""
+        if not user_data.get("uid"):
+            return
+        self._upsert(user_data)
+        self._changed({
+            "op": "upsert",
+            "uid": user_data["uid"],
+            "username": user_data.get("username") or "",
+            "name": user_data.get("name"),
+            "profile_picture_url": user_data.get("profile_picture_url")
+        })
+
+    def _upsert(self, user_data: Dict[str, Any]):
+        uid = user_data.get("uid")
+        if not uid:
+            return
+        username = user_data.get("username") or ""
+        previous = self._records.get(uid)
+        if previous is not None and previous[0].lower() != username.lower() and previous[0]:
+            self._remove_key(previous[0].lower(), uid)
+        if username and (previous is None or previous[0].lower() != username.lower()):
+            self._insert_key(username.lower(), uid)
+        self._records[uid] = (username, user_data.get("name"), user_data.get("profile_picture_url"))
+
+    def update_profile(self, uid: str, name: Optional[str] = None, profile_picture_url: Optional[str] = None):
+        """Refreshes the display fields returned with a match."""
+        self._update_profile(uid, name, profile_picture_url)
+        self._changed({"op": "profile", "uid": uid, "name": name, "profile_picture_url": profile_picture_url})
+
+    def _update_profile(self, uid: str, name: Optional[str], profile_picture_url: Optional[str]):
+        record = self._records.get(uid)
+        if record is None:
+            return
+        username, old_name, old_picture = record
+        self._records[uid] = (username, name if name is not None else old_name,
+                              profile_picture_url if profile_picture_url is not None else old_picture)
+
+    async def load(self, repo, batch_size: int = USERNAME_INDEX_LOAD_BATCH):
+        """Fills the index from the users collection; updates made while loading win over loaded data."""
+        loaded = 0
+        async for batch in repo.scan_collection("users", batch_size):
+            for data in batch:
+                data.setdefault("uid", data["id"])
+                if data["uid"] not in self._records:
+                    self._upsert(data)
+            loaded += len(batch)
+
+        order = sorted(range(len(self._keys)), key=self._keys.__getitem__)
+        self._keys = [self._keys[i] for i in order]
+        self._uids = [self._uids[i] for i in order]
+        self.ready = True
+        print(f"🔤 Username index loaded ({loaded} users, {len(self._keys)} usernames)")
+
+    def search(self, prefix: str, limit: int = SEARCH_USERS_LIMIT) -> List[Dict[str, Any]]:
+        """Returns up to limit users whose username starts with prefix (case-insensitive), in username order."""
+        prefix = prefix.lower()
+        results = []
+        index = bisect_left(self._keys, prefix)
+        while index < len(self._keys) and len(results) < limit and self._keys[index].startswith(prefix):
+            uid = self._uids[index]
+            username, name, profile_picture_url = self._records[uid]
+            results.append({
+                "uid": uid,
+                "name": name,
+                "username": username,
+                "profile_picture_url": profile_picture_url
+            })
+            index += 1
+        return results
@@ -1,228 +1,366 @@
 from fastapi import WebSocket
-from typing import Dict, List, Set
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Set
+from connection_state import create_connection_state
+from fanout import FanoutBus, LocalBus
+from outbox import Outbox
+from replay import ReplayBuffer
+from metrics import FANOUT_LATENCY, FANOUT_SIZE, FRAMES_OUT, IDLE_REAPED, frame_type
 import asyncio
+import json
+import os
+import time
+
+# Group fields pushed to clients in group_update frames (same shape as GET /groups/{uid})
+GROUP_UPDATE_FIELDS = ("name", "members", "creator", "is_private")
+
+# Frames that are dropped first when a client falls behind
+LOW_PRIORITY_TYPES = {"typing", "typing_stop", "group_typing", "group_typing_stop", "presence"}
+
+# WebSocket close code sent to clients dropped for not keeping up (1013 = try again later)
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# Heartbeats: every socket is pinged each interval and closed once it has been silent (no frame,
+# pong included) for longer than the idle timeout (seconds)
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "25"))
+IDLE_TIMEOUT = float(os.getenv("IDLE_TIMEOUT", "60"))
+# WebSocket close code sent to connections reaped for not answering pings
+IDLE_CLOSE_CODE = 4008
+PING_FRAME = '{"type":"ping"}'
+
+# Called with (uid, online) when a user's first socket opens or last socket closes, across all workers
+PresenceHandler = Callable[[str, bool], None]
+
+
+def _json_default(value: Any):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_frame(frame: dict) -> str:
+    """Serializes a frame once so the same text can be written to every recipient socket."""
+    return json.dumps(frame, separators=(",", ":"), ensure_ascii=False, default=_json_default)
+
 
 class WebSocketManager:
-    def __init__(self):
+    def __init__(self, bus: Optional[FanoutBus] = None):
         # Change to store multiple connections per user
         self.active_connections: Dict[str, Set[WebSocket]] = {}  # Stores WebSockets by UID
-    
+        # Open sockets across all users, kept in step by connect/disconnect
+        self.socket_count = 0
+        # Each socket has its own bounded send queue and writer task
+        self.outboxes: Dict[WebSocket, Outbox] = {}
+        # Every outbound frame goes through the bus so it reaches users connected to other workers
+        self.bus = bus or LocalBus()
+        self.bus.set_handler(self.deliver_local)
+        # Recent sequenced message frames, replayed to clients that resume after a dropped connection
+        self.replay = ReplayBuffer()
+        # Who is connected on any worker, and frames waiting for users connected nowhere
+        # (both kept in Redis when fan-out goes through it)
+        self.registry, self.offline = create_connection_state(self.bus, self.active_connections)
+        # When each socket last sent us anything (monotonic time), for reaping dead connections
+        self.last_activity: Dict[WebSocket, float] = {}
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._presence_handler: Optional[PresenceHandler] = None
+
+    async def start(self):
+        """Starts the fan-out bus (subscribes to the inter-process channel if any) and the heartbeat."""
+        await self.bus.start()
+        await self.registry.start()
+        await self.offline.start()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self):
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+        await self.offline.stop()
+        await self.registry.stop()
+        await self.bus.stop()
+
+    def set_presence_handler(self, handler: PresenceHandler):
+        self._presence_handler = handler
+
+    def touch(self, websocket: WebSocket):
+        """Records that a socket is alive (called for every frame it sends)."""
+        if websocket in self.last_activity:
+            self.last_activity[websocket] = time.monotonic()
+
+    async def _heartbeat(self):
+        """Pings every socket each interval and reaps the ones silent for longer than IDLE_TIMEOUT."""
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            deadline = time.monotonic() - IDLE_TIMEOUT
+            for websocket, outbox in list(self.outboxes.items()):
+                if self.last_activity.get(websocket, 0) < deadline:
+                    print(f"💤 Reaping idle connection of {outbox.uid}")
+                    IDLE_REAPED.inc()
+                    outbox.close()
+                    asyncio.create_task(self._drop_connection(outbox.uid, websocket, IDLE_CLOSE_CODE))
+                elif outbox.enqueue(PING_FRAME):
+                    FRAMES_OUT.inc(type="ping")
+            try:
+                await self.registry.refresh(list(self.active_connections))
+            except Exception as e:
+                print(f"❌ Failed to refresh connection leases: {e}")
+
     async def connect(self, websocket: WebSocket, uid: str):
         """Adds a new WebSocket connection for a user (allows multiple connections)."""
-        if uid not in self.active_connections:
+        first_socket = uid not in self.active_connections
+        if first_socket:
             self.active_connections[uid] = set()
+        if websocket not in self.active_connections[uid]:
+            self.socket_count += 1
         self.active_connections[uid].add(websocket)
-        print(f"✅ User {uid} connected. Total active connections: {sum(len(v) for v in self.active_connections.values())}")
-    
+        self.outboxes[websocket] = Outbox(websocket, uid, self._on_outbox_failure)
+        self.last_activity[websocket] = time.monotonic()
+        if first_socket:
+            try:
+                first_anywhere = await self.registry.connect(uid)
+                await self._flush_offline(uid, self.outboxes[websocket])
+            except Exception as e:
+                print(f"❌ Failed to register connection of {uid}: {e}")
+                first_anywhere = False
+            if first_anywhere and self._presence_handler:
+                self._presence_handler(uid, True)
+        print(f"✅ User {uid} connected. Total active connections: {self.socket_count}")
+
     async def disconnect(self, uid: str, websocket: WebSocket = None):
         """Removes a specific WebSocket connection or all connections for a user."""
         if uid in self.active_connections:
             if websocket:
-                self.active_connections[uid].discard(websocket)
+                if websocket in self.active_connections[uid]:
+                    self.active_connections[uid].discard(websocket)
+                    self.socket_count -= 1
+                self._close_outbox(websocket)
                 if not self.active_connections[uid]:
                     del self.active_connections[uid]
             else:
-                del self.active_connections[uid]
-        print(f"🔴 User {uid} disconnected. Remaining connections: {sum(len(v) for v in self.active_connections.values())}")
-    
-    async def send_message(self, uid: str, message_data: dict, sender_uid: str):
-        """Sends a message to a specific user if they're online."""
-        if uid in self.active_connections:
-            tasks = []
-            for websocket in list(self.active_connections[uid]):
+                for user_websocket in self.active_connections.pop(uid):
+                    self.socket_count -= 1
+                    self._close_outbox(user_websocket)
+            if uid not in self.active_connections:
                 try:
-                    # Create message with all data
-                    message = {
-                        "type": message_data.get("type", "message"),
-                        "sender": sender_uid,
-                        "receiver": uid,
-                        "text": message_data.get("text"),
-                        "timestamp": message_data.get("timestamp")
-                    }
-
-                    # Only add file data if present
-                    if "file_url" in message_data:
-                        message.update({
-                            "file_url": message_data.get("file_url"),
-                            "file_type": message_data.get("file_type"),
-                            "file_size": message_data.get("file_size")
-                        })
-
-                    tasks.append(websocket.send_json(message))
+                    last_anywhere = await self.registry.disconnect(uid)
                 except Exception as e:
-                    print(f"❌ Error sending message to {uid}: {e}")
-                    await self.disconnect(uid, websocket)
-            
-            if tasks:
-                await asyncio.gather(*tasks, return_exceptions=True)
-                print(f"✉️ Message sent from {sender_uid} to {uid}")
-                return True
+                    print(f"❌ Failed to unregister connection of {uid}: {e}")
+                    last_anywhere = False
+                if last_anywhere and self._presence_handler:
+                    self._presence_handler(uid, False)
+        print(f"🔴 User {uid} disconnected. Remaining connections: {self.socket_count}")
+
+    async def _queue_offline(self, uids: List[str], frame: str):
+        """Queues a frame for the recipients not connected to any worker."""
+        candidates = [uid for uid in uids if uid not in self.active_connections]
+        if not candidates:
+            return
+        connected = await self.registry.connected(candidates)
+        await self.offline.push([uid for uid in candidates if uid not in connected], frame)
+
+    async def _flush_offline(self, uid: str, outbox: Outbox):
+        """Sends everything queued for a user while they were offline as one "offline_batch" frame."""
+        frames = await self.offline.take(uid)
+        if frames:
+            # Frames are already encoded; splice them into the batch without re-serializing
+            if outbox.enqueue('{"type":"offline_batch","frames":[' + ",".join(frames) + "]}"):
+                FRAMES_OUT.inc(type="offline_batch")
+            print(f"📬 Delivered {len(frames)} queued events to {uid}")
+
+    def _close_outbox(self, websocket: WebSocket):
+        self.last_activity.pop(websocket, None)
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox is not None:
+            outbox.close()
+
+    def _on_outbox_failure(self, outbox: Outbox, slow: bool):
+        """Drops a connection whose send failed or that stayed over its queue limit."""
+        if slow:
+            print(f"🐢 Dropping slow consumer {outbox.uid} ({outbox.dropped} frames dropped)")
+        asyncio.create_task(self._drop_connection(outbox.uid, outbox.websocket, SLOW_CONSUMER_CLOSE_CODE if slow else None))
+
+    async def _drop_connection(self, uid: str, websocket: WebSocket, close_code: Optional[int]):
+        await self.disconnect(uid, websocket)
+        if close_code is not None:
+            try:
+                await websocket.close(code=close_code)
+            except Exception:
+                pass
+
+    async def deliver_local(self, uids: Optional[List[str]], frame: str, exclude_uid: str = None,
+                            low_priority: bool = False) -> int:
+        """Queues an encoded frame on this worker's sockets for uids (every connected user if None).
+
+        Returns the number of sockets it was queued for. Queuing never waits on
+        a socket, so one slow client cannot delay the others.
+        """
+        recipients = list(self.active_connections) if uids is None else uids
+        delivered = 0
+        for uid in recipients:
+            if uid == exclude_uid:
+                continue
+            for websocket in self.active_connections.get(uid, ()):
+                outbox = self.outboxes.get(websocket)
+                if outbox is not None and outbox.enqueue(frame, low_priority):
+                    delivered += 1
+        FANOUT_SIZE.observe(delivered)
+        if delivered:
+            FRAMES_OUT.inc(delivered, type=frame_type(frame))
+        return delivered
+
+    def send_to_socket(self, websocket: WebSocket, frame: dict) -> bool:
+        """Queues a frame for one specific local socket (e.g. an ack to the connection that sent a message)."""
+        outbox = self.outboxes.get(websocket)
+        if outbox is not None and outbox.enqueue(encode_frame(frame)):
+            FRAMES_OUT.inc(type=frame.get("type", "other"))
+            return True
         return False
 
-    async def send_typing_indicator(self, uid: str, sender_uid: str):
-        """Sends a typing indicator to a specific user if they're online."""
-        if uid in self.active_connections:
-            tasks = []
-            for websocket in list(self.active_connections[uid]):
-                try:
-                    tasks.append(websocket.send_json({
-                        "type": "typing",
-                        "sender": sender_uid
-                    }))
-                except Exception as e:
-                    print(f"❌ Error sending typing indicator to {uid}: {e}")
-                    await self.disconnect(uid, websocket)
-            
-            if tasks:
-                await asyncio.gather(*tasks, return_exceptions=True)
-                return True
+    async def _publish(self, uids: Optional[List[str]], frame: dict, exclude_uid: str = None) -> bool:
+        """Encodes a frame once and hands it to the bus.
+
+        Returns False only when it is known that nobody received it.
+        """
+        started = time.perf_counter()
+        low_priority = frame.get("type") in LOW_PRIORITY_TYPES
+        text = encode_frame(frame)
+        if uids is not None and not low_priority:
+            try:
+                await self._queue_offline([uid for uid in uids if uid != exclude_uid], text)
+            except Exception as e:
+                print(f"❌ Failed to queue frame for offline users: {e}")
+        delivered = await self.bus.publish(uids, text, exclude_uid, low_priority)
+        FANOUT_LATENCY.observe(time.perf_counter() - started)
+        return delivered is None or delivered > 0
+
+    async def send_message(self, uid: str, message_data: dict, sender_uid: str):
+        """Sends a message to a specific user if they're online."""
+        # Create message with all data
+        message = {
+            "type": message_data.get("type", "message"),
+            "sender": sender_uid,
+            "receiver": uid,
+            "text": message_data.get("text"),
+            "timestamp": message_data.get("timestamp")
+        }
+        self._identify(message, message_data)
+
+        # Only add file data if present
+        if "file_url" in message_data:
+            message.update({
+                "file_url": message_data.get("file_url"),
+                "file_type": message_data.get("file_type"),
+                "file_size": message_data.get("file_size")
+            })
+
+        self._sequence(message, message_data)
+        if await self._publish([uid], message):
+            print(f"✉️ Message sent from {sender_uid} to {uid}")
+            return True
         return False
 
+    def _identify(self, message: dict, message_data: dict):
+        """Copies the stored message ID (and the sender's client_id) so clients can drop redelivered copies."""
+        for field in ("id", "client_id"):
+            if message_data.get(field):
+                message[field] = message_data[field]
+
+    def _sequence(self, message: dict, message_data: dict):
+        """Copies the conversation sequence number onto a frame and keeps the frame for replay."""
+        if message_data.get("seq") is None:
+            return
+        message["conversation_id"] = message_data["conversation_id"]
+        message["seq"] = message_data["seq"]
+        self.replay.record(message["conversation_id"], message["seq"], message)
+
+    async def send_typing_indicator(self, uid: str, sender_uid: str, typing: bool = True):
+        """Sends a typing (or stopped-typing) indicator to a specific user if they're online."""
+        return await self._publish([uid], {
+            "type": "typing" if typing else "typing_stop",
+            "sender": sender_uid
+        })
+
+    async def send_presence(self, uids: List[str], uid: str, online: bool, last_seen: Optional[datetime] = None):
+        """Tells uids (a user's contacts) that the user came online or went offline."""
+        await self._publish(list(uids), {
+            "type": "presence",
+            "uid": uid,
+            "online": online,
+            "last_seen": last_seen
+        })
+
     async def send_notification(self, uid: str, notification_data: dict):
         """Sends a notification to a specific user if they're online."""
-        if uid in self.active_connections:
-            tasks = []
-            for websocket in list(self.active_connections[uid]):
-                try:
-                    tasks.append(websocket.send_json(notification_data))
-                except Exception as e:
-                    print(f"❌ Error sending notification to {uid}: {e}")
-                    await self.disconnect(uid, websocket)
-            
-            if tasks:
-                await asyncio.gather(*tasks, return_exceptions=True)
-                print(f"🔔 Notification sent to {uid}")
-                return True
+        if await self._publish([uid], notification_data):
+            print(f"🔔 Notification sent to {uid}")
+            return True
         return False
-    
+
 
     async def send_group_message(self, group_id: str, sender_uid: str, message_data: dict, members: List[str]):
         """Sends a message to all online members of a group."""
-        tasks = []
-        for member_uid in members:
-            if member_uid != sender_uid and member_uid in self.active_connections:
-                for websocket in list(self.active_connections[member_uid]):
-                    try:
-                        # Create message with all data
-                        message = {
-                            "type": message_data.get("type", "group_message"),
-                            "group_id": group_id,
-                            "sender": sender_uid,
-                            "text": message_data.get("text"),
-                            "timestamp": None
-                        }
-
-                        # Add file data if present
-                        if message_data.get("file_url"):
-                            message.update({
-                                "file_url": message_data.get("file_url"),
-                                "file_type": message_data.get("file_type"),
-                                "file_size": message_data.get("file_size")
-                            })
-
-                        tasks.append(websocket.send_json(message))
-                    except Exception as e:
-                        print(f"❌ Error sending group message to {member_uid}: {e}")
-                        await self.disconnect(member_uid, websocket)
-        
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
-            print(f"✉️ Group message sent to {len(tasks)} members in group {group_id}")
-    
-    async def send_group_typing_indicator(self, group_id: str, sender_uid: str, members: List[str]):
-        """Sends a typing indicator to all group members except sender."""
-        tasks = []
-        for member_uid in members:
-            if member_uid != sender_uid and member_uid in self.active_connections:
-                for websocket in list(self.active_connections[member_uid]):
-                    try:
-                        tasks.append(websocket.send_json({
-                            "type": "group_typing",
-                            "group_id": group_id,
-                            "sender": sender_uid
-                        }))
-                    except Exception as e:
-                        print(f"❌ Error sending group typing indicator to {member_uid}: {e}")
-                        await self.disconnect(member_uid, websocket)
-        
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+        # Create message with all data
+        message = {
+            "type": message_data.get("type", "group_message"),
+            "group_id": group_id,
+            "sender": sender_uid,
+            "text": message_data.get("text"),
+            "timestamp": None
+        }
+        self._identify(message, message_data)
+
+        # Add file data if present
+        if message_data.get("file_url"):
+            message.update({
+                "file_url": message_data.get("file_url"),
+                "file_type": message_data.get("file_type"),
+                "file_size": message_data.get("file_size")
+            })
+
+        self._sequence(message, message_data)
+        recipients = [member_uid for member_uid in members if member_uid != sender_uid]
+        if recipients and await self._publish(recipients, message):
+            print(f"✉️ Group message sent to members of group {group_id}")
+
+    async def send_group_typing_indicator(self, group_id: str, sender_uid: str, members: List[str], typing: bool = True):
+        """Sends a typing (or stopped-typing) indicator to all group members except sender."""
+        recipients = [member_uid for member_uid in members if member_uid != sender_uid]
+        if recipients:
+            await self._publish(recipients, {
+                "type": "group_typing" if typing else "group_typing_stop",
+                "group_id": group_id,
+                "sender": sender_uid
+            })
 
     async def send_group_notification(self, group_id: str, notification_type: str, data: dict, members: List[str], exclude_uid: str = None):
         """Sends group-specific notifications to members."""
-        tasks = []
-        for member_uid in members:
-            if member_uid == exclude_uid:
-                continue
-            if member_uid in self.active_connections:
-                for websocket in list(self.active_connections[member_uid]):
-                    try:
-                        tasks.append(websocket.send_json({
-                            "type": "group_notification",
-                            "group_id": group_id,
-                            "notification_type": notification_type,
-                            **data
-                        }))
-                    except Exception as e:
-                        print(f"❌ Error sending group notification to {member_uid}: {e}")
-                        await self.disconnect(member_uid, websocket)
-        
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)    
-            
+        await self._publish(list(members), {
+            "type": "group_notification",
+            "group_id": group_id,
+            "notification_type": notification_type,
+            **data
+        }, exclude_uid)
+
     async def broadcast(self, message: dict, exclude_uid: str = None):
         """Broadcasts a message to all connected clients, optionally excluding one."""
-        tasks = []
-        for uid, connections in list(self.active_connections.items()):
-            if exclude_uid and uid == exclude_uid:
-                continue
-                
-            for websocket in list(connections):
-                try:
-                    tasks.append(websocket.send_json(message))
-                except Exception as e:
-                    print(f"❌ Error broadcasting to {uid}: {e}")
-                    await self.disconnect(uid, websocket)
-        
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
-    
+        await self._publish(None, message, exclude_uid)
+
 
     async def send_profile_picture_update(self, uid: str, profile_picture_url: str):
         """Notify all connected devices of a user about their profile picture update."""
-        if uid in self.active_connections:
-            tasks = []
-            for websocket in list(self.active_connections[uid]):
-                try:
-                    tasks.append(websocket.send_json({
-                        "type": "profile_picture_update",
-                        "profile_picture_url": profile_picture_url
-                    }))
-                except Exception as e:
-                    print(f"❌ Error sending profile picture update to {uid}: {e}")
-                    await self.disconnect(uid, websocket)
-            
-            if tasks:
-                await asyncio.gather(*tasks, return_exceptions=True)
-                print(f"🖼️ Profile picture update sent to {uid}")
-                return True
+        if await self._publish([uid], {
+            "type": "profile_picture_update",
+            "profile_picture_url": profile_picture_url
+        }):
+            print(f"🖼️ Profile picture update sent to {uid}")
+            return True
         return False
     async def send_group_update(self, group_id: str, group_data: dict, members: List[str]):
         """Sends updated group information to all members."""
-        tasks = []
-        for member_uid in members:
-            if member_uid in self.active_connections:
-                for websocket in list(self.active_connections[member_uid]):
-                    try:
-                        tasks.append(websocket.send_json({
-                            "type": "group_update",
-                            "group_id": group_id,
-                            "group_data": group_data
-                        }))
-                    except Exception as e:
-                        print(f"❌ Error sending group update to {member_uid}: {e}")
-                        await self.disconnect(member_uid, websocket)
-        
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
-            print(f"🔄 Group update sent for group {group_id}")
\ No newline at end of file
+        # Ship the fields clients render rather than the whole group document
+        group_summary = {"id": group_id, **{field: group_data.get(field) for field in GROUP_UPDATE_FIELDS}}
+        if await self._publish(list(members), {
+            "type": "group_update",
+            "group_id": group_id,
+            "group_data": group_summary
+        }):
+            print(f"🔄 Group update sent for group {group_id}")
@@ -50,7 +50,13 @@ let currentGroupId = null;
 let groupMessagesData = {};
 let currentChatUID = null;
 let unreadMessages = {};
+// Last message sequence number seen per conversation; sent when reconnecting so the server replays the gap
+let lastSeenSeq = {};
 let contactsData = [];
+// Contacts' presence pushed by the server: uid -> { online, last_seen }
+let contactPresence = {};
+// Sent messages the server hasn't acknowledged yet: client_id -> message; resent after a reconnect
+let unackedMessages = {};
 let messagesData = {};
 let pendingContactRequests = [];
 let peerConnection;
@@ -197,6 +203,11 @@ async function loadContacts() {
 
         const data = await response.json();
         contactsData = data.contacts || [];
+        contactsData.forEach(contact => {
+            if ("online" in contact) {
+                contactPresence[contact.uid] = { online: contact.online, last_seen: contact.last_seen };
+            }
+        });
         const filteredContacts = contactsData.filter(contact => contact.uid !== user.uid);
         
         // Load messages for each contact first before sorting
@@ -238,6 +249,7 @@ function renderContacts(contacts) {
     contacts.forEach(contact => {
         const contactItem = document.createElement("div");
         contactItem.classList.add("contact-item");
+        contactItem.classList.toggle("online", !!contactPresence[contact.uid]?.online);
         contactItem.dataset.uid = contact.uid;
         
         // Use profile picture if available, otherwise fall back to initials
@@ -322,12 +334,75 @@ function formatDate(date) {
     return date.toLocaleDateString([], { month: 'short', day: 'numeric' });
 }
 
+// "Online", "Last seen ..." or "" when the server hasn't told us
+function presenceLabel(uid) {
+    const presence = contactPresence[uid];
+    if (!presence) return "";
+    if (presence.online) return "Online";
+    return presence.last_seen ? `Last seen ${formatMessageTime(new Date(presence.last_seen))}` : "";
+}
+
+function updatePresenceUI(uid) {
+    const contactItem = contactsContainer.querySelector(`.contact-item[data-uid="${uid}"]`);
+    if (contactItem) {
+        contactItem.classList.toggle("online", !!contactPresence[uid]?.online);
+    }
+    if (currentChatUID === uid && !currentGroupId) {
+        const contact = contactsData.find(c => c.uid === uid);
+        const status = presenceLabel(uid);
+        contactUidElement.textContent = `Username: ${contact?.username || ""}${status ? ` · ${status}` : ""}`;
+    }
+}
+
+// Conversation IDs match the server's: "dm:<uid>:<uid>" (sorted) or "group:<group_id>"
+function directConversationId(uidA, uidB) {
+    return `dm:${[uidA, uidB].sort().join(":")}`;
+}
+
+// Send a chat message tagged with a client_id, so a resend after a dropped connection isn't stored twice
+function sendChatMessage(message) {
+    const outgoing = { ...message, client_id: message.client_id || crypto.randomUUID() };
+    unackedMessages[outgoing.client_id] = outgoing;
+    if (ws && ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify(outgoing));
+    }
+    return outgoing;
+}
+
+function resendUnackedMessages() {
+    Object.values(unackedMessages).forEach(message => {
+        ws.send(JSON.stringify({ ...message, resend: true }));
+    });
+}
+
+// The server acknowledges each message once it is stored; a failed write is retried
+function handleAck(data) {
+    const message = unackedMessages[data.client_id];
+    if (!message) return;
+    if (data.status === "ok") {
+        delete unackedMessages[data.client_id];
+    } else {
+        setTimeout(() => {
+            if (unackedMessages[data.client_id] && ws && ws.readyState === WebSocket.OPEN) {
+                ws.send(JSON.stringify({ ...message, resend: true }));
+            }
+        }, 3000);
+    }
+}
+
+// Tell the server this conversation has been read (resets its unread count in /conversations)
+function sendReadAck(conversationId) {
+    if (!ws || ws.readyState !== WebSocket.OPEN) return;
+    ws.send(JSON.stringify({ type: "read", conversation_id: conversationId }));
+}
+
 // Update openChat to handle profile pictures in chat header
 async function openChat(contact) {
     currentChatUID = contact.uid;
     currentGroupId = null;
     messagesContainer.innerHTML = "";
     unreadMessages[contact.uid] = 0;
+    sendReadAck(directConversationId(getCurrentUser()?.uid, contact.uid));
     updateContactUI();
 
     noChatSelected.style.display = "none";
@@ -340,6 +415,7 @@ async function openChat(contact) {
     
     chatNameElement.textContent = contact.name || contact.username;
     contactUidElement.textContent = `Username: ${contact.username}`;
+    updatePresenceUI(contact.uid);
     
     // Handle profile picture in chat header
     if (contact.profile_picture_url) {
@@ -640,77 +716,38 @@ function setupWebSocket(user) {
     
     ws.onopen = () => {
         console.log("✅ WebSocket connected");
-        ws.send(JSON.stringify({ token: user.token }));
+        const auth = { token: user.token };
+        if (Object.keys(lastSeenSeq).length > 0) {
+            auth.resume = lastSeenSeq;
+        }
+        ws.send(JSON.stringify(auth));
+        resendUnackedMessages();
     };
 
     ws.onmessage = (event) => {
+        let data;
         try {
-            const data = JSON.parse(event.data);
-
-            // Check if message has file attributes and set the appropriate type for rendering
-            if (data.file_url && (data.type === "message" || data.type === "group_message")) {
-                // Detect message type from mime type if possible
-                const fileType = data.file_type || '';
-                
-                // Clone the data for safe modification
-                const messageData = {...data};
-                
-                // Set message type for proper rendering
-                if (fileType.startsWith('image/')) {
-                    messageData.type = 'image';
-                } else if (fileType.startsWith('video/')) {
-                    messageData.type = 'video';
-                } else if (data.file_url) {
-                    messageData.type = 'file';
-                }
-                
-                // Process based on message category
-                if (data.type === "message") {
-                    handleNewMessage(messageData);
-                } else if (data.type === "group_message") {
-                    handleNewGroupMessage(messageData);
-                }
-            } else {
-                // Handle normal messages
-                if (data.type === "message") {
-                    handleNewMessage(data);
-                }
-                 else if (data.type === "group_message") {
-                    handleNewGroupMessage(data);
-                } else if (data.type === "contact_request_accepted") {
-                    // Handle contact request acceptance
-                    handleContactRequestAccepted(data);
-                } else if (data.type === "typing") {
-                    showTypingIndicator(data.sender);
-                } else if (data.type === "group_typing") {
-                    showGroupTypingIndicator(data.group_id, data.sender);
-                } else if (data.type === "notification") {
-                    fetchPendingContactRequests();
-                } else if (data.type === "profile_picture_update") {
-                    // Update profile picture in UI
-                    const user = getCurrentUser();
-                    if (user && data.profile_picture_url) {
-                        user.profile_picture_url = data.profile_picture_url;
-                        localStorage.setItem("user", JSON.stringify(user));
-                        updateProfilePictureUI(user);
-                    }
-                } else if (data.type === 'webrtc_offer') {
-                    handleIncomingCall(data);
-                } else if (data.type === 'webrtc_answer') {
-                    handleAnswer(data);
-                } else if (data.type === 'webrtc_ice') {
-                    handleICECandidate(data);
-                } else if (data.type === 'webrtc_end') {
-                    handleCallEnd();
-                }
-                else if (data.type === 'group_update') {
-                    updategroupinformation(data)
-                    
-                }
-            }
+            data = JSON.parse(event.data);
         } catch (error) {
             console.error("❌ Error parsing WebSocket message:", error);
+            return;
         }
+
+        // Server heartbeat: answer so the connection isn't reaped as dead
+        if (data.type === "ping") {
+            ws.send(JSON.stringify({ type: "pong" }));
+            return;
+        }
+
+        // Events queued while we were offline arrive together in one frame
+        const frames = data.type === "offline_batch" ? data.frames : [data];
+        frames.forEach(frame => {
+            try {
+                handleSocketFrame(frame);
+            } catch (error) {
+                console.error("❌ Error handling WebSocket message:", error);
+            }
+        });
     };
 
     ws.onclose = () => {
@@ -723,6 +760,103 @@ function setupWebSocket(user) {
     };
 }
 
+function handleSocketFrame(data) {
+    if (data.conversation_id && data.seq) {
+        // Replayed on resume but already delivered (e.g. in the offline batch)
+        if (data.replayed && data.seq <= (lastSeenSeq[data.conversation_id] || 0)) return;
+        lastSeenSeq[data.conversation_id] = Math.max(lastSeenSeq[data.conversation_id] || 0, data.seq);
+    }
+    if (data.type === "resync") {
+        // Missed too much while offline: reload the open conversation's history
+        if (data.conversation_id === `group:${currentGroupId}`) {
+            loadGroupMessages(currentGroupId);
+        } else if (currentChatUID && data.conversation_id === directConversationId(getCurrentUser()?.uid, currentChatUID)) {
+            loadMessages(currentChatUID);
+        }
+        return;
+    }
+    if (data.type === "ack") {
+        handleAck(data);
+        return;
+    }
+
+    // Check if message has file attributes and set the appropriate type for rendering
+    if (data.file_url && (data.type === "message" || data.type === "group_message")) {
+        // Detect message type from mime type if possible
+        const fileType = data.file_type || '';
+    
+        // Clone the data for safe modification
+        const messageData = {...data};
+    
+        // Set message type for proper rendering
+        if (fileType.startsWith('image/')) {
+            messageData.type = 'image';
+        } else if (fileType.startsWith('video/')) {
+            messageData.type = 'video';
+        } else if (data.file_url) {
+            messageData.type = 'file';
+        }
+    
+        // Process based on message category
+        if (data.type === "message") {
+            handleNewMessage(messageData);
+        } else if (data.type === "group_message") {
+            handleNewGroupMessage(messageData);
+        }
+    } else {
+        // Handle normal messages
+        if (data.type === "message") {
+            handleNewMessage(data);
+        }
+         else if (data.type === "group_message") {
+            handleNewGroupMessage(data);
+        } else if (data.type === "contact_request_accepted") {
+            // Handle contact request acceptance
+            handleContactRequestAccepted(data);
+        } else if (data.type === "typing") {
+            showTypingIndicator(data.sender);
+        } else if (data.type === "group_typing") {
+            showGroupTypingIndicator(data.group_id, data.sender);
+        } else if (data.type === "typing_stop") {
+            hideTypingIndicator(data.sender);
+        } else if (data.type === "group_typing_stop") {
+            hideTypingIndicator(data.group_id);
+        } else if (data.type === "presence") {
+            contactPresence[data.uid] = { online: data.online, last_seen: data.last_seen };
+            updatePresenceUI(data.uid);
+        } else if (data.type === "notification") {
+            fetchPendingContactRequests();
+        } else if (data.type === "profile_picture_update") {
+            // Update profile picture in UI
+            const user = getCurrentUser();
+            if (user && data.profile_picture_url) {
+                user.profile_picture_url = data.profile_picture_url;
+                localStorage.setItem("user", JSON.stringify(user));
+                updateProfilePictureUI(user);
+            }
+        } else if (data.type === 'webrtc_offer') {
+            handleIncomingCall(data);
+        } else if (data.type === 'webrtc_answer') {
+            handleAnswer(data);
+        } else if (data.type === 'webrtc_ice') {
+            handleICECandidate(data);
+        } else if (data.type === 'webrtc_end') {
+            handleCallEnd();
+        }
+        else if (data.type === 'group_update') {
+            updategroupinformation(data)
+        
+        }
+    }
+}
+
+// A message is delivered again when its sender resends it after a failed write; it keeps its id and client_id
+function isDuplicateMessage(messages, message) {
+    return messages.some(existing =>
+        (message.id && existing.id === message.id) ||
+        (message.client_id && existing.client_id === message.client_id && existing.sender === message.sender));
+}
+
 // Completely revamped function to handle new messages and always move contacts to top
 function handleNewMessage(message) {
     const currentUser = getCurrentUser();
@@ -735,6 +869,7 @@ function handleNewMessage(message) {
     if (!messagesData[contactUID]) {
         messagesData[contactUID] = [];
     }
+    if (isDuplicateMessage(messagesData[contactUID], message)) return;
     
     // Add message to the messages array with proper timestamp
     const newMessage = {
@@ -759,6 +894,8 @@ function handleNewMessage(message) {
     // Only increment unread count for received messages if not currently viewing this chat
     if (!isSentByMe && contactUID !== currentChatUID) {
         unreadMessages[contactUID] = (unreadMessages[contactUID] || 0) + 1;
+    } else if (!isSentByMe) {
+        sendReadAck(directConversationId(currentUser.uid, contactUID));
     }
     
     // Always move contact to the top of the list, for both sent and received messages
@@ -831,6 +968,13 @@ function showTypingIndicator(senderUID) {
         }, 2000);
     }
 }
+
+function hideTypingIndicator(chatId) {
+    if (chatId === currentChatUID || chatId === currentGroupId) {
+        clearTimeout(typingIndicator.timeout);
+        typingIndicator.style.display = "none";
+    }
+}
 function getMemberName(uid) {
     if (!currentGroupData) return "Member";
     const member = currentGroupData.members.find(m => m.uid === uid);
@@ -1616,13 +1760,13 @@ async function sendMessage(messageContent) {
         }
 
         // Send via WebSocket
-        ws.send(JSON.stringify(message));
+        const sent = sendChatMessage(message);
 
         // Handle the sent message locally
         if (currentGroupId) {
-            handleNewGroupMessage(message);
+            handleNewGroupMessage(sent);
         } else {
-            handleNewMessage(message);
+            handleNewMessage(sent);
         }
 
         // Clear input field
@@ -2132,6 +2276,7 @@ async function openGroupChat(group) {
     currentGroupData = group;
     currentChatUID = null; // Ensure private chat UID is cleared
     messagesContainer.innerHTML = "";
+    sendReadAck(`group:${group.id}`);
 
     // Toggle menu items
     document.querySelectorAll('.private-chat-only').forEach(el => el.style.display = 'none');
@@ -2301,6 +2446,7 @@ function handleNewGroupMessage(message) {
     if (!groupMessagesData[message.group_id]) {
         groupMessagesData[message.group_id] = [];
     }
+    if (isDuplicateMessage(groupMessagesData[message.group_id], message)) return;
     
     const newMessage = {
         ...message,
@@ -3582,18 +3728,18 @@ async function handleFileUpload(file, type) {
                     // Send via WebSocket
                     if (currentChatUID) {
                         // Private chat
-                        ws.send(JSON.stringify({
+                        sendChatMessage({
                             type: "message",
                             receiver: currentChatUID,
                             ...messageData
-                        }));
+                        });
                     } else if (currentGroupId) {
                         // Group chat
-                        ws.send(JSON.stringify({
+                        sendChatMessage({
                             type: "group_message",
                             group_id: currentGroupId,
                             ...messageData
-                        }));
+                        });
                     }
 
                     // Clear file input and preview